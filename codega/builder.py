@@ -1,17 +1,54 @@
 import os
+import sys
 import stat
-import shutil
+import time
 import re
+import json
+import multiprocessing
+
+from multiprocessing.pool import ThreadPool
 
 from lxml import etree
 
 from codega import logger
-from codega.rsclocator import FallbackLocator, FileResourceLocator
+from codega.buildgraph import BuildNode, BuildGraph, Scheduler, GraphError, format_schedule, PrefetchResult, \
+    DEFAULT_PREFETCH_MEMORY
+from codega.fscache import StatCache
+from codega.manifest import BuildManifest, hash_data, hash_file
+from codega.history import BuildHistory, TARGET, SOURCE
+from codega.summary import BuildSummary
+from codega.timing import no_measure, get_peak_memory, PeakMemory
+from codega.filecopy import copy_file, is_same_file, DEFAULT_COPY_MODE
+from codega.dependencies import DependencyRecorder
+from codega.cache import ContentCache, SourceCache, OutputCache, PostProcessCache, get_cache_dir, SOURCE_CACHE, \
+    OUTPUT_CACHE, POSTPROCESS_CACHE
+from codega.postprocess import PostProcessor, PostProcessError, get_command_files, DEFAULT_POSTPROCESS_JOBS
+from codega.remotecache import RemoteStore, get_remote_cache, DEFAULT_TIMEOUT
+from codega.shard import select_shard
+from codega.writer import OutputWriter, DEFAULT_WRITE_THREADS, FSYNC_NONE
+from codega.stamp import get_signature, save_stamp, check_stamp
+from codega.rsclocator import FallbackLocator, FileResourceLocator, RecordingLocator, ResourceError
 from codega.source import SourceBase
-from codega.context import Context
+from codega.context import Context, OutputSink, check_output_name
 from codega.decorators import abstract, mark, has_mark
 from codega.generator.base import GeneratorBase
+from codega.generator.traversal import TraversalGenerator, traverse
 from codega.config.source import ConfigSource, ParseError
+from codega.config.structures import StructureBuilder
+
+
+# Directory (relative to the config file) holding the persistent build state
+STATE_DIR = '.codega'
+
+# Name of the build stamp of a config in the state directory
+STAMP_NAME = 'stamp-%s'
+
+# Estimated memory use of a parsed source relative to the size of its resource
+SOURCE_MEMORY_FACTOR = 8
+
+# Copies are built in batches, each batch is run by a pool of threads
+COPY_BATCH_SIZE = 256
+DEFAULT_COPY_THREADS = 4
 
 
 class BuilderError(Exception):
@@ -27,20 +64,39 @@ def get_mtime(filename):
     return 0
 
 
-def get_module_time(locator, module):
-    '''Get the modification time for a module'''
+def get_module_path(locator, module):
+    '''Get the source file of a module or the directory of a package.
+
+    The module is only imported if it cannot be found otherwise.'''
+
+    try:
+        filename = locator.find_module(module)
 
-    mod = locator.import_module(module)
-    dirname, basename = os.path.split(mod.__file__)
+    except ImportError:
+        filename = locator.import_module(module).__file__
 
-    if os.path.splitext(basename)[0] != '__init__':
-        return get_mtime(mod.__file__)
+    dirname, basename = os.path.split(filename)
+    name, ext = os.path.splitext(basename)
 
-    res = []
-    for root, _, files in os.walk(dirname):
-        res.extend((get_mtime(os.path.join(root, f)) for f in files))
+    if name == '__init__':
+        return dirname
 
-    return max(res)
+    if ext in ('.pyc', '.pyo') and os.path.exists(os.path.join(dirname, name + '.py')):
+        return os.path.join(dirname, name + '.py')
+
+    return filename
+
+
+def get_settings_items(container, prefix=()):
+    '''List the (key, value) pairs of a settings container recursively'''
+
+    for key, value in container.iteritems():
+        if isinstance(value, basestring):
+            yield prefix + (key,), value
+
+        else:
+            for item in get_settings_items(value, prefix + (key,)):
+                yield item
 
 
 def build_locator(config, base_path=None):
@@ -78,6 +134,9 @@ def task(name):
 
 
 class BuilderBase(object):
+    # Builders that can be run in a worker process
+    parallel = False
+
     def __init__(self, parent):
         self.__parent = parent
 
@@ -86,7 +145,45 @@ class BuilderBase(object):
         return self.__parent
 
     def check_filter(self, filter, name):
-        return filter is None or filter(name)
+        '''Check if an output is selected by the filter and by the shard of the build'''
+
+        if filter is not None and not filter(name):
+            return False
+
+        return self.parent.is_selected(self.parent.get_output_path(name))
+
+    def prepare_task(self, task, *args, **kwargs):
+        '''Called in the main process before the build graph is run.
+
+        If the builder has a prepare_<task> method it is called, its result
+        tells whether the task has anything to do.'''
+
+        prepare = getattr(self, 'prepare_%s' % task, None)
+        if prepare is None:
+            return True
+
+        return prepare(*args, **kwargs)
+
+    def get_sources(self, task):
+        '''Names of the sources the task needs'''
+
+        return ()
+
+    def get_outputs(self):
+        '''Absolute paths of the files written by the builder'''
+
+        return ()
+
+    def get_cost(self):
+        '''Predicted build time of the builder in seconds (None if it is
+        unknown, see codega.history)'''
+
+        return 0.0
+
+    def get_memory(self):
+        '''Predicted memory use of building in bytes'''
+
+        return 0
 
     def run_task(self, task, *args, **kwargs):
         if hasattr(self, task):
@@ -105,71 +202,388 @@ class BuilderBase(object):
         return '%s(%s)' % (self.__class__.__name__, self)
 
 
+class TargetBuild(object):
+    '''The state of a target being generated (see TargetBuilder.start_build)
+
+    Members:
+    destination -- Output path of the target
+    source -- Source config entry of the target
+    fingerprint -- Hash of the inputs of the target
+    cache_key -- Key of the target in the output cache
+    labels -- Profile labels of the target
+    context -- Generation context
+    start -- Time the build of the target started
+    recorder -- DependencyRecorder of the files used by the generator
+    loaded -- The generator module was loaded before it was recorded
+    '''
+
+    destination = None
+    source = None
+    fingerprint = None
+    cache_key = None
+    labels = None
+    context = None
+    start = None
+    recorder = None
+    loaded = False
+
+    def __init__(self, destination, source, fingerprint, cache_key, labels, context, start):
+        self.destination = destination
+        self.source = source
+        self.fingerprint = fingerprint
+        self.cache_key = cache_key
+        self.labels = labels
+        self.context = context
+        self.start = start
+        self.recorder = DependencyRecorder()
+
+
 class TargetBuilder(BuilderBase):
+    parallel = True
+
     def __init__(self, parent, target):
         super(TargetBuilder, self).__init__(parent)
 
         self.__target = target
+        self.__cached = False
 
-    @task('build')
-    def build(self, filter=None, force=False):
+    @property
+    def target(self):
+        return self.__target.filename
+
+    def get_fingerprint(self, source):
+        '''Hash of the inputs of the target known before generating it: the
+        source resource, the codega, parser and transform modules, the
+        generator reference, the target settings and the postprocess steps
+        (with the files they reference). The files read by the generator are
+        recorded when the target is generated.'''
+
+        parts = [
+            'codega', self.parent.get_module_digest('codega'),
+            'resource', self.parent.get_resource_digest(source.resource),
+            'parser', str(source.parser), self.parent.get_module_digest(source.parser.module),
+        ]
+
+        for transform in source.transform:
+            parts.extend(['transform', str(transform), self.parent.get_module_digest(transform.module)])
+
+        parts.extend(['generator', str(self.__target.generator)])
+        parts.extend(['settings', repr(list(get_settings_items(self.__target.settings.data)))])
+        for step in self.__target.postprocess:
+            parts.extend(['check' if step.check else 'postprocess', step.command])
+
+        for _, digest in self.parent.get_postprocess_scripts(self.__target):
+            parts.extend(['script', digest])
+
+        return hash_data('\n'.join(parts))
+
+    def get_cache_key(self, fingerprint):
+        '''Key of the target in the output cache: the fingerprint and the
+        content hash of the generator module'''
+
+        module = self.__target.generator.module
+        return hash_data('\n'.join(['output', fingerprint, 'generator', self.parent.get_module_digest(module)]))
+
+    def get_output_cache_key(self):
+        source = self.parent.config.sources[self.__target.source]
+        return self.get_cache_key(self.get_fingerprint(source))
+
+    def is_up_to_date(self, destination, fingerprint):
+        '''Check if the recorded inputs, dependencies and output of the
+        target are unchanged'''
+
+        record = self.parent.manifest.get_target(self.__target.filename)
+        if record is None or record['inputs'] != fingerprint or 'depends' not in record:
+            return False
+
+        for path, digest in record['depends']:
+            if self.parent.get_path_digest(path) != digest:
+                logger.debug('Dependency %r of %r changed', path, self.__target.filename)
+                return False
+
+        if self.__target.multiple:
+            if 'outputs' not in record:
+                return False
+
+            return all(self.parent.manifest.file_digest(os.path.join(destination, name)) == digest
+                       for name, digest in record['outputs'])
+
+        return self.parent.manifest.file_digest(destination) == record['output']
+
+    def prepare_build(self, filter=None, force=False):
         if not self.check_filter(filter, self.__target.filename):
-            return
+            return False
+
+        destination = self.parent.get_target_path(self.__target.filename)
+        source = self.parent.config.sources[self.__target.source]
+
+        self.__cached = False
+        if force:
+            return True
+
+        fingerprint = self.get_fingerprint(source)
+        if self.is_up_to_date(destination, fingerprint):
+            return False
+
+        # Targets found in the output cache do not need their source
+        self.__cached = self.parent.get_cached_output(self.get_cache_key(fingerprint)) is not None
+        return True
+
+    def get_sources(self, task):
+        if task == 'build' and not self.__cached:
+            return (self.__target.source,)
+
+        return ()
+
+    def get_outputs(self):
+        '''The output file, or the target directory and the files recorded
+        in the manifest for multiple output targets'''
+
+        destination = self.parent.get_output_path(self.__target.filename)
+        if not self.__target.multiple:
+            return (destination,)
+
+        record = self.parent.manifest.get_target(self.__target.filename) or {}
+        return (destination,) + tuple(os.path.join(destination, name) for name, _ in record.get('outputs', ()))
+
+    def get_duration(self):
+        '''Get the recorded build time of the target (None if it is unknown)'''
+
+        return self.parent.history.get_duration(TARGET, self.__target.filename)
+
+    def get_cost(self):
+        # Restoring an output from the output cache costs almost nothing
+        if self.__cached:
+            return 0.0
+
+        return self.get_duration()
+
+    def get_memory(self):
+        '''The memory recorded when the target was generated, or the
+        estimated size of its source if it is unknown'''
+
+        if self.__cached:
+            return 0
+
+        memory = self.parent.history.get_memory(TARGET, self.__target.filename)
+        if memory is None:
+            memory = self.parent.get_source_size(self.parent.config.sources[self.__target.source])
+
+        return memory
+
+    def start_build(self, filter=None, force=False):
+        '''Check if the target has to be generated. Returns the state of the
+        build, or None if the target is not selected, is up to date or was
+        restored from the output cache.'''
+
+        if not self.check_filter(filter, self.__target.filename):
+            return None
 
         destination = self.parent.get_target_path(self.__target.filename)
         source = self.parent.config.sources[self.__target.source]
 
         # Check if we need to rebuild the target
-        if not force and os.path.exists(destination):
-            modules = ['codega', source.parser.module, self.__target.generator.module]
+        fingerprint = self.get_fingerprint(source)
+        if not force and self.is_up_to_date(destination, fingerprint):
+            return None
+
+        start = time.time()
+        labels = {
+            'target': os.path.relpath(destination),
+            'source': source.name,
+            'generator': self.__target.generator.module,
+            'builder': 'target',
+        }
+
+        # Restore the output from the output cache
+        cache_key = self.get_cache_key(fingerprint)
+        if not force and self.parent.session.output_cache is not None:
+            with self.parent.measure('restore', **labels):
+                restored = self.restore_output(destination, fingerprint, cache_key, start)
+
+            if restored:
+                return None
+
+        # Generation context, the files of multiple output targets are
+        # written to the output sink
+        sink = OutputSink() if self.__target.multiple else None
+        context = Context(self.parent.config, source, self.__target, locator=self.parent.locator, output=sink)
+
+        return TargetBuild(destination, source, fingerprint, cache_key, labels, context, start)
+
+    def load_generator(self, state):
+        '''Load the generator of the target, the modules it imports are
+        recorded as dependencies'''
 
-            # If the destination modification time is more recent than any other
-            # listed modification time (mtime of any of the modules or files) we
-            # need to rebuild
-            time = 0
-            time = max(time, get_mtime(source.resource))
-            time = reduce(max, [get_module_time(self.parent.locator, m) for m in modules], time)
+        state.loaded = self.__target.generator.module in sys.modules
+        with state.recorder:
+            generator = self.__target.generator.load(self.parent.locator)
+            if isinstance(generator, type) and issubclass(generator, GeneratorBase):
+                generator = generator()
 
-            if get_mtime(destination) >= time:
-                return
+            elif not isinstance(generator, GeneratorBase):
+                raise BuilderError("Generator reference %s could not be loaded" % generator)
 
-        # Generation context
-        context = Context(self.parent.config, source, self.__target)
+        return generator
+
+    @task('build')
+    def build(self, filter=None, force=False):
+        state = self.start_build(filter, force)
+        if state is None:
+            return
 
         # Load source
-        data = self.parent.get_source(source)
+        data = self.parent.get_source(state.source)
+        self.generate(state, data)
+
+    def generate(self, state, data, generator=None):
+        '''Generate the target and write its output'''
+
+        # Generate output, the files and modules used are recorded
+        with self.parent.measure('generate', **state.labels), PeakMemory() as memory:
+            if generator is None:
+                generator = self.load_generator(state)
+
+            with state.recorder:
+                output = generator.generate(data, state.context)
+
+        self.finish_build(state, output, time.time() - state.start, memory.value)
+
+    def finish_build(self, state, output, duration, memory, depends=()):
+        '''Write the generated output and record the build of the target.
+        The files in depends were read while the output was generated,
+        besides the ones recorded for the target.'''
+
+        destination = state.destination
+        sink = state.context.output
+
+        # If the generator module was loaded before recording, the modules
+        # it imports are not known, so the whole module is a dependency
+        module = self.__target.generator.module
+        depends = sorted(set(state.recorder.get_files()).union(depends))
+        if state.loaded and not state.recorder.is_known(module):
+            depends.append(os.path.abspath(get_module_path(self.parent.locator, module)))
+
+        # The outputs are only written if every postprocess step succeeded
+        items = sink.items() if sink is not None else [(self.__target.filename, output)]
+        if self.__target.postprocess:
+            with self.parent.measure('postprocess', **state.labels):
+                items = self.parent.postprocess_outputs(self.__target, items)
+
+            if sink is None:
+                output = items[0][1]
+
+        # Write output. The output of a multiple output target is the list
+        # of its files and their hashes.
+        files = ()
+        with self.parent.measure('write', **state.labels):
+            if sink is not None:
+                outputs = self.parent.write_outputs(destination, items)
+                contents = dict(items)
+                files = [(digest, contents[name]) for name, digest in outputs]
+                output = json.dumps(outputs)
+                digest = hash_data(output)
+
+            else:
+                digest = self.parent.write_output(destination, output)
+
+        prefix = os.path.join(os.path.abspath(destination), '')
+        record = {
+            'inputs': state.fingerprint,
+            'output': digest,
+            'depends': [(path, self.parent.get_path_digest(path)) for path in depends
+                        if path != destination and not path.startswith(prefix)],
+        }
+
+        if sink is not None:
+            self.remove_stale_outputs(outputs)
+            record['outputs'] = outputs
 
-        # Generate output
-        generator = self.__target.generator.load(self.parent.locator)
-        if isinstance(generator, type) and issubclass(generator, GeneratorBase):
-            generator = generator()
+        self.parent.manifest.set_target(self.__target.filename, record)
+        self.parent.history.record(TARGET, self.__target.filename, duration, memory)
+        self.parent.store_cached_output(state.cache_key, output, digest, record['depends'], files=files)
 
-        elif not isinstance(generator, GeneratorBase):
-            raise BuilderError("Generator reference %s could not be loaded" % generator)
+    def restore_output(self, destination, fingerprint, cache_key, start):
+        '''Restore the output from the output cache. Returns False if it is
+        not cached.'''
 
-        output = generator.generate(data, context)
+        cached = self.parent.get_cached_output(cache_key)
+        outputs = None
+        if cached is None:
+            restored = False
 
-        # Write output
-        with open(destination, 'w') as out:
-            out.write(output)
+        elif self.__target.multiple:
+            outputs = self.parent.restore_cached_outputs(destination, cached[0])
+            restored = outputs is not None
+
+        else:
+            restored = self.parent.restore_cached_output(destination, cached[0])
+
+        if not restored:
+            self.parent.summary.add('output cache misses')
+            return False
+
+        logger.info('Output %r restored from the output cache', self.__target.filename)
+        self.parent.summary.add('output cache hits')
+        record = {
+            'inputs': fingerprint,
+            'output': cached[0],
+            'depends': [(path, self.parent.get_path_digest(path)) for path, _ in cached[1]],
+        }
+
+        if outputs is not None:
+            self.remove_stale_outputs(outputs)
+            record['outputs'] = outputs
+
+        self.parent.manifest.set_target(self.__target.filename, record)
+        return True
+
+    def remove_stale_outputs(self, outputs):
+        '''Remove the files of the previous build of a multiple output
+        target that were not generated again'''
+
+        record = self.parent.manifest.get_target(self.__target.filename)
+        if record is None:
+            return
+
+        names = set(name for name, _ in outputs)
+        stale = [name for name, _ in record.get('outputs', ()) if name not in names]
+        if stale:
+            self.parent.remove_output_files(self.__target.filename, stale)
 
     @task('cleanup')
     def cleanup(self, filter=None):
         if not self.check_filter(filter, self.__target.filename):
             return
 
-        self.parent.remove_dest_file(self.__target.filename)
+        if self.__target.multiple:
+            record = self.parent.manifest.get_target(self.__target.filename) or {}
+            self.parent.remove_output_files(self.__target.filename, [name for name, _ in record.get('outputs', ())])
+
+        else:
+            self.parent.remove_dest_file(self.__target.filename)
+
+        self.parent.manifest.remove_target(self.__target.filename)
 
     def __str__(self):
         return 'target(%s)' % self.__target.filename
 
 
 class CopyBuilder(BuilderBase):
+    parallel = True
+
     def __init__(self, parent, copy):
         super(CopyBuilder, self).__init__(parent)
 
         self.__copy = copy
 
+    @property
+    def target(self):
+        return self.__copy.target
+
+    def prepare_build(self, filter=None, force=False):
+        return self.check_filter(filter, self.__copy.target)
+
     @task('build')
     def build(self, filter=None, force=False):
         if not self.check_filter(filter, self.__copy.target):
@@ -178,10 +592,11 @@ class CopyBuilder(BuilderBase):
         source = self.parent.locator.find(self.__copy.source)
         destination = self.parent.get_target_path(self.__copy.target)
 
-        if get_mtime(source) < get_mtime(destination):
-            return
+        with self.parent.measure('copy', target=os.path.relpath(destination), builder='copy'):
+            self.parent.copy_file(source, destination)
 
-        shutil.copy(source, destination)
+    def get_outputs(self):
+        return (self.parent.get_output_path(self.__copy.target),)
 
     @task('cleanup')
     def cleanup(self, filter=None):
@@ -194,14 +609,181 @@ class CopyBuilder(BuilderBase):
         return 'copy(%s)' % self.__copy.target
 
 
+class CopyBatch(BuilderBase):
+    '''Build a batch of copies with a pool of threads (copying is mostly
+    waiting for the disk, so the threads run concurrently)'''
+
+    parallel = True
+
+    def __init__(self, parent, builders):
+        super(CopyBatch, self).__init__(parent)
+
+        self.__builders = builders
+
+    def get_outputs(self):
+        res = []
+        for builder in self.__builders:
+            res.extend(builder.get_outputs())
+
+        return res
+
+    def run_task(self, task, *args, **kwargs):
+        def run(builder):
+            try:
+                builder.run_task(task, *args, **kwargs)
+                return None
+
+            except Exception, error:
+                logger.exception(short_desc=str(error))
+                return '%s: %s' % (builder, error)
+
+        # The copies run concurrently, the wall time of the batch is counted
+        start = time.time()
+        threads = min(self.parent.options.get('copy_threads') or 1, len(self.__builders))
+        if threads > 1:
+            pool = ThreadPool(threads)
+            try:
+                errors = pool.map(run, self.__builders)
+
+            finally:
+                pool.close()
+                pool.join()
+
+        else:
+            errors = map(run, self.__builders)
+
+        if task == 'build':
+            self.parent.summary.add('copy time', time.time() - start)
+
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise BuilderError('Could not copy %d file(s), first error: %s' % (len(errors), errors[0]))
+
+        return True
+
+    def __str__(self):
+        names = ', '.join(builder.target for builder in self.__builders[:3])
+        if len(self.__builders) > 3:
+            names += ' and %d more' % (len(self.__builders) - 3)
+
+        return 'copies(%s)' % names
+
+
+class TargetGroup(BuilderBase):
+    '''Build the targets of a source together (see the fuse option). The
+    targets with traversal generators are generated by a single walk of the
+    source (see codega.generator.traversal), the others in turn.'''
+
+    parallel = True
+
+    def __init__(self, parent, builders):
+        super(TargetGroup, self).__init__(parent)
+
+        self.__builders = builders
+
+    def get_sources(self, task):
+        res = []
+        for builder in self.__builders:
+            res.extend(name for name in builder.get_sources(task) if name not in res)
+
+        return res
+
+    def get_outputs(self):
+        res = []
+        for builder in self.__builders:
+            res.extend(builder.get_outputs())
+
+        return res
+
+    def get_cost(self):
+        costs = [builder.get_cost() for builder in self.__builders]
+        if None in costs:
+            return None
+
+        return sum(costs)
+
+    def get_memory(self):
+        # The targets share their source, which is most of the memory used
+        return max(builder.get_memory() for builder in self.__builders)
+
+    @task('build')
+    def build(self, filter=None, force=False):
+        pending = []
+        for builder in self.__builders:
+            state = builder.start_build(filter, force)
+            if state is not None:
+                pending.append((builder, state))
+
+        if not pending:
+            return
+
+        data = self.parent.get_source(pending[0][1].source)
+
+        fused = []
+        for builder, state in pending:
+            state.start = time.time()
+            generator = builder.load_generator(state)
+            if isinstance(generator, TraversalGenerator):
+                fused.append((builder, state, generator, time.time() - state.start))
+
+            else:
+                builder.generate(state, data, generator)
+
+        if not fused:
+            return
+
+        # The files read during the walk are dependencies of every fused
+        # target, and the walk time is split between them
+        start = time.time()
+        source = pending[0][1].source
+        with self.parent.measure('generate', source=source.name, builder='fused'), PeakMemory() as memory:
+            with DependencyRecorder() as recorder:
+                outputs = traverse(data, [(generator, state.context) for _, state, generator, _ in fused])
+
+        shared = (time.time() - start) / len(fused)
+        depends = recorder.get_files()
+        for (builder, state, _, loading), output in zip(fused, outputs):
+            builder.finish_build(state, output, loading + shared, memory.value, depends)
+
+        logger.info('Generated %d target(s) of source %r in one pass', len(fused), source.name)
+        self.parent.summary.add('fused targets', len(fused))
+
+    @task('cleanup')
+    def cleanup(self, filter=None):
+        for builder in self.__builders:
+            builder.cleanup(filter=filter)
+
+    def __str__(self):
+        return 'targets(%s)' % ', '.join(builder.target for builder in self.__builders)
+
+
 class ExternalBuilder(BuilderBase):
+    '''Build an external config.
+
+    The nodes of an external are normally added to the build graph of the
+    parent (see BuildRunner.add_nodes). The builder itself is only run if
+    the external reads files written by the preceding builders, in which
+    case the external is built in the main process after them.'''
+
     def __init__(self, parent, external):
         super(ExternalBuilder, self).__init__(parent)
 
         self.__external = external
 
+    def get_runner(self):
+        '''Get the runner of the external config (shared by the build)'''
+
+        return self.parent.session.get_runner(self.parent.locator.find(self.__external))
+
     def run_task(self, task, *args, **kwargs):
-        if not BuildRunner.run_task_file(self.parent.locator.find(self.__external), task, *args, **kwargs):
+        for name, value in self.parent.options.iteritems():
+            kwargs.setdefault(name, value)
+
+        # The builders the external depends on changed files since the
+        # digests were computed
+        self.parent.session.writer.flush()
+        self.parent.session.digests.clear()
+        if not self.get_runner().run_task(task, session=self.parent.session, *args, **kwargs):
             raise BuilderError('Could not run task %r on external %s' % (task, self.__external))
 
         return True
@@ -210,136 +792,1579 @@ class ExternalBuilder(BuilderBase):
         return 'external(%s)' % self.__external
 
 
-class BuildRunner(object):
-    def __init__(self, config, base_path='.'):
-        self.__config = config
-        self.__base_path = base_path
-        self.__locator = build_locator(config, base_path=base_path)
+class SourceNode(BuildNode):
+    '''Load a stage of a source: parse it (stage 0) or load a stage from
+    the source cache'''
 
-        self.__source_results = {}
+    prefetchable = True
 
-        self.__builders = []
-        self.__init_builders()
+    def __init__(self, runner, ident, source, stage, order):
+        super(SourceNode, self).__init__(('source', ident, stage), order=order)
 
-    def run_task(self, task, *args, **kwargs):
-        guarded = kwargs.pop('guarded', True)
+        self.__runner = runner
+        self.__source = source
+        self.__stage = stage
+        self.__prefetched = None
 
-        if not self.__builders:
-            logger.error("No builders found")
-            return False
+    @property
+    def cost(self):
+        return self.__runner.history.get_duration(SOURCE, str(self))
 
-        for builder in self.__builders:
-            try:
-                if not builder.run_task(task, *args, **kwargs):
-                    logger.info('Builder has no task %s' % task)
+    @property
+    def memory(self):
+        return self.__runner.get_source_size(self.__source)
 
-                else:
-                    logger.info('Completed task %s on %s' % (task, builder))
+    @property
+    def prefetched(self):
+        return self.__prefetched
 
-            except Exception, error:
-                logger.critical('Could not complete %s: %s', task, error)
-                logger.exception()
-                if not guarded:
-                    raise
+    def prefetch(self, pool):
+        self.__prefetched = PrefetchResult(pool, self.__load)
 
-                return False
+    def run(self):
+        if self.__prefetched is not None:
+            res, self.__prefetched = self.__prefetched.get(), None
 
-        return True
+        else:
+            res = self.__load()
 
-    @classmethod
-    def run_task_file(cls, config_file, task, **kwargs):
-        config_path = get_config(config_file)
+        if self.__stage == len(self.__source.transform):
+            self.__runner.set_source(self.__source, res)
 
-        # Check if file exists
-        if config_path is None:
-            if config_file:
-                logger.critical("File %r not found", config_file)
+        return res
 
-            else:
-                logger.critical("No suitable config file could be found")
+    def __load(self):
+        start = time.time()
+        res = self.__runner.load_source(self.__source, self.__stage)
+        self.__runner.history.record(SOURCE, str(self), time.time() - start)
+        return res
 
-            return False
+    def release(self):
+        super(SourceNode, self).release()
+        if self.__stage == len(self.__source.transform):
+            self.__runner.release_source(self.__source)
 
-        # Load configuration file
-        try:
-            logger.info('Loading config file %r', config_path)
-            config = ConfigSource(BuildRunner.__environment_replacements).load(config_path)
+    def __str__(self):
+        if self.__stage == 0:
+            return 'parse(%s)' % self.__source.name
 
-        except ParseError, parse_error:
-            logger.error('Parse error: %s', parse_error)
-            logger.exception()
-            if not kwargs.get('guarded', True):
-                raise
+        return 'load(%s, stage %d)' % (self.__source.name, self.__stage)
 
-            return False
 
-        return cls(config, base_path=os.path.dirname(config_path)).run_task(task, **kwargs)
+class TransformNode(BuildNode):
+    '''Apply a transformation on the previous stage of a source'''
+
+    prefetchable = True
+
+    def __init__(self, runner, ident, source, index, previous, order):
+        super(TransformNode, self).__init__(('source', ident, index + 1), requires=[previous.key], order=order)
+
+        self.__runner = runner
+        self.__source = source
+        self.__index = index
+        self.__previous = previous
+        self.__prefetched = None
 
     @property
-    def config(self):
-        return self.__config
+    def cost(self):
+        return self.__runner.history.get_duration(SOURCE, str(self))
 
     @property
-    def locator(self):
-        return self.__locator
+    def memory(self):
+        return self.__runner.get_source_size(self.__source)
 
-    def get_target_path(self, relpath):
-        abspath = os.path.join(self.__base_path, self.__config.paths.destination, relpath)
-        dirname = os.path.dirname(abspath)
-        if not os.path.isdir(dirname):
-            raise BuilderError('%r should be a directory' % dirname)
+    @property
+    def prefetched(self):
+        return self.__prefetched
 
-        return abspath
+    def prefetch(self, pool):
+        # The previous stage is either complete or prefetched
+        self.__prefetched = PrefetchResult(pool, self.__transform, self.__previous.value, self.__previous.prefetched)
 
-    def remove_dest_file(self, relpath):
-        logger.debug('Trying to remove %r' % relpath)
-        try:
-            destination = self.get_target_path(relpath)
+    def run(self):
+        if self.__prefetched is not None:
+            res, self.__prefetched = self.__prefetched.get(), None
 
-        except BuilderError:
-            logger.debug('Path containing %r not found' % relpath)
-            return
+        else:
+            res = self.__transform(self.__previous.value)
 
-        if os.path.isfile(destination):
-            logger.info('Removing file %s' % destination)
-            os.unlink(destination)
+        if self.__index + 1 == len(self.__source.transform):
+            self.__runner.set_source(self.__source, res)
 
-        else:
-            logger.debug('File %r not found' % relpath)
+        return res
 
-    def get_source(self, source):
-        if isinstance(source, basestring):
-            source = self.__config.sources[source]
+    def __transform(self, data, pending=None):
+        if pending is not None:
+            data = pending.get()
 
-        logger.debug('Trying to parse source %r' % source.name)
-        if source not in self.__source_results:
-            parser = source.parser.load(self.__locator)
-            if isinstance(parser, type) and issubclass(parser, SourceBase):
-                parser = parser()
+        start = time.time()
+        res = self.__runner.transform_source(self.__source, self.__index, data)
+        self.__runner.history.record(SOURCE, str(self), time.time() - start)
+        return res
 
-            if not isinstance(parser, SourceBase):
-                raise BuilderError("Parser reference %s could not be loaded" % parser)
+    def release(self):
+        super(TransformNode, self).release()
+        if self.__index + 1 == len(self.__source.transform):
+            self.__runner.release_source(self.__source)
 
-            res = parser.load(source.resource, self.__locator)
-            if isinstance(res, etree._ElementTree):
-                res = res.getroot()
+    def __str__(self):
+        return 'transform(%s, stage %d)' % (self.__source.name, self.__index + 1)
 
-            for transform in source.transform:
-                modtrans = transform.load(self.__locator)
-                res = modtrans(res)
 
-            self.__source_results[source] = res
-            logger.info('Source %r successfuly parsed' % source.name)
+class BuilderNode(BuildNode):
+    '''Run a task on a builder. Builders with nothing to do are only reported.
 
-        else:
-            logger.debug('Source already parsed')
+    The position of the builder is its index in the builder list of its
+    runner, prefixed by the positions of the externals it belongs to. The
+    builder is run in the order of its position unless an order is given.'''
 
-        return self.__source_results[source]
+    ordered = True
 
-    def __run_external(self, task, **kwargs):
-        for ext in self.__config.external:
-            if not self.__class__.run_task_file(self.__locator.find(ext), task, **kwargs):
-                raise BuilderError('Could not run task %r on external %s' % (task, ext))
+    def __init__(self, runner, position, builder, task, args, kwargs, requires=(), needed=True, order=None):
+        if order is None:
+            order = position + (1,)
+
+        super(BuilderNode, self).__init__(('builder', position), requires=requires, order=order)
+
+        self.__runner = runner
+        self.__builder = builder
+        self.__task = task
+        self.__args = args
+        self.__kwargs = kwargs
+        self.__needed = needed
+
+    @property
+    def parallel(self):
+        return self.__needed and self.__builder.parallel
+
+    @property
+    def cost(self):
+        if not self.__needed or self.__task != 'build':
+            return 0.0
+
+        return self.__builder.get_cost()
+
+    @property
+    def memory(self):
+        if not self.__needed or self.__task != 'build':
+            return 0
+
+        return self.__builder.get_memory()
+
+    def run(self):
+        if not self.__needed:
+            return True
+
+        # The changes inherited from the main process are not sent back
+        self.__runner.pop_changes()
+        return self.__builder.run_task(self.__task, *self.__args, **self.__kwargs)
+
+    def collect(self):
+        return self.__runner.pop_changes()
+
+    def merge(self, extra):
+        if extra is not None:
+            self.__runner.merge_changes(extra)
+
+    def report(self, success, error):
+        if not success:
+            logger.critical('Could not complete %s on %s: %s', self.__task, self.__builder, error[0])
+            logger.exception(short_desc=error[0], long_desc=error[1])
+
+        elif not self.value:
+            logger.info('Builder has no task %s' % self.__task)
+
+        else:
+            logger.info('Completed task %s on %s' % (self.__task, self.__builder))
+
+    def __str__(self):
+        return str(self.__builder)
+
+
+def get_job_count(jobs):
+    '''Get the number of worker processes to use (0 or less means one per CPU)'''
+
+    if jobs is None:
+        return 1
+
+    if jobs <= 0:
+        return multiprocessing.cpu_count()
+
+    return jobs
+
+
+class BuildSession(object):
+    '''State shared by the runner of a build and the runners of its
+    externals, so the same configs are not loaded, the same files are not
+    hashed and the same sources are not parsed more than once
+
+    Members:
+    runners -- Runners of the external configs by absolute path
+    sources -- Final results of the sources by source key
+    digests -- Content hashes of files and directories by absolute path
+    source_cache -- The persistent SourceCache (None if it is not used)
+    output_cache -- The persistent OutputCache (None if it is not used)
+    remote_cache -- The RemoteCache backing the persistent caches (None if it is not used)
+    postprocess_cache -- The PostProcessCache (None if it is not used)
+    writer -- The OutputWriter writing the outputs of the targets
+    source_memory -- Estimated memory use of the sources in memory by source key
+    peak_source_memory -- The highest total of source_memory in the build
+    '''
+
+    runners = None
+    sources = None
+    digests = None
+    source_cache = None
+    output_cache = None
+    remote_cache = None
+    postprocess_cache = None
+    writer = None
+    source_memory = None
+    peak_source_memory = 0
+
+    def __init__(self, source_cache=None, output_cache=None, remote_cache=None, writer=None, postprocess_cache=None):
+        self.runners = {}
+        self.sources = {}
+        self.digests = {}
+        self.source_cache = source_cache
+        self.output_cache = output_cache
+        self.remote_cache = remote_cache
+        self.postprocess_cache = postprocess_cache
+        self.writer = writer if writer is not None else OutputWriter(threads=0)
+        self.source_memory = {}
+
+    def add_source_memory(self, key, size):
+        self.source_memory[key] = size
+        self.peak_source_memory = max(self.peak_source_memory, sum(self.source_memory.itervalues()))
+
+    def remove_source_memory(self, key):
+        self.source_memory.pop(key, None)
+
+    def get_runner(self, config_path):
+        '''Get the runner of an external config, every config is loaded once'''
+
+        config_path = os.path.abspath(config_path)
+        if config_path not in self.runners:
+            runner = BuildRunner.load_file(config_path, guarded=False)
+            if runner is None:
+                raise BuilderError('Could not load external %r' % config_path)
+
+            self.runners[config_path] = runner
+
+        return self.runners[config_path]
+
+
+class BuildRunner(object):
+    # If set, load_file takes the runners from this RunnerCache, so the
+    # configs and sources stay loaded between the builds
+    runner_cache = None
+
+    # Keep the sources in memory after their last consumer was built (set
+    # for runners reused by several builds)
+    keep_sources = False
+
+    # Absolute path of the config file (None if the config was not loaded
+    # from a file)
+    config_path = None
+
+    def __init__(self, config, base_path='.', state_dir=STATE_DIR):
+        self.__config = config
+        self.__base_path = base_path
+        self.__state_dir = state_dir
+        self.__locator = build_locator(config, base_path=base_path)
+        self.__options = {}
+
+        self.__stats = StatCache()
+        self.__summary = BuildSummary()
+        self.__manifest = BuildManifest(self.get_state_path('manifest'), stats=self.__stats).load()
+        self.__history = BuildHistory(self.get_state_path('history')).load()
+        self.__session = BuildSession()
+        self.__module_digests = {}
+        self.__resource_digests = {}
+
+        self.__source_keys = {}
+        self.__source_dependencies = {}
+        self.__source_results = {}
+        self.__run_count = 0
+        self.__profile_mark = 0
+
+        self.__builders = []
+        self.__init_builders()
+
+    def run_task(self, task, *args, **kwargs):
+        guarded = kwargs.pop('guarded', True)
+        session = kwargs.pop('session', None)
+        owner = session is None
+
+        # Options of the run, they are passed on to the externals
+        options = {
+            'jobs': get_job_count(kwargs.pop('jobs', 1)),
+            'write_if_changed': kwargs.pop('write_if_changed', True),
+            'source_cache': kwargs.pop('source_cache', False),
+            'output_cache': kwargs.pop('output_cache', False),
+            'cache_dir': kwargs.pop('cache_dir', None),
+            'remote_cache': kwargs.pop('remote_cache', None),
+            'remote_timeout': kwargs.pop('remote_timeout', DEFAULT_TIMEOUT),
+            'profile': kwargs.pop('profile', None),
+            'copy_mode': kwargs.pop('copy_mode', DEFAULT_COPY_MODE),
+            'copy_threads': kwargs.pop('copy_threads', DEFAULT_COPY_THREADS),
+            'selected': kwargs.pop('selected', None),
+            'memory_budget': kwargs.pop('memory_budget', None),
+            'prefetch': kwargs.pop('prefetch', 0),
+            'prefetch_memory': kwargs.pop('prefetch_memory', DEFAULT_PREFETCH_MEMORY),
+            'write_threads': kwargs.pop('write_threads', DEFAULT_WRITE_THREADS),
+            'fsync': kwargs.pop('fsync', FSYNC_NONE),
+            'fuse': kwargs.pop('fuse', False),
+            'postprocess_jobs': kwargs.pop('postprocess_jobs', DEFAULT_POSTPROCESS_JOBS),
+        }
+
+        shard = kwargs.pop('shard', None)
+        shard_weights = kwargs.pop('shard_weights', None)
+
+        # If given, the predicted schedule is written to this file instead
+        # of running the build
+        explain_schedule = kwargs.pop('explain_schedule', None)
+
+        if not self.__builders:
+            logger.error("No builders found")
+            return False
+
+        if session is None:
+            source_cache = output_cache = postprocess_cache = remote_cache = None
+            if options['source_cache'] or options['output_cache']:
+                remote_cache = get_remote_cache(options['remote_cache'], options['remote_timeout'])
+
+            if options['source_cache']:
+                path = os.path.join(get_cache_dir(options['cache_dir']), SOURCE_CACHE)
+                remote = RemoteStore(remote_cache, SOURCE_CACHE) if remote_cache is not None else None
+                source_cache = SourceCache(ContentCache(path, remote=remote))
+
+            if options['output_cache']:
+                path = os.path.join(get_cache_dir(options['cache_dir']), OUTPUT_CACHE)
+                remote = RemoteStore(remote_cache, OUTPUT_CACHE) if remote_cache is not None else None
+                output_cache = OutputCache(ContentCache(path, remote=remote))
+
+                # The post-processed outputs are cached along with the outputs
+                path = os.path.join(get_cache_dir(options['cache_dir']), POSTPROCESS_CACHE)
+                remote = RemoteStore(remote_cache, POSTPROCESS_CACHE) if remote_cache is not None else None
+                postprocess_cache = PostProcessCache(ContentCache(path, remote=remote))
+
+            # Worker processes are not forked while the writer threads run
+            threads = options['write_threads'] if options['jobs'] <= 1 else 0
+            writer = OutputWriter(threads, fsync=options['fsync'])
+            session = BuildSession(source_cache, output_cache, remote_cache, writer, postprocess_cache)
+
+        runners = [self]
+        written = True
+        self.start_run(options, session)
+        try:
+            try:
+                if shard is not None:
+                    self.__options['selected'] = self.get_shard_outputs(shard[0], shard[1], shard_weights)
+
+                graph = BuildGraph()
+                self.add_nodes(graph, runners, task, args, kwargs)
+
+            except Exception, error:
+                logger.critical('Could not prepare %s: %s', task, error)
+                logger.exception()
+                if not guarded:
+                    raise
+
+                return False
+
+            if explain_schedule is not None:
+                print >> explain_schedule, format_schedule(graph, self.jobs)
+                return True
+
+            try:
+                res = Scheduler(graph, jobs=self.jobs, guarded=guarded,
+                                memory_budget=self.__options['memory_budget'],
+                                prefetch=self.__options['prefetch'],
+                                prefetch_memory=self.__options['prefetch_memory']).run()
+
+            except GraphError, error:
+                raise BuilderError(str(error))
+
+        finally:
+            # The pending writes are completed before the state is saved
+            if owner:
+                written = session.writer.join()
+
+            if owner and task == 'build':
+                self.__summary.add('peak source memory (MB)', session.peak_source_memory / float(1 << 20))
+                self.__summary.add('peak memory (MB)', get_peak_memory() / float(1 << 20))
+
+            for runner in runners:
+                runner.finish_run()
+
+            if any(runner.summary['source cache stores'] for runner in runners):
+                session.source_cache.cache.evict()
+
+            if owner and session.output_cache is not None:
+                self.__update_output_cache(session.output_cache, runners)
+
+            if owner and session.postprocess_cache is not None and \
+                    any(runner.summary['post-processed outputs'] for runner in runners):
+                session.postprocess_cache.cache.evict()
+
+            if owner and session.remote_cache is not None:
+                session.remote_cache.close()
+
+        res = res and written
+
+        # The stamp is only saved after a complete build
+        if res and owner and task == 'build' and kwargs.get('filter') is None and self.__options['selected'] is None:
+            self.save_stamp()
+
+        return res
+
+    def start_run(self, options, session):
+        '''Reset the state of the previous run'''
+
+        self.__options = dict(options)
+        self.__session = session
+        self.__run_count += 1
+        self.__summary.clear()
+        self.__stats.clear()
+        self.__manifest.refresh()
+        self.__module_digests = {}
+        self.__resource_digests = {}
+        self.__source_keys = {}
+
+    def finish_run(self):
+        '''Log the summary and save the build state of the run'''
+
+        self.__summary.log()
+        self.__manifest.save()
+        self.__history.save()
+
+    def build_graph(self, task, *args, **kwargs):
+        '''Create the build graph of a task (see add_nodes)'''
+
+        graph = BuildGraph()
+        self.add_nodes(graph, [self], task, args, kwargs)
+        return graph
+
+    def add_nodes(self, graph, runners, task, args, kwargs, prefix=()):
+        '''Add the nodes of a task to the build graph.
+
+        Builders with nothing to do do not require their sources, so the
+        sources only needed by up-to-date targets are not parsed. The
+        consumers of a source are run before the next source is loaded, and
+        a source is released after its last consumer (see release_source),
+        so few sources are in memory at the same time.
+
+        The nodes of the externals are added to the same graph, so they
+        share the parsed sources and their builders are run in parallel
+        with the others. An external reading a file written by a preceding
+        builder is built after that builder instead (see ExternalBuilder).
+        Each external config is only built once, the runners taking part
+        in the build are appended to runners.
+
+        Returns the node keys of the builders by the absolute paths of the
+        files they write.'''
+
+        if task == 'build':
+            self.prefetch_cache_entries()
+
+        requirements = []
+        consumer = {}
+        for index, builder in enumerate(self.__builders):
+            if isinstance(builder, ExternalBuilder):
+                requirements.append((builder, None, ()))
+                continue
+
+            needed = builder.prepare_task(task, *args, **kwargs)
+            sources = builder.get_sources(task) if needed else ()
+            requirements.append((builder, needed, sources))
+
+            for name in sources:
+                consumer.setdefault(name, index)
+
+        # Source stages are ordered right before their first consumer. The
+        # stages before the last one found in the source cache are skipped.
+        # Sources with the same key are only loaded once in a build.
+        final = {}
+        for name, index in sorted(consumer.iteritems(), key=lambda item: item[1]):
+            source = self.__config.sources[name]
+            keys = self.get_source_keys(source)
+            if self.has_source(source):
+                if keys is not None:
+                    self.__session.sources.setdefault(keys[-1], self.__source_results[source][2])
+
+                continue
+
+            if keys is not None and keys[-1] in self.__session.sources:
+                continue
+
+            ident = keys[-1] if keys is not None else (prefix, name)
+            last = ('source', ident, len(source.transform))
+            if last not in graph:
+                first = self.get_cached_stage(source)
+                order = prefix + (index, 0)
+                node = graph.add(SourceNode(self, ident, source, first, order=order + (first,)))
+                for stage in range(first, len(source.transform)):
+                    node = graph.add(TransformNode(self, ident, source, stage, node, order=order + (stage + 1,)))
+
+            final[name] = last
+
+        # The copies of a build are run in batches. A batch is placed at
+        # the position of its first copy.
+        batches = {}
+        if task == 'build':
+            copies = [index for index, (builder, needed, _) in enumerate(requirements)
+                      if needed and isinstance(builder, CopyBuilder)]
+            for start in range(0, len(copies), COPY_BATCH_SIZE):
+                batch = copies[start:start + COPY_BATCH_SIZE]
+                batches[batch[0]] = CopyBatch(self, [requirements[index][0] for index in batch])
+                for index in batch[1:]:
+                    batches[index] = None
+
+        # With the fuse option the targets generated from the same source
+        # are built together (see TargetGroup). A group is placed at the
+        # position of its first target.
+        if task == 'build' and self.__options.get('fuse'):
+            groups = {}
+            for index, (builder, needed, sources) in enumerate(requirements):
+                if needed and sources and isinstance(builder, TargetBuilder):
+                    groups.setdefault(tuple(sources), []).append(index)
+
+            for group in groups.itervalues():
+                if len(group) > 1:
+                    batches[group[0]] = TargetGroup(self, [requirements[index][0] for index in group])
+                    for index in group[1:]:
+                        batches[index] = None
+
+        producers = {}
+        for index, (builder, needed, sources) in enumerate(requirements):
+            position = prefix + (index,)
+            if index in batches:
+                if batches[index] is None:
+                    continue
+
+                builder = batches[index]
+                needed = True
+                sources = builder.get_sources(task)
+
+            elif isinstance(builder, ExternalBuilder):
+                runner = builder.get_runner()
+                if runner in runners:
+                    logger.debug('External %r is already built', runner.base_path)
+                    continue
+
+                requires = sorted(set(producers[path] for path in runner.get_inputs() if path in producers))
+                if requires:
+                    node = graph.add(BuilderNode(self, position, builder, task, args, kwargs, requires=requires))
+                    producers.update((path, node.key) for path in runner.get_outputs())
+                    continue
+
+                runners.append(runner)
+                runner.start_run(self.__options, self.__session)
+                producers.update(runner.add_nodes(graph, runners, task, args, kwargs, position))
+                continue
+
+            # The order of a consumer starts with the position of the first
+            # consumer of its source (the order of the source stages)
+            requires = [final[name] for name in sources if name in final]
+            order = graph[requires[0]].order[:-2] + (1,) + position if requires else None
+            node = graph.add(BuilderNode(self, position, builder, task, args, kwargs, requires=requires, needed=needed,
+                                         order=order))
+            producers.update((path, node.key) for path in builder.get_outputs())
+
+        return producers
+
+    def get_inputs(self, visited=None):
+        '''Absolute paths the resources of the sources and copies may be
+        read from (of the externals too)'''
+
+        if visited is None:
+            visited = set()
+
+        visited.add(self)
+        paths = [os.path.join(self.__base_path, path) for path in self.__config.paths.paths] + [self.__base_path]
+        resources = [source.resource for source in self.__config.sources.values()]
+        resources.extend(copy.source for copy in self.__config.copy.values())
+
+        res = set(os.path.abspath(os.path.join(path, resource)) for path in paths for resource in resources)
+        for runner in self.__get_external_runners():
+            if runner not in visited:
+                res.update(runner.get_inputs(visited))
+
+        return res
+
+    def get_outputs(self, visited=None):
+        '''Absolute paths of the files written by the targets and copies (of
+        the externals too)'''
+
+        if visited is None:
+            visited = set()
+
+        visited.add(self)
+        res = set()
+        for builder in self.__builders:
+            res.update(builder.get_outputs())
+
+        for runner in self.__get_external_runners():
+            if runner not in visited:
+                res.update(runner.get_outputs(visited))
+
+        return res
+
+    def get_stamp_signatures(self, visited=None):
+        '''Get the signatures of the files and directories the staleness
+        checks of the build depend on (of the externals too, see
+        codega.stamp)'''
+
+        if visited is None:
+            visited = set()
+
+        visited.add(self)
+        paths = set([os.path.abspath(self.__base_path)])
+        paths.update(os.path.abspath(os.path.join(self.__base_path, path)) for path in self.__config.paths.paths)
+        if self.config_path is not None:
+            paths.add(self.config_path)
+
+        modules = set(['codega'])
+        for source in self.__config.sources.itervalues():
+            modules.add(source.parser.module)
+            modules.update(transform.module for transform in source.transform)
+            try:
+                paths.add(os.path.abspath(self.__locator.find(source.resource)))
+
+            except ResourceError:
+                pass
+
+        for module in modules:
+            path = os.path.abspath(get_module_path(self.__locator, module))
+            paths.add(path)
+            if self.__stats.isdir(path):
+                paths.update(self.__stats.walk_files(path))
+
+        for target in self.__config.targets.itervalues():
+            destination = self.get_output_path(target.filename)
+            paths.add(destination)
+            record = self.__manifest.get_target(target.filename)
+            if record is not None:
+                paths.update(path for path, _ in record.get('depends', ()))
+                paths.update(os.path.join(destination, name) for name, _ in record.get('outputs', ()))
+
+        for copy in self.__config.copy.itervalues():
+            paths.add(self.get_output_path(copy.target))
+            try:
+                paths.add(os.path.abspath(self.__locator.find(copy.source)))
+
+            except ResourceError:
+                pass
+
+        # The files are recorded as they were when they were hashed, so a
+        # file changed during the build is still detected
+        res = {}
+        for path in paths:
+            res[path] = self.__manifest.get_file_signature(path) or get_signature(path)
+
+        for runner in self.__get_external_runners():
+            if runner not in visited:
+                res.update(runner.get_stamp_signatures(visited))
+
+        return res
+
+    def save_stamp(self):
+        '''Save the stamp of a complete build of the config'''
+
+        if self.config_path is None or self.__state_dir is None:
+            return
+
+        # Creating the state directory changes the config directory
+        filename = self.get_state_path(STAMP_NAME % os.path.basename(self.config_path))
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        save_stamp(filename, self.get_config_paths(), self.get_stamp_signatures())
+
+    def get_config_paths(self, visited=None):
+        '''Get the paths of the config files of the build (of the externals too)'''
+
+        if visited is None:
+            visited = set()
+
+        visited.add(self)
+        res = [self.config_path] if self.config_path is not None else []
+        for runner in self.__get_external_runners():
+            if runner not in visited:
+                res.extend(path for path in runner.get_config_paths(visited) if path not in res)
+
+        return res
+
+    @classmethod
+    def is_stamp_valid(cls, config_file):
+        '''Check if nothing changed since the last complete build of a config
+        file, without loading it (see codega.stamp)'''
+
+        config_path = get_config(config_file)
+        if config_path is None:
+            return False
+
+        config_path = os.path.abspath(config_path)
+        return check_stamp(os.path.join(os.path.dirname(config_path), STATE_DIR,
+                                        STAMP_NAME % os.path.basename(config_path)))
+
+    def get_shard_items(self, visited=None):
+        '''Get the targets and copies (of the externals too) as (kind,
+        absolute output path, recorded build time or None) tuples'''
+
+        if visited is None:
+            visited = set()
+
+        visited.add(self)
+        res = []
+        for builder in self.__builders:
+            if isinstance(builder, TargetBuilder):
+                res.append(('target', builder.get_outputs()[0], builder.get_duration()))
+
+            elif isinstance(builder, CopyBuilder):
+                res.append(('copy', builder.get_outputs()[0], None))
+
+        for runner in self.__get_external_runners():
+            if runner not in visited:
+                res.extend(runner.get_shard_items(visited))
+
+        return res
+
+    def get_shard_name(self, path):
+        '''Name of an output in the shard partition and reports: its path
+        relative to the config'''
+
+        return os.path.relpath(path, os.path.abspath(self.__base_path))
+
+    def get_shard_outputs(self, index, count, weights=None):
+        '''Get the absolute paths of the outputs built by a shard (see codega.shard)'''
+
+        items = self.get_shard_items()
+        names = dict((self.get_shard_name(path), path) for _, path, _ in items)
+        targets = [self.get_shard_name(path) for kind, path, _ in items if kind == 'target']
+        copies = [self.get_shard_name(path) for kind, path, _ in items if kind == 'copy']
+
+        selected = select_shard(targets, copies, index, count, weights)
+        logger.info('Shard %d/%d builds %d of %d outputs', index, count, len(selected), len(names))
+        return frozenset(names[name] for name in selected)
+
+    def get_shard_report(self):
+        '''Get the report items of the outputs built by the shard of the
+        last run (see codega.shard.save_report)'''
+
+        res = {}
+        for _, path, duration in self.get_shard_items():
+            if not self.is_selected(path):
+                continue
+
+            # The outputs of multiple output targets are directories
+            if os.path.isfile(path):
+                digest = hash_file(path)
+
+            elif os.path.isdir(path):
+                digest = self.get_path_digest(path)
+
+            else:
+                digest = None
+
+            res[self.get_shard_name(path)] = {
+                'digest': digest,
+                'duration': duration,
+            }
+
+        return res
+
+    def is_selected(self, path):
+        '''Check if an output is built by the shard of the run (every output
+        is if the build is not sharded)'''
+
+        selected = self.__options.get('selected')
+        return selected is None or path in selected
+
+    @classmethod
+    def load_config(cls, config_path):
+        '''Parse a config file, the environment variables are substituted'''
+
+        logger.info('Loading config file %r', config_path)
+        return ConfigSource(BuildRunner.__environment_replacements).load(config_path)
+
+    @classmethod
+    def load_file(cls, config_file, guarded=True):
+        '''Load a config file and create a runner for it. Returns None if
+        the config could not be loaded.'''
+
+        config_path = get_config(config_file)
+
+        # Check if file exists
+        if config_path is None:
+            if config_file:
+                logger.critical("File %r not found", config_file)
+
+            else:
+                logger.critical("No suitable config file could be found")
+
+            return None
+
+        # Load configuration file
+        try:
+            if cls.runner_cache is not None:
+                runner = cls.runner_cache.get_runner(cls, config_path)
+
+            else:
+                runner = cls(cls.load_config(config_path), base_path=os.path.dirname(config_path))
+
+        except ParseError, parse_error:
+            logger.error('Parse error: %s', parse_error)
+            logger.exception()
+            if not guarded:
+                raise
+
+            return None
+
+        runner.config_path = os.path.abspath(config_path)
+        return runner
+
+    @classmethod
+    def run_task_file(cls, config_file, task, **kwargs):
+        # A build with nothing to do returns without loading the config
+        fast = task == 'build' and not kwargs.get('force') and kwargs.get('shard') is None
+        if fast and cls.is_stamp_valid(config_file):
+            logger.info('Nothing changed since the last build')
+            return True
+
+        runner = cls.load_file(config_file, guarded=kwargs.get('guarded', True))
+        if runner is None:
+            return False
+
+        return runner.run_task(task, **kwargs)
+
+    @classmethod
+    def run_task_files(cls, config_files, task, base_path='.', **kwargs):
+        '''Run a task on several config files in one build.
+
+        The configs are run as the externals of a config without targets,
+        so they share the session (the parsed sources, the caches and the
+        digests) and their builders are run in parallel. Configs with a
+        valid stamp are skipped on builds, the stamps of the others are
+        saved after a complete build. The summaries of the configs are
+        added up and logged at the end.'''
+
+        start = time.time()
+        fast = task == 'build' and not kwargs.get('force') and kwargs.get('shard') is None
+        pending = [os.path.abspath(filename) for filename in config_files
+                   if not fast or not cls.is_stamp_valid(filename)]
+
+        logger.info('%d of %d config(s) have nothing to do', len(config_files) - len(pending), len(config_files))
+        if not pending:
+            return True
+
+        builder = StructureBuilder()
+        for config_path in pending:
+            builder.add_external(os.path.relpath(config_path, base_path))
+
+        root = cls(builder.config, base_path=base_path, state_dir=None)
+        res = root.run_task(task, **kwargs)
+        if kwargs.get('explain_schedule') is not None:
+            return res
+
+        runners = [root.session.get_runner(config_path) for config_path in pending]
+        if res and task == 'build' and kwargs.get('filter') is None and kwargs.get('shard') is None:
+            for runner in runners:
+                runner.save_stamp()
+
+        total = BuildSummary()
+        for runner in [root] + root.session.runners.values():
+            total.merge(dict(runner.summary))
+
+        total.add('configs', len(pending))
+        total.add('time (s)', time.time() - start)
+        total.log('Total build summary')
+        return res
+
+    @property
+    def config(self):
+        return self.__config
+
+    @property
+    def base_path(self):
+        return self.__base_path
+
+    @property
+    def locator(self):
+        return self.__locator
+
+    @property
+    def options(self):
+        return self.__options
+
+    @property
+    def session(self):
+        return self.__session
+
+    @property
+    def jobs(self):
+        return self.__options.get('jobs', 1)
+
+    @property
+    def summary(self):
+        return self.__summary
+
+    @property
+    def manifest(self):
+        return self.__manifest
+
+    @property
+    def history(self):
+        return self.__history
+
+    @property
+    def stats(self):
+        return self.__stats
+
+    def measure(self, phase, **labels):
+        '''Measure a build phase if the build is profiled (see BuildProfile.measure)'''
+
+        profile = self.__options.get('profile')
+        if profile is None:
+            return no_measure()
+
+        return profile.measure(phase, **labels)
+
+    def pop_changes(self):
+        '''Return the changes of the build state since the last call (used
+        by worker processes)'''
+
+        # The profile may be shared with the runners of the externals, so
+        # each runner remembers how many records it already returned
+        profile = self.__options.get('profile')
+        records = []
+        if profile is not None:
+            records = profile.get_records(self.__profile_mark)
+            self.__profile_mark = len(profile)
+
+        return {
+            'manifest': self.__manifest.pop_changes(),
+            'history': self.__history.pop_changes(),
+            'summary': self.__summary.pop_changes(),
+            'profile': records,
+        }
+
+    def merge_changes(self, changes):
+        '''Merge the changes returned by pop_changes of a worker process'''
+
+        self.__manifest.merge(changes['manifest'])
+        self.__history.merge(changes['history'])
+        self.__summary.merge(changes['summary'])
+        if self.__options.get('profile') is not None:
+            self.__options['profile'].merge(changes['profile'])
+
+    def get_state_path(self, name):
+        '''Get the path of a build state file (None if the state is not persistent)'''
+
+        if self.__state_dir is None:
+            return None
+
+        return os.path.join(self.__base_path, self.__state_dir, name)
+
+    def get_path_digest(self, path):
+        '''Get the content hash of a file or a directory tree'''
+
+        path = os.path.abspath(path)
+        digests = self.__session.digests
+        if path not in digests:
+            if self.__stats.isdir(path):
+                entries = ['%s %s' % (os.path.relpath(filename, path), self.__manifest.file_digest(filename))
+                           for filename in self.__stats.walk_files(path)]
+                digests[path] = hash_data('\n'.join(entries))
+
+            else:
+                digests[path] = self.__manifest.file_digest(path)
+
+        return digests[path]
+
+    def get_resource_digest(self, resource):
+        '''Get the content hash of a source resource. Resources not found by
+        the locator (e.g. ones that are not files) are identified by name'''
+
+        if resource not in self.__resource_digests:
+            try:
+                self.__resource_digests[resource] = self.get_path_digest(self.__locator.find(resource))
+
+            except ResourceError:
+                self.__resource_digests[resource] = hash_data(resource)
+
+        return self.__resource_digests[resource]
+
+    def get_module_digest(self, module):
+        '''Get the content hash of a module or package'''
+
+        if module not in self.__module_digests:
+            self.__module_digests[module] = self.get_path_digest(get_module_path(self.__locator, module))
+
+        return self.__module_digests[module]
+
+    def get_output_path(self, relpath):
+        '''Get the absolute path of an output (the directory is not checked)'''
+
+        return os.path.abspath(os.path.join(self.__base_path, self.__config.paths.destination, relpath))
+
+    def get_target_path(self, relpath):
+        abspath = os.path.join(self.__base_path, self.__config.paths.destination, relpath)
+        dirname = os.path.dirname(abspath)
+        if not self.__stats.isdir(dirname):
+            raise BuilderError('%r should be a directory' % dirname)
+
+        return abspath
+
+    def is_same_content(self, filename, size, digest):
+        '''Check if a file has the given size and content hash'''
+
+        st = self.__stats.stat(os.path.abspath(filename))
+        if st is None or st.st_size != size:
+            return False
+
+        return self.__manifest.file_digest(filename) == digest
+
+    def write_output(self, destination, output):
+        '''Write the output of a target and return its hash. The output is
+        written by the writer of the session, possibly after the method
+        returned (see codega.writer).
+
+        If the write_if_changed option is set, the destination is not
+        touched if its content is the same as the output.'''
+
+        digest = hash_data(output)
+        compare = bool(self.__options.get('write_if_changed'))
+        recorded = None
+        if compare:
+            cached = self.__manifest.get_file(destination)
+            if cached is not None:
+                recorded = (cached[0], cached[1], cached[2] == digest)
+
+        def written(changed):
+            if changed:
+                self.__summary.add('written outputs')
+
+            else:
+                logger.debug('Output %r did not change, not writing it', destination)
+                self.__summary.add('unchanged outputs')
+
+            self.__manifest.update_file(destination, digest)
+
+        self.__session.writer.submit(destination, output, compare=compare, recorded=recorded, callback=written)
+        return digest
+
+    def write_outputs(self, directory, files):
+        '''Write the files of a multiple output target into its directory.
+        Returns the sorted [name, hash] list of the files.
+
+        The directories are created once, then every file is written like
+        the output of a single target (see write_output).'''
+
+        dirnames = set(os.path.dirname(os.path.join(directory, name)) for name, _ in files)
+        for dirname in sorted(dirnames):
+            if not self.__stats.isdir(os.path.abspath(dirname)):
+                os.makedirs(dirname)
+                self.__stats.invalidate(os.path.abspath(dirname))
+
+        outputs = [[name, self.write_output(os.path.join(directory, name), data)] for name, data in files]
+        logger.debug('Submitted %d outputs to %r', len(outputs), directory)
+        return sorted(outputs)
+
+    def remove_output_files(self, relpath, names):
+        '''Remove files of a multiple output target, and the directories
+        (the target directory too) left empty'''
+
+        try:
+            directory = self.get_target_path(relpath)
+
+        except BuilderError:
+            logger.debug('Path containing %r not found' % relpath)
+            return
+
+        dirnames = set([''])
+        for name in names:
+            filename = os.path.join(directory, name)
+            if os.path.isfile(filename):
+                logger.info('Removing file %s' % filename)
+                os.unlink(filename)
+                self.__stats.invalidate(os.path.abspath(filename))
+
+            dirname = os.path.dirname(name)
+            while dirname:
+                dirnames.add(dirname)
+                dirname = os.path.dirname(dirname)
+
+        # Subdirectories first
+        for dirname in sorted(dirnames, reverse=True):
+            path = os.path.join(directory, dirname)
+            if os.path.isdir(path) and not os.listdir(path):
+                os.rmdir(path)
+                self.__stats.invalidate(os.path.abspath(path))
+
+    def copy_file(self, source, destination):
+        '''Copy a file to its destination (see codega.filecopy for the copy
+        modes).
+
+        If the write_if_changed option is set, the destination is not touched
+        if its content is the same as the source, otherwise it is not touched
+        if it is newer than the source.'''
+
+        st = self.__stats.stat(os.path.abspath(source))
+        digest = None
+        if self.__options.get('write_if_changed'):
+            digest = self.__manifest.file_digest(source)
+            unchanged = is_same_file(source, destination) or self.is_same_content(destination, st.st_size, digest)
+
+        else:
+            unchanged = get_mtime(source) < get_mtime(destination)
+
+        if unchanged:
+            logger.debug('Copy %r did not change, not copying it', destination)
+            self.__summary.add('unchanged copies')
+            return
+
+        method = copy_file(source, destination, self.__options.get('copy_mode', DEFAULT_COPY_MODE))
+        logger.debug('Copied %r to %r (%s)', source, destination, method)
+
+        if digest is not None:
+            self.__manifest.update_file(destination, digest)
+
+        else:
+            self.__stats.invalidate(os.path.abspath(destination))
+
+        self.__summary.add('copied files')
+        self.__summary.add('copied bytes', st.st_size)
+
+    def prefetch_cache_entries(self):
+        '''Check which entries of the sources and the targets missing from
+        the persistent caches are in the shared cache, with one request per
+        cache (see codega.remotecache)'''
+
+        source_cache = self.__session.source_cache
+        if source_cache is not None and source_cache.cache.remote is not None:
+            keys = []
+            for source in self.__config.sources.itervalues():
+                keys.extend(self.get_source_keys(source) or ())
+
+            source_cache.cache.prefetch(keys)
+
+        output_cache = self.__session.output_cache
+        if output_cache is not None and output_cache.cache.remote is not None:
+            keys = []
+            for builder in self.__builders:
+                if not isinstance(builder, TargetBuilder):
+                    continue
+
+                # Errors are reported when the target is prepared
+                try:
+                    keys.append(builder.get_output_cache_key())
+
+                except Exception, e:
+                    logger.debug('No output cache key for %s: %s', builder, e)
+
+            output_cache.cache.prefetch(keys)
+
+    def get_cached_output(self, key):
+        '''Look up an output in the output cache. Returns (output digest,
+        dependencies) or None. The dependencies are resolved in the tree of
+        the config (see store_cached_output).'''
+
+        if self.__session.output_cache is None:
+            return None
+
+        base_path = os.path.abspath(self.__base_path)
+
+        def check_file(filename, digest):
+            return self.get_path_digest(os.path.join(base_path, filename)) == digest
+
+        cached = self.__session.output_cache.load(key, check_file)
+        if cached is None:
+            return None
+
+        return cached[0], [(os.path.normpath(os.path.join(base_path, filename)), digest)
+                           for filename, digest in cached[1]]
+
+    def restore_cached_output(self, destination, digest):
+        '''Copy an output from the output cache to its destination (with the
+        copy mode of the build). Returns False if it was evicted.
+
+        The outputs are not hard linked to the cache, since writing the
+        destination later would change the cached output.'''
+
+        path = self.__session.output_cache.get_output_path(digest)
+        if path is None:
+            return False
+
+        if self.__options.get('write_if_changed') and self.is_same_content(destination, os.path.getsize(path), digest):
+            logger.debug('Output %r did not change, not writing it', destination)
+            self.__summary.add('unchanged outputs')
+            return True
+
+        mode = self.__options.get('copy_mode', DEFAULT_COPY_MODE)
+        copy_file(path, destination, 'reflink' if mode == 'hardlink' else mode)
+        self.__manifest.update_file(destination, digest)
+        self.__summary.add('written outputs')
+        return True
+
+    def restore_cached_outputs(self, directory, digest):
+        '''Restore the files of a multiple output target from the output
+        cache, digest is the hash of their list. Returns the list or None
+        if a file was evicted.'''
+
+        path = self.__session.output_cache.get_output_path(digest)
+        if path is None:
+            return None
+
+        with open(path) as f:
+            outputs = json.load(f)
+
+        # The names come from the cache, they must be inside the directory
+        try:
+            for name, _ in outputs:
+                if check_output_name(name) != name:
+                    raise ValueError('Output name %r is not normalized' % name)
+
+        except (ValueError, TypeError, AttributeError), error:
+            logger.warning('Invalid cached outputs of %r: %s', directory, error)
+            return None
+
+        paths = [self.__session.output_cache.get_output_path(digest) for _, digest in outputs]
+        if None in paths:
+            return None
+
+        for dirname in sorted(set(os.path.dirname(os.path.join(directory, name)) for name, _ in outputs)):
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+        for name, digest in outputs:
+            self.restore_cached_output(os.path.join(directory, name), digest)
+
+        return outputs
+
+    def get_postprocess_scripts(self, target):
+        '''Get the (filename, digest) of the files in the config directory
+        the postprocess commands of a target reference'''
+
+        cwd = os.path.abspath(self.__base_path)
+        return [(filename, self.get_path_digest(filename))
+                for step in target.postprocess for filename in get_command_files(step.command, cwd)]
+
+    def postprocess_outputs(self, target, files):
+        '''Run the postprocess steps of a target on its (name, data) outputs
+        (see codega.postprocess). Returns the processed outputs.'''
+
+        steps = [(step.command, step.check) for step in target.postprocess]
+        if target.multiple:
+            files = [(os.path.join(target.filename, name), data) for name, data in files]
+
+        processor = PostProcessor(self.__session.postprocess_cache, jobs=self.__options.get('postprocess_jobs'),
+                                  cwd=os.path.abspath(self.__base_path))
+        try:
+            processed, hits = processor.process_files(files, steps, self.get_postprocess_scripts(target))
+
+        except PostProcessError, error:
+            raise BuilderError('Could not post-process %r: %s' % (target.filename, error))
+
+        self.__summary.add('post-processed outputs', len(files) - hits)
+        if hits:
+            self.__summary.add('post-process cache hits', hits)
+
+        if target.multiple:
+            processed = [(os.path.relpath(name, target.filename), data) for name, data in processed]
+
+        return processed
+
+    def store_cached_output(self, key, output, digest, dependencies, files=()):
+        '''Store an output in the output cache. The key does not depend on
+        the location of the config, so the dependencies inside its directory
+        are stored relative to it, and checked in the tree of the config
+        that uses the entry.'''
+
+        if self.__session.output_cache is None:
+            return
+
+        base_path = os.path.abspath(self.__base_path)
+        prefix = os.path.join(base_path, '')
+        dependencies = [(os.path.relpath(path, base_path) if path.startswith(prefix) else path, file_digest)
+                        for path, file_digest in dependencies]
+
+        if self.__session.output_cache.store(key, output, digest, dependencies, files=files):
+            self.__summary.add('output cache stores')
+
+    def remove_dest_file(self, relpath):
+        logger.debug('Trying to remove %r' % relpath)
+        try:
+            destination = self.get_target_path(relpath)
+
+        except BuilderError:
+            logger.debug('Path containing %r not found' % relpath)
+            return
+
+        if os.path.isfile(destination):
+            logger.info('Removing file %s' % destination)
+            os.unlink(destination)
+
+        else:
+            logger.debug('File %r not found' % relpath)
+
+    def get_source_keys(self, source):
+        '''Get the source cache key of each stage of a source, or None if the
+        source cannot be cached.
+
+        The key of the parsed source is the hash of the absolute path and
+        the content of the resource and the parser module (the parser may
+        read other files relative to the resource), the key of each later
+        stage is the hash of the previous key and the transform module.'''
+
+        if source.name not in self.__source_keys:
+            try:
+                path = os.path.abspath(self.__locator.find(source.resource))
+
+            except ResourceError:
+                self.__source_keys[source.name] = None
+                return None
+
+            key = hash_data('\n'.join([
+                'resource', path, self.get_path_digest(path),
+                'parser', str(source.parser), self.get_module_digest(source.parser.module),
+            ]))
+
+            keys = [key]
+            for transform in source.transform:
+                key = hash_data('\n'.join([key, 'transform', str(transform), self.get_module_digest(transform.module)]))
+                keys.append(key)
+
+            self.__source_keys[source.name] = keys
+
+        return self.__source_keys[source.name]
+
+    def get_cached_stage(self, source):
+        '''Get the last stage of a source found in the source cache (0 if
+        the source has to be parsed)'''
+
+        if self.__session.source_cache is None:
+            return 0
+
+        keys = self.get_source_keys(source)
+        if keys is None:
+            return 0
+
+        for stage in reversed(range(1, len(keys))):
+            if self.__session.source_cache.contains(keys[stage]):
+                return stage
+
+        return 0
+
+    def load_source(self, source, stage=0):
+        '''Get a stage of a source from the source cache. If it is not
+        cached, the source is parsed and transformed up to the stage.'''
+
+        res = self.__load_cached_source(source, stage)
+        if res is None:
+            res = self.parse_source(source)
+            for index in range(stage):
+                res = self.transform_source(source, index, res)
+
+        return res
+
+    def parse_source(self, source):
+        '''Parse a source without applying the transformations'''
+
+        logger.debug('Trying to parse source %r' % source.name)
+        parser = source.parser.load(self.__locator)
+        if isinstance(parser, type) and issubclass(parser, SourceBase):
+            parser = parser()
+
+        if not isinstance(parser, SourceBase):
+            raise BuilderError("Parser reference %s could not be loaded" % parser)
+
+        # Files read by the parser (e.g. includes) are recorded, the cached
+        # source is only valid while they are unchanged
+        locator = RecordingLocator(self.__locator)
+        with self.measure('parse', source=source.name, builder='source'):
+            res = parser.load(source.resource, locator)
+
+        if isinstance(res, etree._ElementTree):
+            res = res.getroot()
+
+        resource = self.__locator.find(source.resource, check_exists=False)
+        self.__source_dependencies[source.name] = [(path, self.get_path_digest(path)) for path in locator.found
+                                                   if path != resource and self.__stats.exists(path)]
+
+        logger.info('Source %r successfuly parsed' % source.name)
+        self.__store_cached_source(source, 0, res)
+        return res
+
+    def transform_source(self, source, index, data):
+        '''Apply a transformation of a source on the previous stage'''
+
+        modtrans = source.transform[index].load(self.__locator)
+        with self.measure('transform', source=source.name, builder='source'):
+            res = modtrans(data)
+
+        self.__store_cached_source(source, index + 1, res)
+        return res
+
+    def set_source(self, source, data):
+        '''Store the final (transformed) result of a source, it is shared
+        with the other runners of the build'''
+
+        keys = self.get_source_keys(source)
+        self.__source_results[source] = (self.__run_count, keys and keys[-1], data)
+        if keys is not None:
+            self.__session.sources[keys[-1]] = data
+
+        self.__session.add_source_memory(self.__get_source_ident(source), self.get_source_size(source))
+
+    def release_source(self, source):
+        '''Drop the final result of a source after its last consumer was
+        built, unless the runner keeps its sources'''
+
+        if self.keep_sources:
+            return
+
+        logger.debug('Releasing source %r', source.name)
+        self.__source_results.pop(source, None)
+        keys = self.get_source_keys(source)
+        if keys is not None:
+            self.__session.sources.pop(keys[-1], None)
+
+        self.__session.remove_source_memory(self.__get_source_ident(source))
+
+    def has_source(self, source):
+        '''Check if the final result of a source is in memory. Results of
+        earlier runs are only kept while the inputs of the source are
+        unchanged, so a runner can be reused for several builds.'''
+
+        if source not in self.__source_results:
+            return False
+
+        run, key, _ = self.__source_results[source]
+        if run == self.__run_count:
+            return True
+
+        keys = self.get_source_keys(source)
+        if key is None or keys is None or key != keys[-1]:
+            del self.__source_results[source]
+            return False
+
+        return True
+
+    def get_source(self, source):
+        if isinstance(source, basestring):
+            source = self.__config.sources[source]
+
+        if not self.has_source(source):
+            keys = self.get_source_keys(source)
+            if keys is not None and keys[-1] in self.__session.sources:
+                logger.debug('Source loaded by another config')
+                res = self.__session.sources[keys[-1]]
+
+                # The source is released by the runner that loaded it
+                if not self.keep_sources:
+                    return res
+
+            else:
+                first = self.get_cached_stage(source)
+                res = self.load_source(source, first)
+                for index in range(first, len(source.transform)):
+                    res = self.transform_source(source, index, res)
+
+            self.set_source(source, res)
+
+        else:
+            logger.debug('Source already parsed')
+
+        return self.__source_results[source][2]
+
+    def release_sources(self):
+        '''Drop the sources kept in memory'''
+
+        self.__source_results = {}
+
+    def get_source_size(self, source):
+        '''Estimate the memory used by a parsed source (in bytes, 0 if the
+        resource is not a file)'''
+
+        try:
+            st = self.__stats.stat(os.path.abspath(self.__locator.find(source.resource)))
+
+        except ResourceError:
+            return 0
+
+        if st is None:
+            return 0
+
+        return st.st_size * SOURCE_MEMORY_FACTOR
+
+    def estimate_source_memory(self):
+        '''Estimate the memory used by the sources kept in memory (in bytes)'''
+
+        return sum(self.get_source_size(source) for source in self.__source_results)
+
+    def __load_cached_source(self, source, stage):
+        if self.__session.source_cache is None:
+            return None
+
+        keys = self.get_source_keys(source)
+        if keys is None:
+            return None
+
+        def check_file(filename, digest):
+            return self.__manifest.file_digest(filename) == digest
+
+        with self.measure('load', source=source.name, builder='source'):
+            res = self.__session.source_cache.load(keys[stage], check_file)
+
+        if res is None:
+            self.__summary.add('source cache misses')
+            return None
+
+        data, self.__source_dependencies[source.name] = res
+        logger.info('Source %r loaded from the source cache (stage %d)', source.name, stage)
+        self.__summary.add('source cache hits')
+        return data
+
+    def __store_cached_source(self, source, stage, data):
+        # Transformations change the tree in place, so each stage is stored
+        # as soon as it is computed
+        if self.__session.source_cache is None:
+            return
+
+        keys = self.get_source_keys(source)
+        if keys is None:
+            return
+
+        if self.__session.source_cache.store(keys[stage], data, self.__source_dependencies.get(source.name, ())):
+            self.__summary.add('source cache stores')
+
+    def __update_output_cache(self, output_cache, runners):
+        # Persistent statistics and eviction of the output cache
+        counters = {}
+        for name in ('hits', 'misses', 'stores'):
+            value = sum(runner.summary['output cache %s' % name] for runner in runners)
+            if value:
+                counters[name] = value
+
+        if counters:
+            output_cache.cache.add_counters(counters)
+
+        if counters.get('stores'):
+            output_cache.cache.evict()
+
+    def __get_source_ident(self, source):
+        keys = self.get_source_keys(source)
+        if keys is not None:
+            return keys[-1]
+
+        return (self.__base_path, source.name)
+
+    def __get_external_runners(self):
+        for builder in self.__builders:
+            if isinstance(builder, ExternalBuilder):
+                yield builder.get_runner()
 
     def __init_builders(self):
         # Add targets
@@ -347,7 +2372,7 @@ class BuildRunner(object):
             self.__builders.append(TargetBuilder(self, target))
 
         # Add copies
-        for name, copy in self.__config.copy.values():
+        for name, copy in self.__config.copy.items():
             self.__builders.append(CopyBuilder(self, copy))
 
         # Add externals
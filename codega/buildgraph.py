@@ -0,0 +1,675 @@
+'''Build graph and scheduler
+
+The build graph contains a node for every step of a build (parsing a source,
+each transformation of it, building targets, copies and externals). The edges
+point from a node to the nodes it requires. The scheduler runs the nodes whose
+requirements are complete; nodes marked as parallel can be run in forked
+worker processes, so they inherit every result computed by the main process
+before they are started.
+
+Nodes may predict their run time (e.g. from the build history). With several
+jobs, the nodes starting the longest predicted chains are run first, so a
+long target is not started last while the other workers are idle.
+
+Nodes may also predict their memory use. With a memory budget, a node is only
+started while the predicted memory of the nodes running or holding a value
+fits in the budget; a node that does not fit is run alone.
+
+In serial builds, prefetchable nodes (e.g. parsing a source) among the next
+nodes to run can be started on background threads, so their work overlaps
+with the nodes run before them.
+'''
+
+import sys
+import heapq
+import select
+import traceback
+import threading
+import multiprocessing
+
+from multiprocessing.pool import ThreadPool
+
+from codega import logger
+from codega.decorators import abstract
+
+
+# Number of threads running the prefetched nodes and the default limit of
+# their predicted memory (in bytes)
+PREFETCH_THREADS = 2
+DEFAULT_PREFETCH_MEMORY = 512 << 20
+
+
+class GraphError(Exception):
+    '''The build graph is inconsistent'''
+
+
+class PrefetchResult(object):
+    '''Result of a function run on a thread of a prefetch pool. Unlike the
+    results of multiprocessing pools, several threads may wait for it (a
+    prefetched node and the prefetched nodes requiring it).
+
+    Members:
+    _event -- Set when the function returned
+    _value -- Return value of the function
+    _exc_info -- Exception raised by the function (or None)
+    '''
+
+    _event = None
+    _value = None
+    _exc_info = None
+
+    def __init__(self, pool, func, *args):
+        self._event = threading.Event()
+        pool.apply_async(self.__run, (func, args))
+
+    def __run(self, func, args):
+        try:
+            self._value = func(*args)
+
+        except Exception:
+            self._exc_info = sys.exc_info()
+
+        finally:
+            self._event.set()
+
+    def get(self):
+        '''Wait for the function, return its value or raise its exception'''
+
+        self._event.wait()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._value
+
+
+class BuildNode(object):
+    '''Node of the build graph
+
+    Members:
+    _key -- Unique key of the node
+    _requires -- Keys of the required nodes
+    _order -- Sort key, ready nodes with lower order are run first
+    value -- Result of the node after it was run (released when no longer needed)
+    cost -- Predicted run time in seconds (None if it is unknown)
+    memory -- Predicted memory use in bytes, from the start of the node until
+              its value is released (or it completed if nothing requires it)
+    '''
+
+    # The node can be run in a worker process
+    parallel = False
+
+    # The report of the node is deferred until every preceding ordered node
+    # is reported, so the output of a parallel run is deterministic
+    ordered = False
+
+    # The node can be run on a background thread before its turn (see
+    # prefetch), it must not depend on the state of the main thread
+    prefetchable = False
+
+    # Pending result of the prefetched node (None if it was not prefetched
+    # or it was run)
+    prefetched = None
+
+    _key = None
+    _requires = None
+    _order = None
+    value = None
+    cost = 0.0
+    memory = 0
+
+    def __init__(self, key, requires=(), order=()):
+        self._key = key
+        self._requires = tuple(requires)
+        self._order = order
+
+    @property
+    def key(self):
+        return self._key
+
+    @property
+    def requires(self):
+        return self._requires
+
+    @property
+    def order(self):
+        return self._order
+
+    @abstract
+    def run(self):
+        '''Run the node and return its result'''
+
+    def prefetch(self, pool):
+        '''Start the work of the node on a thread of pool (see
+        PrefetchResult), run waits for it. Only called if the node is
+        prefetchable and every node it requires is complete or prefetched.'''
+
+    def collect(self):
+        '''Called in the worker process after run, the result is passed to merge'''
+
+    def merge(self, extra):
+        '''Merge the data collected in the worker process'''
+
+    def release(self):
+        '''Called when every node requiring this one completed, the result
+        is no longer needed'''
+
+        self.value = None
+
+    def report(self, success, error):
+        '''Report the outcome of the node
+
+        Arguments:
+        success -- The node completed successfuly
+        error -- The (message, traceback) of the failure
+        '''
+
+    def __str__(self):
+        return str(self._key)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self)
+
+
+class BuildGraph(object):
+    '''Directed acyclic graph of build nodes
+
+    Members:
+    _nodes -- Nodes by key
+    _sequence -- Node keys in insertion order
+    '''
+
+    _nodes = None
+    _sequence = None
+
+    def __init__(self):
+        self._nodes = {}
+        self._sequence = []
+
+    def add(self, node):
+        if node.key in self._nodes:
+            raise GraphError('Node %s is already in the graph' % (node.key,))
+
+        self._nodes[node.key] = node
+        self._sequence.append(node.key)
+        return node
+
+    def __contains__(self, key):
+        return key in self._nodes
+
+    def __getitem__(self, key):
+        return self._nodes[key]
+
+    def __iter__(self):
+        return (self._nodes[key] for key in self._sequence)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def dependents(self):
+        '''Map each node key to the keys of the nodes requiring it'''
+
+        res = dict((key, []) for key in self._sequence)
+        for node in self:
+            for key in node.requires:
+                if key not in self._nodes:
+                    raise GraphError('Node %s requires unknown node %s' % (node.key, key))
+
+                res[key].append(node.key)
+
+        return res
+
+    def topological_order(self):
+        '''List the nodes in an order that respects the requirements'''
+
+        dependents = self.dependents()
+        pending = dict((node.key, len(node.requires)) for node in self)
+        ready = [(node.order, index, node.key) for index, node in enumerate(self) if not node.requires]
+        heapq.heapify(ready)
+
+        res = []
+        sequence = dict((key, index) for index, key in enumerate(self._sequence))
+        while ready:
+            _, _, key = heapq.heappop(ready)
+            res.append(self._nodes[key])
+
+            for dependent in dependents[key]:
+                pending[dependent] -= 1
+                if pending[dependent] == 0:
+                    heapq.heappush(ready, (self._nodes[dependent].order, sequence[dependent], dependent))
+
+        if len(res) != len(self._nodes):
+            raise GraphError('The build graph contains a cycle')
+
+        return res
+
+    def get_costs(self):
+        '''Get the predicted run time of each node by key. Nodes with an
+        unknown cost are predicted to take the average of the known
+        non-zero costs.'''
+
+        res = dict((node.key, node.cost) for node in self)
+        known = [cost for cost in res.itervalues() if cost]
+        default = sum(known) / len(known) if known else 0.0
+        for key, cost in res.iteritems():
+            if cost is None:
+                res[key] = default
+
+        return res
+
+    def get_priorities(self, costs=None):
+        '''Get the predicted run time of the longest chain starting with
+        each node (the node and the nodes requiring it) by key'''
+
+        if costs is None:
+            costs = self.get_costs()
+
+        dependents = self.dependents()
+        res = {}
+        for node in reversed(self.topological_order()):
+            res[node.key] = costs[node.key] + max([res[key] for key in dependents[node.key]] or [0.0])
+
+        return res
+
+    def get_critical_path(self, costs=None):
+        '''List the nodes of the longest predicted chain'''
+
+        if costs is None:
+            costs = self.get_costs()
+
+        priorities = self.get_priorities(costs)
+        dependents = self.dependents()
+        candidates = [node.key for node in self if not node.requires]
+        res = []
+        while candidates:
+            key = max(candidates, key=lambda key: priorities[key])
+            res.append(self._nodes[key])
+            candidates = dependents[key]
+
+        return res
+
+
+def format_schedule(graph, jobs=1, top=10):
+    '''Describe the predicted schedule of a graph: the total predicted run
+    time, the critical path and the nodes started first'''
+
+    costs = graph.get_costs()
+    priorities = graph.get_priorities(costs)
+    path = graph.get_critical_path(costs)
+    unknown = len([node for node in graph if node.cost is None])
+
+    total = sum(costs.itervalues())
+    length = priorities[path[0].key] if path else 0.0
+    lines = [
+        'Predicted schedule of %d nodes with %d job(s), %d without a recorded time' % (len(graph), jobs, unknown),
+        '  total run time: %.3f s, critical path: %.3f s, wall time: at least %.3f s' %
+        (total, length, max(length, total / max(jobs, 1))),
+        '',
+        'Critical path (seconds):',
+    ]
+
+    for node in path:
+        lines.append('  %10.3f%s  %s' % (costs[node.key], '?' if node.cost is None else ' ', node))
+
+    if jobs > 1:
+        order = sorted(graph, key=lambda node: -priorities[node.key])[:top]
+        lines.append('')
+        lines.append('Longest chains, started first (seconds):')
+        for node in order:
+            lines.append('  %10.3f   %s' % (priorities[node.key], node))
+
+    return '\n'.join(lines)
+
+
+def _worker_main(connection, graph):
+    '''Main loop of a worker process: run the nodes sent by the scheduler
+    and send back their outcomes'''
+
+    buffer = logger.buffer_records()
+    while True:
+        key = connection.recv()
+        if key is None:
+            break
+
+        node = graph[key]
+        try:
+            outcome = (True, node.run(), node.collect(), None)
+
+        except Exception, error:
+            outcome = (False, None, node.collect(), (str(error), traceback.format_exc()))
+
+        connection.send(outcome + (buffer.pop_records(),))
+
+    connection.close()
+
+
+class Worker(object):
+    '''A forked worker process running parallel nodes.
+
+    The worker only sees the results that were computed before it was forked,
+    so it can only run nodes whose requirements were complete at that time.
+
+    Members:
+    node -- The node being run by the worker (None if idle)
+    snapshot -- Keys of the nodes that were complete when the worker was forked
+    connection -- Connection to the worker process
+    process -- The worker process
+    '''
+
+    node = None
+    snapshot = None
+    connection = None
+    process = None
+
+    def __init__(self, graph, snapshot):
+        self.snapshot = frozenset(snapshot)
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker_main, args=(child, graph))
+        self.process.start()
+        child.close()
+
+    def fileno(self):
+        return self.connection.fileno()
+
+    def can_run(self, node):
+        return all(key in self.snapshot for key in node.requires)
+
+    def start(self, node):
+        self.node = node
+        self.connection.send(node.key)
+
+    def receive(self):
+        '''Receive the outcome of the current node'''
+
+        try:
+            outcome = self.connection.recv()
+
+        except EOFError:
+            self.stop()
+            outcome = (False, None, None, ('Worker process exited unexpectedly', ''), [])
+
+        self.node = None
+        return outcome
+
+    def stop(self):
+        '''Stop the worker process'''
+
+        if self.process.is_alive():
+            try:
+                self.connection.send(None)
+
+            except IOError:
+                pass
+
+        self.connection.close()
+        self.process.join()
+
+
+class Scheduler(object):
+    '''Run the nodes of a build graph
+
+    Nodes are run as soon as the nodes they require are complete. If more
+    than one job is allowed, parallel nodes are run in worker processes while
+    the main process runs the others, and the ready nodes starting the
+    longest predicted chains are run first (otherwise in topological
+    order). Workers are reused while they have
+    every requirement of the next node, otherwise a new one is forked. After
+    a failure no new nodes are started.
+
+    With a memory budget, the ready nodes are started while the predicted
+    memory of the nodes running or holding a value fits in the budget. Once
+    a node does not fit, no other node is started until it does, so large
+    nodes are not postponed to the end; a node is always started if nothing
+    else is running, so larger nodes than the budget are run alone.
+
+    In serial builds, the prefetchable nodes among the next nodes in order
+    are prefetched while the predicted memory of the prefetched nodes not
+    run yet fits in the prefetch memory. Worker processes are not forked
+    while threads are running, so parallel builds do not prefetch.
+
+    Members:
+    _graph -- The build graph
+    _jobs -- Maximum number of worker processes
+    _guarded -- If false, the first failure raises an exception
+    _memory_budget -- Maximum predicted memory use in bytes (None if not limited)
+    _prefetch -- Number of the next nodes considered for prefetching
+    _prefetch_memory -- Maximum predicted memory of the prefetched nodes in bytes
+    _exc_info -- Key and exception of the first node that failed in the main process
+    '''
+
+    _graph = None
+    _jobs = None
+    _guarded = None
+    _memory_budget = None
+    _prefetch = 0
+    _prefetch_memory = None
+    _exc_info = None
+
+    def __init__(self, graph, jobs=1, guarded=True, memory_budget=None, prefetch=0,
+                 prefetch_memory=DEFAULT_PREFETCH_MEMORY):
+        self._graph = graph
+        self._jobs = jobs
+        self._guarded = guarded
+        self._memory_budget = memory_budget
+        self._prefetch = prefetch
+        self._prefetch_memory = prefetch_memory
+
+    def run(self):
+        '''Run the graph, return True if every node completed'''
+
+        graph = self._graph
+        order = graph.topological_order()
+        position = dict((node.key, (index,)) for index, node in enumerate(order))
+        if self._jobs > 1:
+            priorities = graph.get_priorities()
+            position = dict((key, (-priorities[key],) + value) for key, value in position.iteritems())
+
+        dependents = graph.dependents()
+        pending = dict((node.key, len(node.requires)) for node in graph)
+
+        ready = [(position[node.key], node.key) for node in graph if not node.requires]
+        heapq.heapify(ready)
+
+        workers = []
+        outcomes = {}
+        reported = [0]
+        reports = [node for node in graph if node.ordered]
+        failure = [None]
+
+        # Predicted memory of the nodes started and not released yet
+        usage = {}
+
+        # Predicted memory of the prefetched nodes not run yet
+        pool = None
+        prefetched = {}
+        if self._prefetch > 0 and self._jobs <= 1:
+            pool = ThreadPool(PREFETCH_THREADS)
+
+        def prefetch(node):
+            # The serial run order is the topological order
+            index = position[node.key][-1]
+            for other in order[index + 1:index + 1 + self._prefetch]:
+                if not other.prefetchable or other.key in prefetched:
+                    continue
+
+                if not all(key in prefetched or (key in outcomes and outcomes[key][0]) for key in other.requires):
+                    continue
+
+                memory = other.memory or 0
+                if self._prefetch_memory is not None and sum(prefetched.itervalues()) + memory > self._prefetch_memory:
+                    break
+
+                logger.debug('Prefetching %s', other)
+                other.prefetch(pool)
+                prefetched[other.key] = memory
+
+        def fits(node):
+            if self._memory_budget is None or not any(worker.node is not None for worker in workers):
+                return True
+
+            return sum(usage.itervalues()) + (node.memory or 0) <= self._memory_budget
+
+        def start(node):
+            usage[node.key] = node.memory or 0
+            if self._memory_budget is not None and usage[node.key] > self._memory_budget:
+                logger.info('%s needs about %d MB, more than the memory budget, running it alone',
+                            node, usage[node.key] >> 20)
+
+        def complete(node, outcome):
+            success, value, extra, error, records = outcome
+            node.value = value
+            node.merge(extra)
+            outcomes[node.key] = (success, error, records)
+            if not success or not dependents[node.key]:
+                usage.pop(node.key, None)
+
+            if not success:
+                if failure[0] is None:
+                    failure[0] = (node, error)
+
+                if not node.ordered:
+                    logger.replay(records)
+                    node.report(False, error)
+
+                return
+
+            for dependent in dependents[node.key]:
+                pending[dependent] -= 1
+                if pending[dependent] == 0:
+                    heapq.heappush(ready, (position[dependent], dependent))
+
+            # Release the values of the required nodes nobody else needs
+            for key in node.requires:
+                if all(other in outcomes for other in dependents[key]):
+                    graph[key].release()
+                    usage.pop(key, None)
+
+            if not node.ordered:
+                logger.replay(records)
+                node.report(True, None)
+
+        def flush_reports():
+            while reported[0] < len(reports) and reports[reported[0]].key in outcomes:
+                node = reports[reported[0]]
+                success, error, records = outcomes[node.key]
+                logger.replay(records)
+                node.report(success, error)
+                reported[0] += 1
+
+        def get_worker(node):
+            idle = [worker for worker in workers if worker.node is None]
+            for worker in idle:
+                if worker.can_run(node):
+                    return worker
+
+            if len(workers) >= self._jobs:
+                if not idle:
+                    return None
+
+                # Replace an idle worker forked before the requirements of
+                # the node were complete
+                idle[0].stop()
+                workers.remove(idle[0])
+
+            logger.debug('Forking a new worker process')
+            worker = Worker(graph, outcomes)
+            workers.append(worker)
+            return worker
+
+        try:
+            while True:
+                # Start the ready nodes. Parallel nodes without a free worker
+                # are deferred, so the main process can go on with the others.
+                # Once a node does not fit in the memory budget, the others
+                # wait for it.
+                deferred = []
+                while ready and failure[0] is None:
+                    item = heapq.heappop(ready)
+                    node = graph[item[1]]
+
+                    if not fits(node):
+                        logger.debug('Waiting for memory to start %s', node)
+                        deferred.append(item)
+                        deferred.extend(ready)
+                        del ready[:]
+                        break
+
+                    if node.parallel and self._jobs > 1:
+                        worker = get_worker(node)
+                        if worker is None:
+                            deferred.append(item)
+
+                        else:
+                            logger.debug('Starting %s in a worker process', node)
+                            start(node)
+                            worker.start(node)
+
+                        continue
+
+                    if pool is not None:
+                        prefetch(node)
+
+                    start(node)
+                    complete(node, self.__run_inline(node))
+                    prefetched.pop(node.key, None)
+                    flush_reports()
+
+                for item in deferred:
+                    heapq.heappush(ready, item)
+
+                busy = [worker for worker in workers if worker.node is not None]
+                if not busy:
+                    break
+
+                readable, _, _ = select.select(busy, [], [])
+                for worker in readable:
+                    node = worker.node
+                    outcome = worker.receive()
+                    if not outcome[0] and worker in workers and not worker.process.is_alive():
+                        workers.remove(worker)
+
+                    complete(node, outcome)
+
+                flush_reports()
+
+        finally:
+            for worker in workers:
+                worker.stop()
+
+            # Prefetched nodes not run after a failure complete in the
+            # background, at most the next few nodes
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        # After a failure some ordered nodes may not have been run, the
+        # completed ones are still reported
+        for node in reports[reported[0]:]:
+            if node.key in outcomes:
+                success, error, records = outcomes[node.key]
+                logger.replay(records)
+                node.report(success, error)
+
+        if failure[0] is not None:
+            if not self._guarded:
+                node, error = failure[0]
+                if self._exc_info is not None and self._exc_info[0] == node.key:
+                    exc_type, exc_value, exc_trace = self._exc_info[1]
+                    raise exc_type, exc_value, exc_trace
+
+                raise GraphError('Could not complete %s: %s' % (node, error[0]))
+
+            return False
+
+        return True
+
+    def __run_inline(self, node):
+        try:
+            return True, node.run(), None, None, []
+
+        except Exception, error:
+            # Keep the first exception so it can be re-raised after the
+            # running workers finished
+            if self._exc_info is None:
+                self._exc_info = (node.key, sys.exc_info())
+
+            return False, None, None, (str(error), traceback.format_exc()), []
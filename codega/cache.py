@@ -0,0 +1,554 @@
+'''Persistent caches
+
+A ContentCache is a directory of entries addressed by a key (a hex digest).
+Entries are files, their modification time is updated when they are used so
+the least recently used ones can be evicted when the cache grows over its
+size limit.
+
+The SourceCache stores parsed (and transformed) sources in a ContentCache.
+XML trees are stored serialized as XML, which lxml parses quickly, with the
+location of their nodes (the line numbers and the base URL), any other source
+(e.g. an ALP syntax tree) is pickled.
+
+The OutputCache stores generated outputs, so a target generated from the same
+inputs (e.g. in another checkout) is copied from the cache instead of being
+generated again.
+
+The PostProcessCache stores the post-processed outputs by the hash of the raw
+output and the commands run on it (see codega.postprocess).
+
+A ContentCache can be backed by a shared cache (see codega.remotecache):
+entries missing locally are downloaded from it, stored entries are uploaded.
+Anyone who can reach the shared cache can store entries in it, so the
+downloaded entries are checked: the ones addressed by the hash of their
+content must match it, and pickled sources are never shared (unpickling
+would run code from the shared cache).
+'''
+
+import os
+import json
+import shutil
+import cPickle
+
+from lxml import etree
+
+from codega.manifest import hash_data
+from codega import logger
+
+
+# Default location and size limit of the cache
+DEFAULT_CACHE_DIR = os.path.join('~', '.cache', 'codega')
+DEFAULT_CACHE_SIZE = 1 << 30
+
+# Subdirectories of the cache directory holding the different caches
+SOURCE_CACHE = 'sources'
+OUTPUT_CACHE = 'outputs'
+POSTPROCESS_CACHE = 'postprocess'
+CACHE_NAMES = (SOURCE_CACHE, OUTPUT_CACHE, POSTPROCESS_CACHE)
+
+# Version of the source serialization format
+SOURCE_FORMAT = 2
+
+# Version of the output cache entries (2: relative dependency paths)
+OUTPUT_FORMAT = 2
+
+# File in a cache directory holding the persistent counters (e.g. hits)
+COUNTERS_FILE = 'counters.json'
+
+
+class CacheError(Exception):
+    '''A cache entry could not be stored or loaded'''
+
+
+def get_cache_dir(path=None):
+    '''Get the cache directory. The CODEGA_CACHE_DIR environment variable
+    overrides the default.'''
+
+    if path is None:
+        path = os.getenv('CODEGA_CACHE_DIR') or DEFAULT_CACHE_DIR
+
+    return os.path.abspath(os.path.expanduser(path))
+
+
+def get_cache_size():
+    '''Get the size limit of a cache in bytes. The CODEGA_CACHE_SIZE
+    environment variable (in megabytes) overrides the default.'''
+
+    size = os.getenv('CODEGA_CACHE_SIZE')
+    if size:
+        try:
+            return int(size) << 20
+
+        except ValueError:
+            logger.warning('Invalid cache size %r, using the default', size)
+
+    return DEFAULT_CACHE_SIZE
+
+
+class ContentCache(object):
+    '''Directory of cache entries
+
+    Members:
+    _path -- Cache directory
+    _max_size -- The cache is evicted to this size (in bytes)
+    _remote -- The shared cache (a RemoteStore) or None
+    '''
+
+    _path = None
+    _max_size = None
+    _remote = None
+
+    def __init__(self, path, max_size=None, remote=None):
+        self._path = path
+        self._max_size = max_size if max_size is not None else get_cache_size()
+        self._remote = remote
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def remote(self):
+        return self._remote
+
+    def get_entry_path(self, key):
+        return os.path.join(self._path, key[:2], key[2:])
+
+    def contains(self, key):
+        if os.path.isfile(self.get_entry_path(key)):
+            return True
+
+        return self._remote is not None and self._remote.contains(key)
+
+    def get_path(self, key):
+        '''Get the path of an entry (marked as used) or None if it is not in
+        the cache. The key of the entry is the hash of its content (see
+        add).'''
+
+        path = self.get_entry_path(key)
+        try:
+            os.utime(path, None)
+            return path
+
+        except OSError:
+            pass
+
+        if self.fetch(key, check=lambda data: hash_data(data) == key) is None or not os.path.isfile(path):
+            return None
+
+        return path
+
+    def get(self, key, check=None):
+        '''Get the content of an entry or None if it is not in the cache. An
+        entry downloaded from the shared cache is only used if check (if
+        given) returns True for its content.'''
+
+        path = self.get_entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            # Mark the entry as recently used
+            os.utime(path, None)
+            return data
+
+        except (IOError, OSError):
+            return self.fetch(key, check)
+
+    def fetch(self, key, check=None):
+        '''Download an entry from the shared cache and store it locally.
+        Returns its content or None if it is not in the shared cache or
+        check (if given) returns False for its content.'''
+
+        if self._remote is None:
+            return None
+
+        data = self._remote.get(key)
+        if data is None:
+            return None
+
+        if check is not None and not check(data):
+            logger.warning('Cache entry %s downloaded from the shared cache is invalid, ignoring it', key)
+            return None
+
+        logger.debug('Downloaded cache entry %s', key)
+        try:
+            self.__store(key, data)
+
+        except CacheError, e:
+            logger.debug('%s', e)
+
+        return data
+
+    def prefetch(self, keys):
+        '''Check which of the entries missing locally are in the shared
+        cache, in one request'''
+
+        if self._remote is not None:
+            self._remote.prefetch([key for key in keys if not os.path.isfile(self.get_entry_path(key))])
+
+    def put(self, key, data, shared=True):
+        '''Store an entry (in the shared cache too, if shared is set)'''
+
+        self.__store(key, data)
+        if shared and self._remote is not None:
+            self._remote.put(key, data)
+
+    def add(self, key, data):
+        '''Store an entry unless it is already stored (locally and in the
+        shared cache). The key is the hash of the content.'''
+
+        if not os.path.isfile(self.get_entry_path(key)):
+            self.__store(key, data)
+
+        if self._remote is not None and not self._remote.contains(key):
+            self._remote.put(key, data)
+
+    def __store(self, key, data):
+        path = self.get_entry_path(key)
+        dirname = os.path.dirname(path)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+            tmpname = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmpname, 'wb') as out:
+                out.write(data)
+
+            os.rename(tmpname, path)
+
+        except (IOError, OSError), e:
+            raise CacheError('Could not store cache entry %s: %s' % (key, e))
+
+    def remove(self, key):
+        try:
+            os.unlink(self.get_entry_path(key))
+
+        except OSError:
+            pass
+
+    def entries(self):
+        '''List the (path, size, last use) of the entries'''
+
+        if not os.path.isdir(self._path):
+            return
+
+        for dirname in sorted(os.listdir(self._path)):
+            subdir = os.path.join(self._path, dirname)
+            if not os.path.isdir(subdir):
+                continue
+
+            for name in os.listdir(subdir):
+                if name.endswith('.tmp'):
+                    continue
+
+                path = os.path.join(subdir, name)
+                try:
+                    st = os.stat(path)
+
+                except OSError:
+                    continue
+
+                yield path, st.st_size, st.st_mtime
+
+    def get_stats(self):
+        '''Get the number of entries and their total size'''
+
+        count = size = 0
+        for _, entry_size, _ in self.entries():
+            count += 1
+            size += entry_size
+
+        return count, size
+
+    def evict(self, max_size=None):
+        '''Remove the least recently used entries until the cache is not
+        larger than max_size. Returns the number of removed entries.'''
+
+        if max_size is None:
+            max_size = self._max_size
+
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        size = sum(entry[1] for entry in entries)
+
+        removed = 0
+        for path, entry_size, _ in entries:
+            if size <= max_size:
+                break
+
+            try:
+                os.unlink(path)
+
+            except OSError:
+                continue
+
+            size -= entry_size
+            removed += 1
+
+        if removed:
+            logger.info('Evicted %d entries from cache %r', removed, self._path)
+
+        return removed
+
+    def get_counters(self):
+        '''Get the persistent counters of the cache'''
+
+        try:
+            with open(os.path.join(self._path, COUNTERS_FILE)) as f:
+                return json.load(f)
+
+        except (IOError, ValueError):
+            return {}
+
+    def add_counters(self, counters):
+        '''Add values to the persistent counters. Builds running at the same
+        time may lose some of each other's updates.'''
+
+        res = self.get_counters()
+        for name, value in counters.iteritems():
+            res[name] = res.get(name, 0) + value
+
+        path = os.path.join(self._path, COUNTERS_FILE)
+        try:
+            if not os.path.isdir(self._path):
+                os.makedirs(self._path)
+
+            tmpname = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmpname, 'w') as out:
+                json.dump(res, out)
+
+            os.rename(tmpname, path)
+
+        except (IOError, OSError), e:
+            logger.warning('Could not update the counters of cache %r: %s', self._path, e)
+
+    def clear(self):
+        '''Remove every entry'''
+
+        if os.path.isdir(self._path):
+            shutil.rmtree(self._path)
+
+
+def dump_source(data):
+    '''Serialize a parsed source'''
+
+    if isinstance(data, etree._Element):
+        # The serialized tree does not keep the location of the nodes
+        location = {
+            'base': data.getroottree().docinfo.URL,
+            'lines': [node.sourceline for node in data.iter()],
+        }
+        return 'x' + json.dumps(location) + '\n' + etree.tostring(data)
+
+    try:
+        return 'p' + cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+
+    except Exception, e:
+        raise CacheError('Source cannot be serialized: %s' % e)
+
+
+def load_source(data):
+    '''Deserialize a source serialized with dump_source'''
+
+    kind, payload = data[0], data[1:]
+    if kind == 'x':
+        location, payload = payload.split('\n', 1)
+        location = json.loads(location)
+        data = etree.fromstring(payload, base_url=location['base'])
+        for node, line in zip(data.iter(), location['lines']):
+            node.sourceline = line
+
+        return data
+
+    if kind == 'p':
+        return cPickle.loads(payload)
+
+    raise CacheError('Unknown source format %r' % kind)
+
+
+def is_shared_source(entry):
+    '''Check if a source cache entry can come from the shared cache, i.e.
+    the source is not pickled'''
+
+    return entry.partition('\n')[2][:1] == 'x'
+
+
+class SourceCache(object):
+    '''Cache of parsed sources
+
+    Entries contain a header with the files (other than the resource) read
+    while parsing the source, e.g. included files. An entry is only valid if
+    these files did not change.
+
+    Members:
+    _cache -- The underlying ContentCache
+    '''
+
+    _cache = None
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def contains(self, key):
+        return self._cache.contains(key)
+
+    def load(self, key, check_file):
+        '''Load a source. Returns (data, dependencies) or None if the entry
+        is missing or invalid.
+
+        Arguments:
+        key -- Entry key
+        check_file -- Function called with a (filename, digest) dependency,
+                      returns False if the file changed
+        '''
+
+        entry = self._cache.get(key, check=is_shared_source)
+        if entry is None:
+            return None
+
+        try:
+            header, payload = entry.split('\n', 1)
+            header = json.loads(header)
+            if header['format'] != SOURCE_FORMAT:
+                return None
+
+            for filename, digest in header['dependencies']:
+                if not check_file(filename, digest):
+                    logger.debug('Cached source %s is invalid, %r changed', key, filename)
+                    return None
+
+            return load_source(payload), header['dependencies']
+
+        except Exception, e:
+            logger.warning('Could not load cached source %s: %s', key, e)
+            self._cache.remove(key)
+            return None
+
+    def store(self, key, data, dependencies=()):
+        '''Store a source with the (filename, digest) pairs it depends on.
+        Sources that cannot be serialized are not stored.'''
+
+        try:
+            header = json.dumps({'format': SOURCE_FORMAT, 'dependencies': list(dependencies)})
+            entry = header + '\n' + dump_source(data)
+            self._cache.put(key, entry, shared=is_shared_source(entry))
+            return True
+
+        except CacheError, e:
+            logger.debug('Source %s not cached: %s', key, e)
+            return False
+
+
+class OutputCache(object):
+    '''Cache of generated outputs
+
+    The outputs are stored by their content hash. The entry of a target is
+    stored by the hash of the inputs known before generating it; it holds
+    the hash of the output and the (filename, digest) pairs of the files the
+    generator read (relative to the directory of the config if they are in
+    it). An entry is only valid if these files did not change.
+
+    Members:
+    _cache -- The underlying ContentCache
+    '''
+
+    _cache = None
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def load(self, key, check_file):
+        '''Look up the output of a target. Returns (output digest,
+        dependencies) or None if there is no valid entry.
+
+        Arguments:
+        key -- Entry key
+        check_file -- Function called with a (filename, digest) dependency,
+                      returns False if the file changed
+        '''
+
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+
+        try:
+            entry = json.loads(entry)
+            if entry['format'] != OUTPUT_FORMAT or not self._cache.contains(entry['output']):
+                return None
+
+            for filename, digest in entry['dependencies']:
+                if not check_file(filename, digest):
+                    logger.debug('Cached output %s is invalid, %r changed', key, filename)
+                    return None
+
+            return entry['output'], entry['dependencies']
+
+        except Exception, e:
+            logger.warning('Could not load cached output %s: %s', key, e)
+            self._cache.remove(key)
+            return None
+
+    def get_output_path(self, digest):
+        '''Get the file holding an output (None if it was evicted)'''
+
+        return self._cache.get_path(digest)
+
+    def store(self, key, output, digest, dependencies=(), files=()):
+        '''Store the output of a target with the (filename, digest) pairs it
+        depends on. files lists further (digest, content) pairs stored with
+        the output (the files of multiple output targets).'''
+
+        try:
+            for file_digest, data in files:
+                self._cache.add(file_digest, data)
+
+            self._cache.add(digest, output)
+            entry = {'format': OUTPUT_FORMAT, 'output': digest, 'dependencies': list(dependencies)}
+            self._cache.put(key, json.dumps(entry))
+            return True
+
+        except CacheError, e:
+            logger.warning('Output %s not cached: %s', key, e)
+            return False
+
+
+class PostProcessCache(object):
+    '''Cache of post-processed outputs, the entries hold the processed
+    content
+
+    Members:
+    _cache -- The underlying ContentCache
+    '''
+
+    _cache = None
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def load(self, key):
+        '''Get a processed output or None if it is not cached'''
+
+        return self._cache.get(key)
+
+    def store(self, key, data):
+        '''Store a processed output'''
+
+        try:
+            self._cache.put(key, data)
+            return True
+
+        except CacheError, e:
+            logger.warning('Post-processed output %s not cached: %s', key, e)
+            return False
@@ -0,0 +1,111 @@
+'''Build server client
+
+The client sends a cgx command line to the build server (see codega.server)
+and prints the log and the output sent back. It only uses the standard
+library, so starting the client is cheap.
+'''
+
+import os
+import sys
+import json
+import socket
+
+
+# Name of the socket in the cache directory. The default cache directory is
+# the same as in codega.cache, which is not imported to keep the client light.
+SOCKET_NAME = 'server.sock'
+DEFAULT_CACHE_DIR = os.path.join('~', '.cache', 'codega')
+
+
+def get_socket_path(path=None):
+    '''Get the path of the server socket. The CODEGA_SOCKET environment
+    variable overrides the default.'''
+
+    if path is None:
+        path = os.getenv('CODEGA_SOCKET') or \
+               os.path.join(os.getenv('CODEGA_CACHE_DIR') or DEFAULT_CACHE_DIR, SOCKET_NAME)
+
+    return os.path.abspath(os.path.expanduser(path))
+
+
+class Connection(object):
+    '''A socket sending and receiving JSON messages
+
+    Members:
+    _socket -- The socket
+    _reader -- File object used for reading lines
+    '''
+
+    _socket = None
+    _reader = None
+
+    def __init__(self, sock):
+        self._socket = sock
+        self._reader = sock.makefile('rb')
+
+    def send(self, **message):
+        self._socket.sendall(json.dumps(message) + '\n')
+
+    def receive(self):
+        '''Receive a message, None if the connection was closed'''
+
+        line = self._reader.readline()
+        if not line:
+            return None
+
+        return json.loads(line)
+
+    def close(self):
+        self._reader.close()
+        self._socket.close()
+
+
+def run_client(argv, path=None):
+    '''Send a command line to the build server and print its log and
+    output. Returns the result of the command or None if the server is not
+    running.
+
+    Arguments:
+    argv -- The command line (the log level options are handled by the server)
+    path -- Socket path
+    '''
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(get_socket_path(path))
+
+    except socket.error:
+        sock.close()
+        return None
+
+    connection = Connection(sock)
+    try:
+        connection.send(argv=list(argv), cwd=os.getcwd(), env=dict(os.environ))
+
+        while True:
+            message = connection.receive()
+            if message is None:
+                print >> sys.stderr, 'The build server closed the connection'
+                return False
+
+            if 'log' in message:
+                print >> sys.stderr, message['log']
+
+            elif 'output' in message:
+                sys.stdout.write(message['output'])
+
+            elif 'result' in message:
+                return message['result']
+
+    finally:
+        connection.close()
+
+
+def parse_client_option(argv):
+    '''Check for the --client[=SOCKET] option at the start of the cgx
+    arguments. Returns (requested, socket path, remaining arguments).'''
+
+    if argv and (argv[0] == '--client' or argv[0].startswith('--client=')):
+        return True, argv[0].partition('=')[2] or None, argv[1:]
+
+    return False, None, argv
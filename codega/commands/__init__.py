@@ -3,6 +3,11 @@ from pack import CommandPack
 from make import CommandMake
 from build import CommandBuild
 from clean import CommandClean
+from cache import CommandCache
+from watch import CommandWatch
+from serve import CommandServe
+from merge import CommandMergeShards
+from cacheserver import CommandCacheServer
 
 from codega.ordereddict import OrderedDict
 
@@ -12,8 +17,13 @@ class CommandMain(CommandContainer):
         commands = OrderedDict()
         commands['help'] = CommandHelp(self, 'Display list of commands with their meaning')
         commands['make'] = CommandMake()
+        commands['watch'] = CommandWatch()
         commands['clean'] = CommandClean()
         commands['build'] = CommandBuild()
         commands['pack'] = CommandPack()
+        commands['cache'] = CommandCache()
+        commands['serve'] = CommandServe()
+        commands['merge-shards'] = CommandMergeShards()
+        commands['cache-server'] = CommandCacheServer()
 
         super(CommandMain, self).__init__(name, commands, helpstring=helpstring)
@@ -57,4 +57,4 @@ class CommandBuild(OptparsedCommand):
             with open(self.opts.config, 'w') as out:
                 out.write(conf_xml)
 
-        return BuildRunner(config).run_task('build', force=True)
+        return BuildRunner(config, state_dir=None).run_task('build', force=True)
@@ -0,0 +1,77 @@
+import os
+import optparse
+
+from codega.cache import ContentCache, get_cache_dir, CACHE_NAMES
+from codega.ordereddict import OrderedDict
+from codega import logger
+
+from base import OptparsedCommand, CommandContainer, CommandHelp
+
+
+def format_size(size):
+    '''Format a size in bytes for humans'''
+
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return '%d %s' % (size, unit)
+
+        size /= 1024.0
+
+    return '%.1f GB' % size
+
+
+class CacheCommandBase(OptparsedCommand):
+    '''Base of the cache commands, handles the cache directory option'''
+
+    def __init__(self, name, helpstring):
+        options = [
+            optparse.make_option('-d', '--cache-dir', default=None,
+                                 help='Cache directory (default: $CODEGA_CACHE_DIR or ~/.cache/codega)'),
+        ]
+
+        super(CacheCommandBase, self).__init__(name, options, helpstring=helpstring)
+
+    def get_caches(self):
+        '''List the (name, cache) pairs'''
+
+        path = get_cache_dir(self.opts.cache_dir)
+        return [(name, ContentCache(os.path.join(path, name))) for name in CACHE_NAMES]
+
+
+class CommandCacheStats(CacheCommandBase):
+    def __init__(self):
+        super(CommandCacheStats, self).__init__('stats', 'Show the number of entries and the size of the caches')
+
+    def execute(self):
+        print 'Cache directory: %s' % get_cache_dir(self.opts.cache_dir)
+        for name, cache in self.get_caches():
+            count, size = cache.get_stats()
+            print '  %s: %d entries, %s' % (name, count, format_size(size))
+
+            counters = cache.get_counters()
+            if counters:
+                print '    %s' % ', '.join('%s: %d' % item for item in sorted(counters.iteritems()))
+
+        return True
+
+
+class CommandCacheClear(CacheCommandBase):
+    def __init__(self):
+        super(CommandCacheClear, self).__init__('clear', 'Remove every cache entry')
+
+    def execute(self):
+        for name, cache in self.get_caches():
+            logger.info('Clearing cache %r', cache.path)
+            cache.clear()
+
+        return True
+
+
+class CommandCache(CommandContainer):
+    def __init__(self):
+        commands = OrderedDict()
+        commands['help'] = CommandHelp(self, 'Display list of cache commands')
+        commands['stats'] = CommandCacheStats()
+        commands['clear'] = CommandCacheClear()
+
+        super(CommandCache, self).__init__('cache', commands, helpstring='Inspect or clear the persistent caches')
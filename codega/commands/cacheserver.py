@@ -0,0 +1,44 @@
+import os
+import optparse
+
+from codega.remotecache import CacheServer, DEFAULT_PORT
+from codega.cache import get_cache_dir
+from codega import logger
+
+from base import OptparsedCommand
+
+
+class CommandCacheServer(OptparsedCommand):
+    _arg = None
+
+    def __init__(self):
+        options = [
+            optparse.make_option('-d', '--directory', default=None,
+                                 help='Directory of the cache entries (default: the server directory of the cache directory)'),
+            optparse.make_option('--host', default='127.0.0.1',
+                                 help='Address to listen on (default: %default)'),
+            optparse.make_option('-p', '--port', default=DEFAULT_PORT, type='int',
+                                 help='Port to listen on (default: %default)'),
+            optparse.make_option('--max-size', default=None, type='int', metavar='MB',
+                                 help='Size limit of each cache in MB (default: $CODEGA_CACHE_SIZE or 1024)'),
+        ]
+
+        super(CommandCacheServer, self).__init__('cache-server', options,
+                                                 helpstring='Run a cache server shared by trusted builds (see --remote-cache)')
+
+    def execute(self):
+        path = self.opts.directory or os.path.join(get_cache_dir(), 'server')
+        max_size = self.opts.max_size << 20 if self.opts.max_size is not None else None
+
+        server = CacheServer((self.opts.host, self.opts.port), os.path.abspath(path), max_size=max_size)
+        logger.info('Serving cache %r on http://%s:%d/', path, self.opts.host, server.server_address[1])
+        try:
+            server.serve_forever()
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            server.server_close()
+
+        return True
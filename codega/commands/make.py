@@ -1,12 +1,24 @@
+import os
+import sys
 import optparse
 
-from codega.builder import BuildRunner
+from codega.builder import BuildRunner, DEFAULT_COPY_THREADS, STATE_DIR
+from codega.discovery import ConfigDiscovery
+from codega.buildgraph import DEFAULT_PREFETCH_MEMORY
+from codega.filecopy import COPY_MODES, DEFAULT_COPY_MODE
+from codega.timing import BuildProfile
+from codega.shard import parse_shard, load_weights, save_report
+from codega.remotecache import DEFAULT_TIMEOUT
+from codega.writer import DEFAULT_WRITE_THREADS, FSYNC_POLICIES, FSYNC_NONE
+from codega.postprocess import DEFAULT_POSTPROCESS_JOBS
+from codega import logger
 
 from base import OptparsedCommand
 
 
 class CommandMake(OptparsedCommand):
     _arg = None
+    _shard = None
 
     def __init__(self):
         options = [
@@ -16,15 +28,182 @@ class CommandMake(OptparsedCommand):
                                  help='Specify targets (default: all)'),
             optparse.make_option('-f', '--force', default=False, action='store_true',
                                  help='Force rebuild'),
+            optparse.make_option('-r', '--recursive', default=False, action='store_true',
+                                 help='Build every codega.xml under the directory given (default: the current one)'),
+            optparse.make_option('--rescan', default=False, action='store_true',
+                                 help='Search the configs again instead of using the ones found before (with -r)'),
+            optparse.make_option('-j', '--jobs', default=None, type='int',
+                                 help='Number of targets built in parallel, 0 means one per CPU (default: 1, one per CPU with -r)'),
+            optparse.make_option('--memory-budget', default=None, type='int', metavar='MB',
+                                 help='Only build targets in parallel while their estimated memory use fits in MB'),
+            optparse.make_option('--prefetch', default=0, type='int', metavar='N',
+                                 help='Parse the sources of the next N build steps in the background (default: %default)'),
+            optparse.make_option('--prefetch-memory', default=DEFAULT_PREFETCH_MEMORY >> 20, type='int', metavar='MB',
+                                 help='Estimated memory of the sources parsed in advance (default: %default)'),
+            optparse.make_option('--fuse', default=False, action='store_true',
+                                 help='Generate the targets of a source with traversal generators in one pass'),
+            optparse.make_option('--always-write', default=False, action='store_true',
+                                 help='Write outputs and copies even if their content did not change'),
+            optparse.make_option('--write-threads', default=DEFAULT_WRITE_THREADS, type='int', metavar='N',
+                                 help='Number of threads writing the outputs of a serial build, 0 writes them in turn (default: %default)'),
+            optparse.make_option('--fsync', default=FSYNC_NONE, choices=FSYNC_POLICIES,
+                                 help='When the outputs are synced to the disk: %s (default: %%default)' % ', '.join(FSYNC_POLICIES)),
+            optparse.make_option('--postprocess-jobs', default=DEFAULT_POSTPROCESS_JOBS, type='int', metavar='N',
+                                 help='Number of files of one multiple target post-processed in parallel (default: %default)'),
+            optparse.make_option('--cache', default=False, action='store_true',
+                                 help='Use the persistent caches (implied by --cache-dir and --remote-cache)'),
+            optparse.make_option('--cache-dir', default=None,
+                                 help='Cache directory (default: $CODEGA_CACHE_DIR or ~/.cache/codega)'),
+            optparse.make_option('--remote-cache', default=None, metavar='URL',
+                                 help='Trusted cache server backing the persistent caches (default: $CODEGA_REMOTE_CACHE)'),
+            optparse.make_option('--remote-timeout', default=DEFAULT_TIMEOUT, type='float', metavar='SECONDS',
+                                 help='Timeout of the requests to the shared cache server (default: %default)'),
+            optparse.make_option('--copy-mode', default=DEFAULT_COPY_MODE, choices=COPY_MODES,
+                                 help='How files are copied: %s (default: %%default)' % ', '.join(COPY_MODES)),
+            optparse.make_option('--copy-threads', default=DEFAULT_COPY_THREADS, type='int',
+                                 help='Number of files copied concurrently (default: %default)'),
+            optparse.make_option('--profile', default=False, action='store_true',
+                                 help='Print the time spent in each phase of the build (--profile=FILE also saves it as JSON)'),
+            optparse.make_option('--profile-output', default=None, metavar='FILE',
+                                 help='Save the profile as JSON'),
+            optparse.make_option('--profile-top', default=20, type='int', metavar='N',
+                                 help='Number of items in the profile report (default: %default)'),
+            optparse.make_option('--explain-schedule', default=False, action='store_true',
+                                 help='Print the predicted critical path of the build instead of building'),
+            optparse.make_option('--shard', default=None, metavar='I/N',
+                                 help='Only build the I-th of N parts of the targets and copies'),
+            optparse.make_option('--shard-weights', default=None, metavar='FILE',
+                                 help='Build times used for partitioning the shards (written by cgx merge-shards)'),
+            optparse.make_option('--shard-report', default=None, metavar='FILE',
+                                 help='Report of the outputs built by the shard (default: .codega/shard-I-of-N.json)'),
         ]
 
         super(CommandMake, self).__init__('make', options, helpstring='Build codega targets listed in the make file')
 
     def filter(self, name):
-        if self.opts.target:
-            return name in self.opts.target
+        return name in self.opts.target
+
+    @property
+    def use_cache(self):
+        '''The persistent caches are only used if asked for'''
+
+        return self.opts.cache or self.opts.cache_dir is not None or self.opts.remote_cache is not None
+
+    def prepare(self, argv):
+        # --profile=FILE is a shorthand for --profile --profile-output FILE
+        args = []
+        for arg in argv:
+            if arg.startswith('--profile='):
+                args.extend(['--profile', '--profile-output', arg.partition('=')[2]])
+
+            else:
+                args.append(arg)
+
+        if not super(CommandMake, self).prepare(args):
+            return False
+
+        if self.opts.recursive and (self.opts.config or self.opts.shard):
+            logger.critical('The -c and --shard options cannot be used with -r')
+            return False
+
+        if not self.opts.recursive and self.args:
+            logger.critical('Unexpected arguments %s, use -c to specify the config', ' '.join(self.args))
+            return False
+
+        self._shard = None
+        if self.opts.shard is not None:
+            try:
+                self._shard = parse_shard(self.opts.shard)
+
+            except ValueError, error:
+                logger.critical(str(error))
+                return False
 
         return True
 
     def execute(self):
-        return BuildRunner.run_task_file(self.opts.config, 'build', filter=self.filter, force=self.opts.force)
+        profile = None
+        if self.opts.profile or self.opts.profile_output:
+            profile = BuildProfile()
+
+        if self.opts.recursive:
+            return self.execute_recursive(profile)
+
+        # Nothing changed since the last complete build
+        if self._shard is None and profile is None and not self.opts.force and not self.opts.explain_schedule and \
+           BuildRunner.is_stamp_valid(self.opts.config):
+            logger.info('Nothing changed since the last build')
+            return True
+
+        runner = BuildRunner.load_file(self.opts.config)
+        if runner is None:
+            return False
+
+        weights = None
+        if self._shard is not None and self.opts.shard_weights:
+            weights = load_weights(self.opts.shard_weights)
+
+        res = runner.run_task('build', shard=self._shard, shard_weights=weights, **self.get_build_options(profile))
+        if self.opts.explain_schedule:
+            return res
+
+        if res and self._shard is not None:
+            self.save_shard_report(runner)
+
+        self.report_profile(profile)
+        return res
+
+    def execute_recursive(self, profile):
+        '''Build the configs found under the directory given (see codega.discovery)'''
+
+        root = self.args[0] if self.args else '.'
+        if not os.path.isdir(root):
+            logger.critical('Directory %r not found', root)
+            return False
+
+        configs = ConfigDiscovery(root, os.path.join(root, STATE_DIR, 'discovery.json')).find(rescan=self.opts.rescan)
+
+        if not configs:
+            logger.critical('No config found under %r', root)
+            return False
+
+        options = self.get_build_options(profile)
+        if self.opts.jobs is None:
+            options['jobs'] = 0
+
+        res = BuildRunner.run_task_files(configs, 'build', base_path=root, **options)
+        if not self.opts.explain_schedule:
+            self.report_profile(profile)
+
+        return res
+
+    def get_build_options(self, profile):
+        '''Options of the build passed to BuildRunner.run_task'''
+
+        return dict(filter=self.filter if self.opts.target else None, force=self.opts.force,
+                    jobs=self.opts.jobs, write_if_changed=not self.opts.always_write,
+                    memory_budget=self.opts.memory_budget << 20 if self.opts.memory_budget else None,
+                    prefetch=self.opts.prefetch, prefetch_memory=self.opts.prefetch_memory << 20,
+                    write_threads=self.opts.write_threads, fsync=self.opts.fsync, fuse=self.opts.fuse,
+                    postprocess_jobs=self.opts.postprocess_jobs,
+                    source_cache=self.use_cache, output_cache=self.use_cache,
+                    cache_dir=self.opts.cache_dir, remote_cache=self.opts.remote_cache,
+                    remote_timeout=self.opts.remote_timeout,
+                    copy_mode=self.opts.copy_mode, copy_threads=self.opts.copy_threads,
+                    profile=profile, explain_schedule=sys.stdout if self.opts.explain_schedule else None)
+
+    def report_profile(self, profile):
+        if profile is not None:
+            print profile.format_report(self.opts.profile_top)
+            if self.opts.profile_output:
+                profile.save(self.opts.profile_output)
+
+    def save_shard_report(self, runner):
+        index, count = self._shard
+        filename = self.opts.shard_report or runner.get_state_path('shard-%d-of-%d.json' % (index, count))
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        logger.info('Saving the report of shard %d/%d to %r', index, count, filename)
+        save_report(filename, index, count, runner.get_shard_report())
@@ -0,0 +1,51 @@
+import optparse
+
+from codega.builder import BuildRunner
+from codega.shard import load_report, check_reports, get_weights, save_weights
+from codega import logger
+
+from base import OptparsedCommand
+
+
+class CommandMergeShards(OptparsedCommand):
+    def __init__(self):
+        options = [
+            optparse.make_option('-c', '--config', default=None,
+                                 help='Specify config file (default: codega or codega.xml)'),
+            optparse.make_option('-w', '--weights', default=None, metavar='FILE',
+                                 help='Save the build times of the reports for partitioning the next build'),
+        ]
+
+        super(CommandMergeShards, self).__init__('merge-shards', options,
+                                                 helpstring='Check that the shards of a build produced every output exactly once')
+
+    def execute(self):
+        if not self.args:
+            logger.critical('No shard reports given')
+            return False
+
+        runner = BuildRunner.load_file(self.opts.config)
+        if runner is None:
+            return False
+
+        try:
+            reports = [load_report(filename) for filename in self.args]
+
+        except (IOError, ValueError), error:
+            logger.critical('Could not load shard report: %s', error)
+            return False
+
+        expected = set(runner.get_shard_name(path) for _, path, _ in runner.get_shard_items())
+        problems = check_reports(reports, expected)
+        for problem in problems:
+            logger.error(problem)
+
+        if self.opts.weights:
+            save_weights(self.opts.weights, get_weights(reports))
+
+        if problems:
+            logger.critical('The shards did not produce the build correctly (%d problem(s))', len(problems))
+            return False
+
+        logger.info('The %d shard(s) produced all %d outputs', len(reports), len(expected))
+        return True
@@ -0,0 +1,23 @@
+import optparse
+
+from codega.server import BuildServer
+from codega.runnercache import DEFAULT_MEMORY_BUDGET
+
+from base import OptparsedCommand
+
+
+class CommandServe(OptparsedCommand):
+    _arg = None
+
+    def __init__(self):
+        options = [
+            optparse.make_option('-s', '--socket', default=None,
+                                 help='Socket path (default: $CODEGA_SOCKET or ~/.cache/codega/server.sock)'),
+            optparse.make_option('--memory-budget', default=DEFAULT_MEMORY_BUDGET >> 20, type='int',
+                                 help='Estimated memory (in MB) the kept sources may use (default: %default)'),
+        ]
+
+        super(CommandServe, self).__init__('serve', options, helpstring='Run a build server, commands can be sent to it with cgx --client')
+
+    def execute(self):
+        return BuildServer(self.opts.socket, memory_budget=self.opts.memory_budget << 20).serve()
@@ -0,0 +1,54 @@
+import optparse
+
+from codega.watch import BuildWatch, create_watcher
+from codega.remotecache import DEFAULT_TIMEOUT
+
+from base import OptparsedCommand
+
+
+class CommandWatch(OptparsedCommand):
+    _arg = None
+
+    def __init__(self):
+        options = [
+            optparse.make_option('-c', '--config', default=None,
+                                 help='Specify config file (default: codega or codega.xml)'),
+            optparse.make_option('-t', '--target', default=[], action='append',
+                                 help='Specify targets (default: all)'),
+            optparse.make_option('-j', '--jobs', default=1, type='int',
+                                 help='Number of targets built in parallel, 0 means one per CPU (default: %default)'),
+            optparse.make_option('--cache', default=False, action='store_true',
+                                 help='Use the persistent caches (implied by --cache-dir and --remote-cache)'),
+            optparse.make_option('--cache-dir', default=None,
+                                 help='Cache directory (default: $CODEGA_CACHE_DIR or ~/.cache/codega)'),
+            optparse.make_option('--remote-cache', default=None, metavar='URL',
+                                 help='Trusted cache server backing the persistent caches (default: $CODEGA_REMOTE_CACHE)'),
+            optparse.make_option('--remote-timeout', default=DEFAULT_TIMEOUT, type='float', metavar='SECONDS',
+                                 help='Timeout of the requests to the shared cache server (default: %default)'),
+            optparse.make_option('--poll', default=False, action='store_true',
+                                 help='Poll the files instead of using inotify'),
+            optparse.make_option('--interval', default=1.0, type='float',
+                                 help='Polling interval in seconds (default: %default)'),
+        ]
+
+        super(CommandWatch, self).__init__('watch', options, helpstring='Rebuild the targets of the make file whenever their inputs change')
+
+    def filter(self, name):
+        if self.opts.target:
+            return name in self.opts.target
+
+        return True
+
+    @property
+    def use_cache(self):
+        '''The persistent caches are only used if asked for'''
+
+        return self.opts.cache or self.opts.cache_dir is not None or self.opts.remote_cache is not None
+
+    def execute(self):
+        watcher = create_watcher(polling=self.opts.poll, interval=self.opts.interval)
+        watch = BuildWatch(self.opts.config, watcher, filter=self.filter, jobs=self.opts.jobs,
+                           source_cache=self.use_cache, output_cache=self.use_cache,
+                           cache_dir=self.opts.cache_dir, remote_cache=self.opts.remote_cache,
+                           remote_timeout=self.opts.remote_timeout)
+        return watch.run()
@@ -1,3 +1,3 @@
 from codega.version import Version
 
-latest_version = Version(1, 5)
+latest_version = Version(1, 7)
@@ -64,6 +64,12 @@ class SaveVisitor(ClassVisitor):
         res.append(build_element('generator', text=self.visit(node.generator)))
         res.append(build_element('target', text=node.filename))
 
+        if node.kind != structures.TARGET_SINGLE:
+            res.append(build_element('kind', text=node.kind))
+
+        for step in node.postprocess:
+            res.append(build_element('postprocess', attributes={'check': 'true'} if step.check else {}, text=step.command))
+
         if not node.settings.empty:
             res.append(self.visit(node.settings))
 
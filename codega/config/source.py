@@ -71,9 +71,13 @@ class ParseVisitor(XmlVisitor):
         source = self.get_text(node, 'source')
         generator = self.get_text(node, 'generator')
         filename = self.get_text(node, 'target')
+        kind = self.get_text(node, 'kind')
         settings = self.process_settings(node.find('settings'))
 
-        self._builder.add_target(source, filename, generator, settings=settings)
+        self._builder.add_target(source, filename, generator, settings=settings, kind=kind)
+        for child in node.findall('postprocess'):
+            check = child.attrib.get('check', 'false').strip() in ('true', '1')
+            self._builder.add_postprocess(filename, child.text.strip(), check=check)
 
     @visitor('copy')
     def visit_copy(self, node):
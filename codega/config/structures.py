@@ -9,6 +9,12 @@ module_validator = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*
 
 classname_validator = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
 
+# Target kinds: a single output file or any number of files generated into
+# the target directory
+TARGET_SINGLE = 'single'
+TARGET_MULTIPLE = 'multiple'
+TARGET_KINDS = (TARGET_SINGLE, TARGET_MULTIPLE)
+
 
 def config_property(name, property_type=basestring, enable_change=True):
     if enable_change:
@@ -245,31 +251,67 @@ class Source(NodeBase):
         self._parser = ModuleReference(self, 'codega.source', 'XmlSource')
 
 
+class PostProcess(NodeBase):
+    '''Post-processing step of a target
+
+    Members:
+    _command -- Shell command run on the output
+    _check -- The command only checks the output (its standard output is not used)
+    '''
+
+    _command = None
+    _check = False
+
+    command = config_property('_command')
+    check = config_property('_check', property_type=bool)
+
+
 class Target(NodeBase):
     '''Config target entry
 
     Members:
     _source -- Target source reference (by name)
-    _filename -- Target file name
+    _filename -- Target file name (the target directory of multiple output targets)
+    _kind -- Target kind (see TARGET_KINDS)
     _generator -- Target generator
+    _postprocess -- Post-processing steps run on the output (list of PostProcess)
     _settings -- Target-specific settings
     '''
 
     _source = None
     _filename = None
+    _kind = TARGET_SINGLE
     _generator = None
+    _postprocess = None
     _settings = None
 
     source = config_property('_source')
     filename = config_property('_filename')
     generator = config_property('_generator', enable_change=False)
+    postprocess = config_property('_postprocess', enable_change=False)
     settings = config_property('_settings', enable_change=False)
 
+    @property
+    def kind(self):
+        return self._kind
+
+    @kind.setter
+    def kind(self, value):
+        if value not in TARGET_KINDS:
+            raise ValueError("Invalid target kind %r" % value)
+
+        self._kind = value
+
+    @property
+    def multiple(self):
+        return self._kind == TARGET_MULTIPLE
+
     def __init__(self, parent):
         super(Target, self).__init__(parent)
 
         self._settings = Settings(self)
         self._generator = ModuleReference(self)
+        self._postprocess = []
 
 
 class Copy(NodeBase):
@@ -454,11 +496,14 @@ class StructureBuilder(object):
 
         return source
 
-    def add_target(self, source, filename, generator, settings=()):
+    def add_target(self, source, filename, generator, settings=(), kind=None):
         # Create target object
         target = Target(self.__config)
         target.source = source
         target.filename = filename
+        if kind is not None:
+            target.kind = kind
+
         target.generator.load_from_string(generator)
         self.__add_setting_list(target.settings, values=settings)
 
@@ -466,6 +511,15 @@ class StructureBuilder(object):
 
         return target
 
+    def add_postprocess(self, target, command, check=False):
+        step = PostProcess(self.__config.targets[target])
+        step.command = command
+        step.check = check
+
+        self.__config.targets[target].postprocess.append(step)
+
+        return step
+
     def add_copy(self, source, target):
         copy = Copy(self.__config)
         copy.source = source
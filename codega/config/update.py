@@ -32,6 +32,10 @@ class UpdateVisitor(ExplicitVisitor):
              be used to transform the source to a different structure.
     * 1.5 -- Module reference format changed. Now instead of ':' the module and class
              separator is '.'
+    * 1.6 -- Added 'kind' tag to targets. Targets of the 'multiple' kind generate any
+             number of files into the target directory.
+    * 1.7 -- Added 'postprocess' tag to targets. The commands are run on the generated
+             output before it is written.
     '''
 
     @visitor(Version(1, 0))
@@ -43,7 +47,7 @@ class UpdateVisitor(ExplicitVisitor):
         xml_root.attrib['version'] = '1.1'
         return self.visit(Version(1, 1), xml_root)
 
-    @visitor(Version(1, 1), Version(1, 2), Version(1, 3), Version(1, 4), latest_version)
+    @visitor(Version(1, 1), Version(1, 2), Version(1, 3), Version(1, 4), Version(1, 5), Version(1, 6), latest_version)
     def version_current(self, version, xml_root):
         '''Formats that don't need further change'''
 
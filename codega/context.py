@@ -1,3 +1,56 @@
+import os
+
+from codega.ordereddict import OrderedDict
+
+
+def check_output_name(name):
+    '''Normalize the name of an output of a multiple output target. Raises
+    ValueError if it is not inside the target directory.'''
+
+    name = os.path.normpath(name)
+    if os.path.isabs(name) or name == os.curdir or name.split(os.sep)[0] == os.pardir:
+        raise ValueError("Output name %r is not inside the target directory" % name)
+
+    return name
+
+
+class OutputSink(object):
+    '''Collects the files generated by a multiple output target. The files
+    are written by the builder when the generator returned.
+
+    Members:
+    _files -- Maps the file names (relative to the target directory) to
+              their content, in the order they were generated
+    '''
+
+    _files = None
+
+    def __init__(self):
+        self._files = OrderedDict()
+
+    def write(self, name, data):
+        '''Add a file to the output'''
+
+        if not isinstance(data, basestring):
+            raise TypeError("The content of %r should be a string" % name)
+
+        name = check_output_name(name)
+        if name in self._files:
+            raise ValueError("Output %r is generated more than once" % name)
+
+        self._files[name] = data
+
+    @property
+    def names(self):
+        return self._files.keys()
+
+    def items(self):
+        return self._files.items()
+
+    def __len__(self):
+        return len(self._files)
+
+
 class Context(object):
     '''Generator context object
 
@@ -5,16 +58,23 @@ class Context(object):
     _config -- The configuration used
     _source -- Source config entry used by generator
     _target -- Target config entry used by generator
+    _locator -- Resource locator of the config (the resources found are
+                recorded as dependencies of the target)
+    _output -- OutputSink of multiple output targets (None otherwise)
     '''
 
     _config = None
     _source = None
     _target = None
+    _locator = None
+    _output = None
 
-    def __init__(self, config, source, target):
+    def __init__(self, config, source, target, locator=None, output=None):
         self._config = config
         self._source = source
         self._target = target
+        self._locator = locator
+        self._output = output
 
     @property
     def config(self):
@@ -28,6 +88,14 @@ class Context(object):
     def target(self):
         return self._target
 
+    @property
+    def locator(self):
+        return self._locator
+
+    @property
+    def output(self):
+        return self._output
+
     @property
     def settings(self):
         return self._target.settings
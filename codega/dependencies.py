@@ -0,0 +1,181 @@
+'''Dependency recording
+
+While a target is generated, the files it reads are recorded: the resources
+found through the locator, the template files loaded and the modules
+imported. The builder stores them with the target and rebuilds the target
+when any of them changes.
+
+Imports are recorded by replacing the __import__ built-in while recording.
+A module only executes its imports when it is loaded the first time, so the
+modules imported while loading a module are remembered and added whenever
+the module is imported later. Modules of codega itself, of the standard
+library and of the installed packages are not recorded.
+'''
+
+import os
+import sys
+import types
+import threading
+import __builtin__
+
+from distutils import sysconfig
+
+
+# The imports done while loading each module (by module name)
+_module_imports = {}
+
+# Recorders of the threads
+_local = threading.local()
+
+# Modules in these directories are not recorded
+SYSTEM_PATHS = tuple(sorted(set(os.path.join(os.path.realpath(path), '') for path in (
+    sysconfig.get_python_lib(standard_lib=True),
+    sysconfig.get_python_lib(plat_specific=True, standard_lib=True),
+    sysconfig.get_python_lib(),
+    sysconfig.get_python_lib(plat_specific=True),
+))))
+
+
+def get_source_file(module):
+    '''Get the source file of an imported module'''
+
+    filename = getattr(module, '__file__', None)
+    if filename is None:
+        return None
+
+    base, ext = os.path.splitext(os.path.abspath(filename))
+    if ext in ('.pyc', '.pyo'):
+        return base + '.py'
+
+    return base + ext
+
+
+def is_codega_module(name):
+    return name == 'codega' or name.startswith('codega.')
+
+
+def is_system_file(filename):
+    '''Check if a file belongs to the standard library or an installed package'''
+
+    return os.path.realpath(filename).startswith(SYSTEM_PATHS)
+
+
+def get_recorder():
+    '''Get the active recorder of the thread (None if nothing is recorded)'''
+
+    return getattr(_local, 'recorder', None)
+
+
+def record_file(filename):
+    '''Record a file read by the generated target, if it is recorded'''
+
+    recorder = get_recorder()
+    if recorder is not None:
+        recorder.add_file(filename)
+
+
+class DependencyRecorder(object):
+    '''Record the files and modules used while generating a target. Used as
+    a context manager.
+
+    Members:
+    _files -- Absolute paths of the read files
+    _modules -- Names of the imported modules
+    _loading -- Stack of the imports done by the modules being loaded
+    _import -- The original __import__
+    '''
+
+    _files = None
+    _modules = None
+    _loading = None
+    _import = None
+
+    def __init__(self):
+        self._files = set()
+        self._modules = set()
+        self._loading = []
+
+    def add_file(self, filename):
+        self._files.add(os.path.abspath(filename))
+
+    def add_module(self, name):
+        '''Record a module and the modules imported while it was loaded'''
+
+        pending = [name]
+        while pending:
+            name = pending.pop()
+            if name not in self._modules:
+                self._modules.add(name)
+                pending.extend(_module_imports.get(name, ()))
+
+    def is_known(self, name):
+        '''Check if the imports of a module are known (it was loaded while recording)'''
+
+        return name in _module_imports
+
+    def get_files(self):
+        '''Get the recorded files and the source files of the recorded
+        modules, except the ones of codega and the system'''
+
+        res = set(self._files)
+        for name in self._modules:
+            if is_codega_module(name):
+                continue
+
+            filename = get_source_file(sys.modules.get(name))
+            if filename is not None and not is_system_file(filename):
+                res.add(filename)
+
+        return sorted(res)
+
+    def __enter__(self):
+        if get_recorder() is not None:
+            raise RuntimeError('Dependencies are already being recorded')
+
+        _local.recorder = self
+        self._import = __builtin__.__import__
+        __builtin__.__import__ = self.__import
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        __builtin__.__import__ = self._import
+        _local.recorder = None
+
+    def __import(self, name, globals=None, locals=None, fromlist=None, level=-1):
+        if get_recorder() is not self:
+            return self._import(name, globals, locals, fromlist, level)
+
+        count = len(sys.modules)
+        self._loading.append(set())
+        try:
+            module = self._import(name, globals, locals, fromlist, level)
+
+        finally:
+            imported = self._loading.pop()
+
+        names = []
+        target = module
+        if not fromlist:
+            for part in name.split('.')[1:]:
+                target = getattr(target, part, None)
+
+        if isinstance(target, types.ModuleType):
+            names.append(target.__name__)
+
+        for item in fromlist or ():
+            value = getattr(module, item, None)
+            if isinstance(value, types.ModuleType):
+                names.append(value.__name__)
+
+        # The imports of a module are only done when it is loaded
+        if len(sys.modules) != count:
+            for imported_name in names:
+                _module_imports.setdefault(imported_name, set()).update(imported - set(names))
+
+        for imported_name in names:
+            self.add_module(imported_name)
+
+        if self._loading:
+            self._loading[-1].update(names)
+
+        return module
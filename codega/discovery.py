@@ -0,0 +1,134 @@
+'''Config discovery
+
+cgx make -r builds every config found under a directory. Walking a large tree
+takes a while, so the configs found are cached in the state directory of the
+root, along with the modification time of every directory walked. Entries are
+only added to or removed from a directory by changing its modification time
+(a new subdirectory changes the one of its parent), so the cached list is
+valid while none of the directories changed.
+
+Hidden directories (e.g. the state directories or .git) are not walked.
+'''
+
+import os
+import json
+
+from codega import logger
+
+
+DISCOVERY_VERSION = 1
+
+# Name of the config files found
+CONFIG_NAME = 'codega.xml'
+
+
+def get_mtime(path):
+    '''Get the modification time of a path (None if it does not exist)'''
+
+    try:
+        return os.stat(path).st_mtime
+
+    except OSError:
+        return None
+
+
+def find_configs(root, name=CONFIG_NAME):
+    '''Walk a directory tree. Returns the paths of the config files found
+    and the modification times of the directories walked, both relative to
+    the root.'''
+
+    configs = []
+    dirs = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        relpath = os.path.relpath(dirpath, root)
+        dirs[relpath] = get_mtime(dirpath)
+
+        dirnames[:] = sorted(dirname for dirname in dirnames if not dirname.startswith('.'))
+        if name in filenames:
+            configs.append(os.path.normpath(os.path.join(relpath, name)))
+
+    return sorted(configs), dirs
+
+
+class ConfigDiscovery(object):
+    '''Find the configs under a directory, the list is cached
+
+    Members:
+    _root -- The directory searched
+    _path -- Cache file name (None if the list is not cached)
+    _name -- Name of the config files
+    '''
+
+    _root = None
+    _path = None
+    _name = CONFIG_NAME
+
+    def __init__(self, root, path=None, name=CONFIG_NAME):
+        self._root = root
+        self._path = path
+        self._name = name
+
+    @property
+    def root(self):
+        return self._root
+
+    def find(self, rescan=False):
+        '''Get the absolute paths of the config files under the root. The
+        cached list is not used if rescan is set.'''
+
+        configs = None if rescan else self.load()
+        if configs is None:
+            # The cache is written to a directory that is not walked, the
+            # directory is created first so the root does not change later
+            if self._path is not None and not os.path.isdir(os.path.dirname(self._path)):
+                os.makedirs(os.path.dirname(self._path))
+
+            configs, dirs = find_configs(self._root, self._name)
+            logger.info('Found %d config(s) under %r', len(configs), self._root)
+            self.save(configs, dirs)
+
+        return [os.path.abspath(os.path.join(self._root, path)) for path in configs]
+
+    def load(self):
+        '''Load the cached list, returns None if it is not valid'''
+
+        if self._path is None or not os.path.isfile(self._path):
+            return None
+
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+
+            if data.get('version') != DISCOVERY_VERSION or data.get('name') != self._name:
+                return None
+
+            for relpath, mtime in data['dirs'].iteritems():
+                if get_mtime(os.path.join(self._root, relpath)) != mtime:
+                    logger.debug('Directory %r changed, searching the configs again', relpath)
+                    return None
+
+            logger.debug('Using the %d config(s) found before under %r', len(data['configs']), self._root)
+            return data['configs']
+
+        except (IOError, ValueError, KeyError, TypeError, AttributeError), e:
+            logger.warning('Could not load the configs found before %r: %s', self._path, e)
+            return None
+
+    def save(self, configs, dirs):
+        '''Save the list of configs and the modification times of the directories'''
+
+        if self._path is None:
+            return
+
+        data = {
+            'version': DISCOVERY_VERSION,
+            'name': self._name,
+            'configs': configs,
+            'dirs': dirs,
+        }
+
+        tmpname = '%s.%d.tmp' % (self._path, os.getpid())
+        with open(tmpname, 'w') as out:
+            json.dump(data, out)
+
+        os.rename(tmpname, self._path)
@@ -0,0 +1,153 @@
+'''File copy strategies
+
+Copied files can be written in three ways:
+
+ * copy: the content is read and written by Python
+ * reflink: the file is cloned by the file system (copy-on-write, e.g. on
+   btrfs or XFS) or copied by the kernel with copy_file_range; if neither
+   works, the file is copied
+ * hardlink: the destination is a hard link to the source; if the files are
+   on different file systems, the file is copied. The destination must not
+   be edited, since that changes the source too.
+
+The destination is replaced atomically: the copy is written to a temporary
+file next to it, which is then renamed.
+'''
+
+import os
+import errno
+import shutil
+import thread
+
+
+COPY_MODES = ('copy', 'reflink', 'hardlink')
+DEFAULT_COPY_MODE = 'reflink'
+
+# ioctl request cloning a file (FICLONE on Linux)
+FICLONE = 0x40049409
+
+# Errors meaning the copy method is not supported by the files
+UNSUPPORTED_ERRORS = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY,
+                      errno.EBADF, errno.EPERM, errno.EMLINK)
+
+_copy_file_range = []
+
+# (method, source device, destination device) of the methods that failed
+_unsupported = set()
+
+
+def load_copy_file_range():
+    '''Get the copy_file_range function of the C library or None'''
+
+    if not _copy_file_range:
+        try:
+            import ctypes
+            import ctypes.util
+
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            function = libc.copy_file_range
+            function.restype = ctypes.c_ssize_t
+            function.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                                 ctypes.c_size_t, ctypes.c_uint]
+            _copy_file_range.append(function)
+
+        except (ImportError, OSError, AttributeError):
+            _copy_file_range.append(None)
+
+    return _copy_file_range[0]
+
+
+def clone_file(source, destination):
+    '''Clone a file with the FICLONE ioctl. Raises IOError if the file
+    system does not support it.'''
+
+    import fcntl
+
+    with open(source, 'rb') as src:
+        with open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def copy_range(source, destination):
+    '''Copy a file with copy_file_range. Raises OSError if it is not
+    supported.'''
+
+    import ctypes
+
+    function = load_copy_file_range()
+    if function is None:
+        raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+
+    with open(source, 'rb') as src:
+        with open(destination, 'wb') as dst:
+            while True:
+                res = function(src.fileno(), None, dst.fileno(), None, 1 << 30, 0)
+                if res < 0:
+                    error = ctypes.get_errno()
+                    raise OSError(error, os.strerror(error))
+
+                if res == 0:
+                    break
+
+
+def is_same_file(source, destination):
+    '''Check if two paths are links to the same file'''
+
+    try:
+        return os.path.samefile(source, destination)
+
+    except OSError:
+        return False
+
+
+def copy_file(source, destination, mode=DEFAULT_COPY_MODE):
+    '''Copy a file, the destination is replaced atomically. Returns the
+    method used: hardlink, clone, copy_file_range or copy.'''
+
+    if mode not in COPY_MODES:
+        raise ValueError('Unknown copy mode %r' % mode)
+
+    tmpname = '%s.%d-%d.tmp' % (destination, os.getpid(), thread.get_ident())
+    try:
+        method = _write_copy(source, tmpname, mode)
+        if method != 'hardlink':
+            shutil.copymode(source, tmpname)
+
+        os.rename(tmpname, destination)
+        return method
+
+    finally:
+        if os.path.lexists(tmpname):
+            os.unlink(tmpname)
+
+
+def _write_copy(source, tmpname, mode):
+    methods = []
+    if mode == 'hardlink':
+        methods.append(('hardlink', os.link))
+
+    if mode in ('reflink', 'hardlink'):
+        methods.append(('clone', clone_file))
+        methods.append(('copy_file_range', copy_range))
+
+    # A method that is not supported between two file systems is not
+    # tried again
+    devices = (os.stat(source).st_dev, os.stat(os.path.dirname(os.path.abspath(tmpname))).st_dev)
+    for method, function in methods:
+        if (method,) + devices in _unsupported:
+            continue
+
+        try:
+            function(source, tmpname)
+            return method
+
+        except (IOError, OSError), e:
+            if e.errno not in UNSUPPORTED_ERRORS:
+                raise
+
+            _unsupported.add((method,) + devices)
+            if os.path.lexists(tmpname):
+                os.unlink(tmpname)
+
+    shutil.copyfile(source, tmpname)
+    return 'copy'
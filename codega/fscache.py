@@ -0,0 +1,87 @@
+'''File system information cache
+
+The builder checks the same files (modules, packages, sources) for every
+target. The StatCache memoizes the results of stat calls and directory
+walks for the duration of a build run.
+'''
+
+import os
+import stat
+
+
+def is_ignored_file(name):
+    '''Hidden and compiled files are not considered part of a module'''
+
+    return name.startswith('.') or os.path.splitext(name)[1] in ('.pyc', '.pyo')
+
+
+class StatCache(object):
+    '''Memoized os.stat and directory walk results
+
+    Members:
+    _stats -- Stat results by path (None if the path does not exist)
+    _walks -- File lists by directory
+    '''
+
+    _stats = None
+    _walks = None
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        '''Forget every cached result'''
+
+        self._stats = {}
+        self._walks = {}
+
+    def invalidate(self, path):
+        '''Forget the cached stat result of a path (e.g. after writing it)'''
+
+        self._stats.pop(path, None)
+
+    def stat(self, path):
+        '''Get the stat result of a path or None if it does not exist'''
+
+        if path not in self._stats:
+            try:
+                self._stats[path] = os.stat(path)
+
+            except OSError:
+                self._stats[path] = None
+
+        return self._stats[path]
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def isdir(self, path):
+        st = self.stat(path)
+        return st is not None and stat.S_ISDIR(st.st_mode)
+
+    def isfile(self, path):
+        st = self.stat(path)
+        return st is not None and stat.S_ISREG(st.st_mode)
+
+    def mtime(self, path):
+        '''Get the modification time of a path or 0 if it does not exist'''
+
+        st = self.stat(path)
+        if st is None:
+            return 0
+
+        return st[stat.ST_MTIME]
+
+    def walk_files(self, path):
+        '''List the files under a directory recursively (in a stable order),
+        skipping hidden and compiled files'''
+
+        if path not in self._walks:
+            res = []
+            for root, dirs, files in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if not is_ignored_file(d))
+                res.extend(os.path.join(root, name) for name in sorted(files) if not is_ignored_file(name))
+
+            self._walks[path] = tuple(res)
+
+        return self._walks[path]
@@ -0,0 +1,106 @@
+'''
+Traversal generators are driven by a walk of the source tree instead of walking it
+themselves. The walk calls the handlers registered for the tag of each node when it enters
+and leaves the node (in document order), and the generator writes its output to a buffer.
+
+Several traversal generators of the same source can be driven by one walk (see traverse):
+the tree is walked once and the handlers of the node are looked up once for all the
+generators. The builder generates the targets of a source in a single pass this way (see
+the fuse build option).
+'''
+
+from codega.decorators import mark, collect_marked
+from codega.stringio import StringIO
+
+from base import GeneratorBase
+
+
+def enter(*tags):
+    '''Call the method when the walk enters a node with one of the tags'''
+
+    return mark('enter', tags)
+
+
+def leave(*tags):
+    '''Call the method when the walk leaves a node with one of the tags'''
+
+    return mark('leave', tags)
+
+
+class TraversalType(type):
+    '''Meta-class of the traversal generators, collects the handlers by tag'''
+
+    def __new__(cls, name, bases, mdict):
+        for kind in ('enter', 'leave'):
+            handlers = {}
+            for base in reversed(bases):
+                handlers.update(getattr(base, '__%s_handlers__' % kind, {}))
+
+            for tags, func in collect_marked(mdict, kind):
+                for tag in tags:
+                    handlers[tag] = func
+
+            mdict['__%s_handlers__' % kind] = handlers
+
+        return type.__new__(cls, name, bases, mdict)
+
+
+class TraversalGenerator(GeneratorBase):
+    '''A generator driven by a walk of the source tree. The handlers are called with the
+    node, the generation context and the output buffer of the generator.'''
+
+    __metaclass__ = TraversalType
+
+    def begin(self, source, context, out):
+        '''Called before the walk'''
+
+    def end(self, source, context, out):
+        '''Called after the walk, returns the output'''
+
+        return out.getvalue()
+
+    def generate(self, source, context):
+        return traverse(source, [(self, context)])[0]
+
+
+def traverse(source, generators):
+    '''Drive traversal generators through one walk of the source tree
+
+    Arguments:
+    source -- Root node of the source
+    generators -- List of (generator, context) pairs
+
+    Returns the outputs of the generators in the same order.
+    '''
+
+    buffers = [StringIO() for _ in generators]
+
+    # The handlers of all the generators by tag
+    handlers = {'enter': {}, 'leave': {}}
+    for (generator, context), out in zip(generators, buffers):
+        for kind, table in handlers.iteritems():
+            for tag, func in getattr(generator, '__%s_handlers__' % kind).iteritems():
+                table.setdefault(tag, []).append((func, generator, context, out))
+
+    entering = handlers['enter']
+    leaving = handlers['leave']
+
+    for (generator, context), out in zip(generators, buffers):
+        generator.begin(source, context, out)
+
+    # The nodes are entered before their children and left after them
+    stack = [(source, None)]
+    while stack:
+        node, children = stack.pop()
+        if children is None:
+            for func, generator, context, out in entering.get(node.tag, ()):
+                func(generator, node, context, out)
+
+            stack.append((node, True))
+            stack.extend((child, None) for child in reversed(node))
+
+        else:
+            for func, generator, context, out in leaving.get(node.tag, ()):
+                func(generator, node, context, out)
+
+    return [generator.end(source, context, out) for (generator, context), out in zip(generators, buffers)]
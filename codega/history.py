@@ -0,0 +1,141 @@
+'''Build history
+
+The history of a config records the cost of its builders in the previous
+builds: the wall time of building each target and the peak resident memory
+it needed while it was generated, and the wall time of each stage of the
+sources (parsing, loading from the source cache and transforming). Durations
+are averaged over the recent builds, the memory is the one measured last
+(targets staying below an earlier peak of the process are not measured, see
+codega.timing.PeakMemory).
+
+The history is kept in the state directory. With several jobs the scheduler
+starts the builders on the longest predicted chains first (see
+codega.buildgraph), and the shard reports list the recorded durations, so
+merge-shards saves them as the weights of the next sharded build.
+'''
+
+import os
+import json
+
+from codega import logger
+
+
+HISTORY_VERSION = 1
+
+# Weight of the last build in the recorded durations
+DURATION_WEIGHT = 0.5
+
+# Kinds of the recorded items
+TARGET = 'target'
+SOURCE = 'source'
+
+
+class BuildHistory(object):
+    '''Persistent records of the build costs
+
+    Members:
+    _path -- History file name (None if the history is not persistent)
+    _records -- Maps (kind, name) to {'duration': seconds, 'memory': bytes}
+    _changes -- Records changed since the last pop_changes call
+    _dirty -- The history needs to be saved
+    '''
+
+    _path = None
+    _records = None
+    _changes = None
+    _dirty = False
+
+    def __init__(self, path=None):
+        self._path = path
+        self._records = {}
+        self._changes = {}
+
+    @property
+    def path(self):
+        return self._path
+
+    def load(self):
+        '''Load the history file if it exists'''
+
+        if self._path is None or not os.path.isfile(self._path):
+            return self
+
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+
+            if data.get('version') != HISTORY_VERSION:
+                logger.info('History %r has a different version, ignoring it', self._path)
+                return self
+
+            self._records = dict(((kind, name), record) for kind, name, record in data['records'])
+
+        except (IOError, ValueError, KeyError, TypeError), e:
+            logger.warning('Could not load history %r: %s', self._path, e)
+
+        return self
+
+    def save(self):
+        '''Save the history if it changed'''
+
+        if self._path is None or not self._dirty:
+            return
+
+        dirname = os.path.dirname(self._path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        data = {
+            'version': HISTORY_VERSION,
+            'records': sorted([kind, name, record] for (kind, name), record in self._records.iteritems()),
+        }
+
+        tmpname = '%s.%d.tmp' % (self._path, os.getpid())
+        with open(tmpname, 'w') as out:
+            json.dump(data, out)
+
+        os.rename(tmpname, self._path)
+        self._dirty = False
+
+    def get(self, kind, name):
+        '''Get the record of an item or None'''
+
+        return self._records.get((kind, name))
+
+    def get_duration(self, kind, name):
+        '''Get the recorded duration of an item (None if it is unknown)'''
+
+        return self._records.get((kind, name), {}).get('duration')
+
+    def get_memory(self, kind, name):
+        '''Get the recorded memory of an item (None if it is unknown)'''
+
+        return self._records.get((kind, name), {}).get('memory')
+
+    def record(self, kind, name, duration, memory=None):
+        '''Record the cost of an item in the current build'''
+
+        record = dict(self._records.get((kind, name), {}))
+        if record.get('duration') is not None:
+            duration = DURATION_WEIGHT * duration + (1 - DURATION_WEIGHT) * record['duration']
+
+        record['duration'] = duration
+        if memory is not None:
+            record['memory'] = memory
+
+        self._records[(kind, name)] = record
+        self._changes[(kind, name)] = record
+        self._dirty = True
+
+    def pop_changes(self):
+        '''Return the changes since the last call (used by worker processes)'''
+
+        res, self._changes = self._changes, {}
+        return res
+
+    def merge(self, changes):
+        '''Merge the changes returned by pop_changes of a different process'''
+
+        if changes:
+            self._records.update(changes)
+            self._dirty = True
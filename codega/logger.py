@@ -4,7 +4,7 @@ import traceback
 import sys
 
 from lxml.etree import use_global_python_log, PyErrorLog
-from logging import debug, info, warning, error, critical, log, addLevelName, DEBUG, INFO, WARNING, ERROR, CRITICAL
+from logging import debug, info, warning, error, critical, log, addLevelName, getLogger, Handler, DEBUG, INFO, WARNING, ERROR, CRITICAL
 
 
 TRACE = 9
@@ -12,43 +12,55 @@ addLevelName(TRACE, 'TRACE')
 trace = lambda msg, *args, **kwargs: log(TRACE, msg, *args, **kwargs)
 
 
+LOG_FORMAT = '%(asctime)s %(levelname) -10s %(message)s'
+
+LEVELS = {
+    'trace': TRACE,
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR,
+    'critical': CRITICAL,
+    '5': TRACE,
+    '4': DEBUG,
+    '3': INFO,
+    '2': WARNING,
+    '1': ERROR,
+    '0': CRITICAL,
+}
+
+
+def pop_level(argv):
+    '''Remove the -v (--verbosity) option from an argument list and return
+    its value (None if there is no such option)'''
+
+    for ndx, opt in enumerate(argv):
+        if opt == '-v' or opt == '--verbosity':
+            levelname = argv[ndx + 1]
+            del argv[ndx:ndx + 2]
+            return levelname
+
+    return None
+
+
 def prepare(level=None):
     import logging
 
-    levels = {
-        'trace': TRACE,
-        'debug': DEBUG,
-        'info': INFO,
-        'warning': WARNING,
-        'error': ERROR,
-        'critical': CRITICAL,
-        '5': TRACE,
-        '4': DEBUG,
-        '3': INFO,
-        '2': WARNING,
-        '1': ERROR,
-        '0': CRITICAL,
-    }
-
-    logging.basicConfig(format='%(asctime)s %(levelname) -10s %(message)s')
+    logging.basicConfig(format=LOG_FORMAT)
 
     levelname = None
     if level is None:
-        for ndx, opt in enumerate(sys.argv):
-            if opt == '-v' or opt == '--verbosity':
-                levelname = sys.argv[ndx + 1]
-                del sys.argv[ndx:ndx + 2]
-                break
+        levelname = pop_level(sys.argv)
 
     else:
         levelname = level
 
     if levelname is not None:
         try:
-            loglevel = levels[levelname]
+            loglevel = LEVELS[levelname]
 
         except KeyError:
-            print >> sys.stderr, "Unknown log level %s" % opt
+            print >> sys.stderr, "Unknown log level %s" % levelname
             exit(1)
 
     else:
@@ -81,3 +93,55 @@ def exception(preface=None, level=DEBUG, short_desc=None, long_desc=None, level_
 
     for line in long_desc.split('\n'):
         log(level_trace, "%s%s", line_prefix, line)
+
+
+class RecordBuffer(Handler):
+    '''Log handler keeping the records instead of emitting them.
+
+    Used in worker processes so the log output of a task can be sent back and
+    replayed in the main process as one block.
+
+    Members:
+    records -- Collected log records
+    '''
+
+    records = None
+
+    def __init__(self):
+        Handler.__init__(self)
+
+        self.records = []
+
+    def emit(self, record):
+        # Records are pickled when sent back, so the arguments and the
+        # exception information are resolved here
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+    def pop_records(self):
+        '''Return the collected records and reset the buffer'''
+
+        res, self.records = self.records, []
+        return res
+
+
+def buffer_records():
+    '''Replace the handlers of the root logger with a RecordBuffer and return it'''
+
+    root = getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    handler = RecordBuffer()
+    root.addHandler(handler)
+    return handler
+
+
+def replay(records):
+    '''Emit records collected by a RecordBuffer'''
+
+    root = getLogger()
+    for record in records:
+        root.handle(record)
@@ -1,6 +1,9 @@
 '''Mako template wrappers for codega
 
 Dependencies: mako
+
+The template files loaded while a target is generated are recorded as its
+dependencies (see codega.dependencies).
 '''
 
 from mako.runtime import Context as ExternalMakoContext
@@ -10,6 +13,7 @@ from mako.template import Template as ExternalMakoTemplate
 from codega.stringio import StringIO
 
 from codega.generator.template import TemplateGenerator
+from codega.dependencies import record_file
 from codega.template import TemplateBase, TemplatesetBase
 from codega import logger
 
@@ -50,6 +54,18 @@ class MakoTemplate(TemplateBase):
     render.__doc__ = TemplateBase.render.__doc__
 
 
+class TemplateLookup(ExternalMakoTemplateLookup):
+    '''Mako template lookup recording the loaded template files (including
+    the ones inherited or included by other templates)'''
+
+    def get_template(self, uri):
+        template = super(TemplateLookup, self).get_template(uri)
+        if template.filename is not None:
+            record_file(template.filename)
+
+        return template
+
+
 class MakoTemplateset(TemplatesetBase):
     '''Mako templateset (a wrapper to mako.lookup.TemplateLookup)
 
@@ -62,7 +78,7 @@ class MakoTemplateset(TemplatesetBase):
     def __init__(self, *args, **kwargs):
         super(MakoTemplateset, self).__init__()
 
-        self._lookup = ExternalMakoTemplateLookup(*args, **kwargs)
+        self._lookup = TemplateLookup(*args, **kwargs)
 
     # TemplateCollection interface
     def get_template(self, name):
@@ -98,6 +114,9 @@ class MakoTemplatesetFile(TemplatesetBase):
 
     # TemplateCollection interface
     def get_template(self, name):
+        if self._template.filename is not None:
+            record_file(self._template.filename)
+
         tpl = self._template.get_def(name)
 
         return MakoTemplate(tpl)
@@ -0,0 +1,229 @@
+'''Build manifest
+
+The manifest records the content hashes of the inputs and the output of each
+target, so the builder can decide whether a target is stale by comparing
+hashes instead of modification times. The hashes of the files are cached
+together with their modification time and size, so a file is only read again
+if its stat information changed.
+'''
+
+import os
+import json
+import hashlib
+
+from codega import logger
+from codega.fscache import StatCache
+
+
+# Version 2: the file hashes are recorded with the float modification times
+MANIFEST_VERSION = 2
+
+
+def hash_data(data):
+    '''Get the hex digest of a string'''
+
+    return hashlib.sha1(data).hexdigest()
+
+
+def hash_file(filename):
+    '''Get the hex digest of a file's content'''
+
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(65536)
+            if not block:
+                break
+
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+class BuildManifest(object):
+    '''Persistent store of file and target hashes
+
+    Members:
+    _path -- Manifest file name (None if the manifest is not persistent)
+    _files -- File hash cache, maps absolute file names to (mtime, size, digest)
+    _targets -- Target records, maps target names to dictionaries
+    _changes -- Changes since the last pop_changes call
+    _dirty -- The manifest needs to be saved
+    _signature -- (mtime, size) of the manifest file when it was last loaded or saved
+    _stats -- StatCache used for checking the files
+    '''
+
+    _path = None
+    _stats = None
+    _files = None
+    _targets = None
+    _changes = None
+    _dirty = False
+    _signature = None
+
+    def __init__(self, path=None, stats=None):
+        self._path = path
+        self._stats = stats if stats is not None else StatCache()
+        self._files = {}
+        self._targets = {}
+        self._changes = {'files': {}, 'targets': {}}
+
+    @property
+    def path(self):
+        return self._path
+
+    def load(self):
+        '''Load the manifest file if it exists'''
+
+        if self._path is None or not os.path.isfile(self._path):
+            return self
+
+        self._signature = self.__get_signature()
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+
+            if data.get('version') != MANIFEST_VERSION:
+                logger.info('Manifest %r has a different version, ignoring it', self._path)
+                return self
+
+            self._files = dict((name, tuple(value)) for name, value in data['files'].iteritems())
+            self._targets = data['targets']
+
+        except (IOError, ValueError, KeyError, AttributeError), e:
+            logger.warning('Could not load manifest %r: %s', self._path, e)
+
+        return self
+
+    def save(self):
+        '''Save the manifest if it changed'''
+
+        if self._path is None or not self._dirty:
+            return
+
+        dirname = os.path.dirname(self._path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        data = {
+            'version': MANIFEST_VERSION,
+            'files': self._files,
+            'targets': self._targets,
+        }
+
+        tmpname = '%s.tmp' % self._path
+        with open(tmpname, 'w') as out:
+            json.dump(data, out)
+
+        os.rename(tmpname, self._path)
+        self._dirty = False
+        self._signature = self.__get_signature()
+
+    def refresh(self):
+        '''Load the manifest again if another process changed it since it
+        was loaded (used by runners kept in memory between builds)'''
+
+        if self._path is None or self._dirty or self.__get_signature() == self._signature:
+            return
+
+        logger.debug('Manifest %r changed, loading it again', self._path)
+        self._files = {}
+        self._targets = {}
+        self.load()
+
+    def file_digest(self, filename):
+        '''Get the content hash of a file, or None if it does not exist'''
+
+        filename = os.path.abspath(filename)
+        st = self._stats.stat(filename)
+        if st is None:
+            return None
+
+        key = (st.st_mtime, st.st_size)
+        cached = self._files.get(filename)
+        if cached is not None and tuple(cached[:2]) == key:
+            return cached[2]
+
+        digest = hash_file(filename)
+        self.__set_file(filename, key + (digest,))
+        return digest
+
+    def get_file(self, filename):
+        '''Get the (mtime, size, digest) recorded for a file, or None'''
+
+        cached = self._files.get(os.path.abspath(filename))
+        if cached is None:
+            return None
+
+        return tuple(cached)
+
+    def get_file_signature(self, filename):
+        '''Get the (mtime, size) a file had when its hash was recorded, or
+        None if it is not known'''
+
+        cached = self._files.get(os.path.abspath(filename))
+        if cached is None:
+            return None
+
+        return tuple(cached[:2])
+
+    def update_file(self, filename, digest):
+        '''Record the digest of a file that was just written'''
+
+        filename = os.path.abspath(filename)
+        self._stats.invalidate(filename)
+        st = self._stats.stat(filename)
+        self.__set_file(filename, (st.st_mtime, st.st_size, digest))
+
+    def get_target(self, name):
+        '''Get the record of a target or None'''
+
+        return self._targets.get(name)
+
+    def set_target(self, name, record):
+        '''Set the record of a target'''
+
+        self._targets[name] = record
+        self._changes['targets'][name] = record
+        self._dirty = True
+
+    def remove_target(self, name):
+        '''Remove the record of a target'''
+
+        if name in self._targets:
+            self.set_target(name, None)
+            del self._targets[name]
+
+    def pop_changes(self):
+        '''Return the changes since the last call (used by worker processes)'''
+
+        res, self._changes = self._changes, {'files': {}, 'targets': {}}
+        return res
+
+    def merge(self, changes):
+        '''Merge the changes returned by pop_changes of a different process'''
+
+        for filename, value in changes['files'].iteritems():
+            self.__set_file(filename, value)
+
+        for name, record in changes['targets'].iteritems():
+            if record is None:
+                self._targets.pop(name, None)
+
+            else:
+                self._targets[name] = record
+
+            self._dirty = True
+
+    def __get_signature(self):
+        try:
+            st = os.stat(self._path)
+            return st.st_mtime, st.st_size
+
+        except OSError:
+            return None
+
+    def __set_file(self, filename, value):
+        self._files[filename] = value
+        self._changes['files'][filename] = value
+        self._dirty = True
@@ -0,0 +1,185 @@
+'''Post-processing of generated outputs
+
+The postprocess steps of a target (see the config format) are shell commands
+run on every output of the target before it is written. A filter (e.g. a
+formatter) reads the output on its standard input and writes the processed
+output to its standard output. A check (e.g. a syntax check) reads the output
+too, but only its exit status is used. The commands are run in the directory
+of the config, with the CODEGA_OUTPUT environment variable set to the name of
+the output. If a command fails, nothing is written.
+
+The files in that directory a command references (e.g. a script run by it)
+are tracked like the inputs of the target: changing them rebuilds it. Tools
+outside of the directory are not tracked, the caches must be cleared when
+they change (see cgx cache clear).
+
+The files of a multiple output target are processed concurrently by a pool of
+threads (the commands run in parallel). The processed outputs are cached by
+the hash of the raw output, its name, the commands, their directory and the
+files they reference, so an output that did not change does not run the
+commands again.
+'''
+
+import os
+import shlex
+import subprocess
+
+from multiprocessing.pool import ThreadPool
+
+from codega.manifest import hash_data, hash_file
+from codega import logger
+
+
+DEFAULT_POSTPROCESS_JOBS = 4
+
+
+class PostProcessError(Exception):
+    '''A post-processing command failed'''
+
+
+def get_command_files(command, cwd):
+    '''Get the files in the directory of a command it references (e.g. the
+    script it runs or a --config=FILE argument)'''
+
+    try:
+        words = shlex.split(command)
+
+    except ValueError:
+        return []
+
+    root = os.path.join(os.path.abspath(cwd), '')
+    res = []
+    for word in words:
+        for path in (word, word.partition('=')[2]):
+            path = os.path.abspath(os.path.join(cwd, path))
+            if path.startswith(root) and os.path.isfile(path) and path not in res:
+                res.append(path)
+
+    return res
+
+
+def get_postprocess_key(name, data, steps, cwd=None, scripts=()):
+    '''Get the cache key of a processed output
+
+    Arguments:
+    name -- Name of the output
+    data -- The raw output
+    steps -- (command, check) pairs
+    cwd -- Directory the commands run in
+    scripts -- (filename, digest) of the files the commands reference
+    '''
+
+    parts = ['postprocess', cwd or '', name, hash_data(data)]
+    for command, check in steps:
+        parts.extend(['check' if check else 'filter', command])
+
+    for filename, digest in scripts:
+        parts.extend(['script', filename, digest])
+
+    return hash_data('\n'.join(parts))
+
+
+def run_command(command, data, cwd=None, name=None):
+    '''Run a command on an output, returns its standard output'''
+
+    env = dict(os.environ)
+    if name is not None:
+        env['CODEGA_OUTPUT'] = name
+
+    process = subprocess.Popen(command, shell=True, cwd=cwd, env=env,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, errors = process.communicate(data)
+    if process.returncode != 0:
+        raise PostProcessError('Command %r failed on %r (exit status %d): %s' %
+                               (command, name, process.returncode, errors.strip()))
+
+    return output
+
+
+class PostProcessor(object):
+    '''Run the postprocess steps on outputs
+
+    Members:
+    _cache -- PostProcessCache of the processed outputs (None if they are not cached)
+    _jobs -- Number of outputs processed concurrently by one process_files call
+    _cwd -- Directory the commands are run in
+    '''
+
+    _cache = None
+    _jobs = DEFAULT_POSTPROCESS_JOBS
+    _cwd = None
+
+    def __init__(self, cache=None, jobs=DEFAULT_POSTPROCESS_JOBS, cwd=None):
+        self._cache = cache
+        self._jobs = jobs
+        self._cwd = cwd
+
+    def get_scripts(self, steps):
+        '''Get the (filename, digest) of the files the steps reference'''
+
+        cwd = self._cwd or os.curdir
+        return [(filename, hash_file(filename))
+                for command, _ in steps for filename in get_command_files(command, cwd)]
+
+    def process(self, name, data, steps, scripts=None):
+        '''Run the steps on an output. Returns the processed output and
+        whether it was found in the cache. The referenced files are found
+        if scripts is None.'''
+
+        if scripts is None:
+            scripts = self.get_scripts(steps)
+
+        key = get_postprocess_key(name, data, steps, self._cwd, scripts)
+        if self._cache is not None:
+            cached = self._cache.load(key)
+            if cached is not None:
+                return cached, True
+
+        for command, check in steps:
+            logger.debug('Running %r on %r', command, name)
+            output = run_command(command, data, cwd=self._cwd, name=name)
+            if not check:
+                data = output
+
+        if self._cache is not None:
+            self._cache.store(key, data)
+
+        return data, False
+
+    def process_files(self, files, steps, scripts=None):
+        '''Run the steps on (name, data) pairs concurrently. Returns the
+        processed (name, data) pairs and the number of cache hits.
+
+        Every output is processed even if one fails, the first error is
+        raised at the end.'''
+
+        if scripts is None:
+            scripts = self.get_scripts(steps)
+
+        def run(item):
+            name, data = item
+            try:
+                return self.process(name, data, steps, scripts), None
+
+            except (PostProcessError, OSError), error:
+                return None, error
+
+        threads = min(self._jobs or 1, len(files))
+        if threads > 1:
+            pool = ThreadPool(threads)
+            try:
+                results = pool.map(run, files)
+
+            finally:
+                pool.close()
+                pool.join()
+
+        else:
+            results = map(run, files)
+
+        errors = [error for _, error in results if error is not None]
+        if errors:
+            raise PostProcessError('Post-processing failed on %d output(s), first error: %s' % (len(errors), errors[0]))
+
+        processed = [(name, result[0]) for (name, _), (result, _) in zip(files, results)]
+        return processed, sum(1 for result, _ in results if result[1])
@@ -0,0 +1,395 @@
+'''Shared caches over HTTP
+
+The persistent caches (see codega.cache) can be backed by a cache server
+shared by several machines. The protocol is plain HTTP, entries are addressed
+by the name of the cache and their key:
+
+  GET /<cache>/<key>    -- 200 with the content of the entry or 404
+  HEAD /<cache>/<key>   -- 200 if the entry exists, 404 otherwise
+  PUT /<cache>/<key>    -- store the entry (the body)
+  POST /<cache>/exists  -- the body lists keys (one per line), the response
+                           lists the ones that exist
+
+The client keeps its connections open between the requests. If the server
+cannot be reached or does not answer in time, the shared cache is not used
+for the rest of the build, so the build goes on with the local caches.
+
+Entries are checked as far as possible (content addressed entries must match
+their hash, pickled sources are not downloaded), but the output key entries
+and the post-processed outputs are used as they are: the server and its
+clients must be trusted.
+
+CacheServer is a reference server storing the entries in a directory (cgx
+cache-server).
+'''
+
+import os
+import re
+import socket
+import urlparse
+import httplib
+import threading
+import SocketServer
+import BaseHTTPServer
+
+from codega.cache import ContentCache, CacheError, CACHE_NAMES
+from codega import logger
+
+
+DEFAULT_PORT = 8765
+DEFAULT_TIMEOUT = 5.0
+
+# Idle connections kept by a client
+MAX_CONNECTIONS = 8
+
+# The server evicts its caches after this many stored entries
+EVICT_INTERVAL = 100
+
+KEY_PATTERN = re.compile(r'^[0-9a-f]{4,128}$')
+
+
+class RemoteCacheError(Exception):
+    '''The cache server could not be used'''
+
+
+def get_remote_cache(url=None, timeout=DEFAULT_TIMEOUT):
+    '''Get the client of the cache server (None if no server is used). The
+    CODEGA_REMOTE_CACHE environment variable gives the URL if url is None.'''
+
+    if url is None:
+        url = os.getenv('CODEGA_REMOTE_CACHE')
+
+    if not url:
+        return None
+
+    try:
+        return RemoteCache(url, timeout)
+
+    except ValueError, e:
+        logger.warning('%s, using the local caches only', e)
+        return None
+
+
+class RemoteCache(object):
+    '''Client of a cache server
+
+    Connections are reused (each process has its own pool, since worker
+    processes are forked). After a failure the server is not used again.
+
+    Members:
+    _host -- Host name of the server
+    _port -- Port of the server
+    _prefix -- Path prefix of the URL
+    _timeout -- Timeout of the requests in seconds
+    _pool -- Idle connections
+    _pid -- The process owning the connections of the pool
+    _lock -- Lock protecting the pool
+    _failed -- The server failed, it is not used any more
+    '''
+
+    _host = None
+    _port = None
+    _prefix = None
+    _timeout = None
+    _pool = None
+    _pid = None
+    _lock = None
+    _failed = False
+
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme != 'http' or not parts.hostname:
+            raise ValueError('Invalid cache server URL %r' % url)
+
+        self._host = parts.hostname
+        self._port = parts.port or 80
+        self._prefix = parts.path.rstrip('/')
+        self._timeout = timeout
+        self._pool = []
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        return not self._failed
+
+    def request(self, method, path, body=None):
+        '''Send a request, returns (status, data). Raises RemoteCacheError
+        if the server cannot be used.'''
+
+        if self._failed:
+            raise RemoteCacheError('The cache server is not available')
+
+        headers = {'Content-Length': str(len(body or ''))}
+        for attempt in range(2):
+            connection, reused = self.__get_connection()
+            try:
+                connection.request(method, self._prefix + path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+
+            except (socket.error, httplib.HTTPException), e:
+                connection.close()
+
+                # The server may have closed an idle connection
+                if reused and attempt == 0 and not isinstance(e, socket.timeout):
+                    continue
+
+                self._failed = True
+                logger.warning('Cache server %s:%d failed (%s), using the local caches only',
+                               self._host, self._port, e or e.__class__.__name__)
+                raise RemoteCacheError(str(e))
+
+            if response.will_close:
+                connection.close()
+
+            else:
+                self.__put_connection(connection)
+
+            return response.status, data
+
+    def get(self, name, key):
+        '''Get an entry (None if it is missing)'''
+
+        status, data = self.request('GET', '/%s/%s' % (name, key))
+        return data if status == 200 else None
+
+    def put(self, name, key, data):
+        status, _ = self.request('PUT', '/%s/%s' % (name, key), data)
+        return status in (200, 201, 204)
+
+    def contains(self, name, key):
+        status, _ = self.request('HEAD', '/%s/%s' % (name, key))
+        return status == 200
+
+    def exists(self, name, keys):
+        '''Get the set of the keys that exist (in one request)'''
+
+        status, data = self.request('POST', '/%s/exists' % name, '\n'.join(keys))
+        if status != 200:
+            raise RemoteCacheError('Unexpected status %d' % status)
+
+        return set(data.split())
+
+    def close(self):
+        with self._lock:
+            for connection in self._pool:
+                connection.close()
+
+            self._pool = []
+
+    def __get_connection(self):
+        with self._lock:
+            # Connections inherited from a different process are not used
+            if self._pid != os.getpid():
+                self._pool = []
+                self._pid = os.getpid()
+
+            if self._pool:
+                return self._pool.pop(), True
+
+        return httplib.HTTPConnection(self._host, self._port, timeout=self._timeout), False
+
+    def __put_connection(self, connection):
+        with self._lock:
+            if self._pid == os.getpid() and len(self._pool) < MAX_CONNECTIONS:
+                self._pool.append(connection)
+                return
+
+        connection.close()
+
+
+class RemoteStore(object):
+    '''A cache of a cache server, used by ContentCache as the shared tier.
+    Errors are logged and the cache behaves as if the entry was missing.
+
+    Members:
+    _client -- The RemoteCache
+    _name -- Name of the cache
+    _known -- Keys known to exist
+    _missing -- Keys known to be missing
+    '''
+
+    _client = None
+    _name = None
+    _known = None
+    _missing = None
+
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+        self._known = set()
+        self._missing = set()
+
+    def get(self, key):
+        if key in self._missing or not self._client.available:
+            return None
+
+        try:
+            data = self._client.get(self._name, key)
+
+        except RemoteCacheError:
+            return None
+
+        if data is None:
+            self._missing.add(key)
+
+        return data
+
+    def put(self, key, data):
+        if key in self._known or not self._client.available:
+            return
+
+        try:
+            if self._client.put(self._name, key, data):
+                self._known.add(key)
+                self._missing.discard(key)
+
+        except RemoteCacheError:
+            pass
+
+    def contains(self, key):
+        if key in self._known:
+            return True
+
+        if key in self._missing or not self._client.available:
+            return False
+
+        try:
+            found = self._client.contains(self._name, key)
+
+        except RemoteCacheError:
+            return False
+
+        (self._known if found else self._missing).add(key)
+        return found
+
+    def prefetch(self, keys):
+        '''Check which of the keys exist in one request'''
+
+        keys = sorted(set(keys) - self._known - self._missing)
+        if not keys or not self._client.available:
+            return
+
+        try:
+            found = self._client.exists(self._name, keys)
+
+        except RemoteCacheError:
+            return
+
+        self._known.update(found)
+        self._missing.update(key for key in keys if key not in found)
+
+
+class CacheRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serve the requests of the cache protocol'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        cache, key = self.parse_path()
+        if cache is None:
+            return
+
+        data = cache.get(key)
+        if data is None:
+            self.respond(404)
+
+        else:
+            self.respond(200, data)
+
+    def do_HEAD(self):
+        cache, key = self.parse_path()
+        if cache is None:
+            return
+
+        self.respond(200 if cache.contains(key) else 404, send_body=False)
+
+    def do_PUT(self):
+        cache, key = self.parse_path()
+        if cache is None:
+            return
+
+        try:
+            cache.put(key, self.read_body())
+
+        except CacheError, e:
+            logger.error('Could not store %s: %s', self.path, e)
+            self.respond(500)
+            return
+
+        self.server.entry_stored()
+        self.respond(204)
+
+    def do_POST(self):
+        name, _, action = self.path.strip('/').partition('/')
+        body = self.read_body()
+        if name not in self.server.caches or action != 'exists':
+            self.respond(404)
+            return
+
+        cache = self.server.caches[name]
+        keys = [key for key in body.split() if KEY_PATTERN.match(key) and cache.contains(key)]
+        self.respond(200, '\n'.join(keys))
+
+    def parse_path(self):
+        '''Get the cache and the key of the request, responds with 404 if
+        they are invalid (the cache is None then)'''
+
+        name, _, key = self.path.strip('/').partition('/')
+        if name not in self.server.caches or not KEY_PATTERN.match(key):
+            self.read_body()
+            self.respond(404)
+            return None, None
+
+        return self.server.caches[name], key
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def respond(self, status, data='', send_body=True):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug('%s: %s', self.client_address[0], format % args)
+
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''Cache server storing the entries of each cache in a ContentCache
+
+    Members:
+    caches -- The ContentCaches by name
+    _stored -- Number of entries stored since the last eviction
+    _lock -- Lock protecting _stored
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    caches = None
+    _stored = 0
+    _lock = None
+
+    def __init__(self, address, path, max_size=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, CacheRequestHandler)
+
+        self.caches = dict((name, ContentCache(os.path.join(path, name), max_size=max_size)) for name in CACHE_NAMES)
+        self._lock = threading.Lock()
+
+    def entry_stored(self):
+        '''Evict the caches after every EVICT_INTERVAL stored entries'''
+
+        with self._lock:
+            self._stored += 1
+            if self._stored < EVICT_INTERVAL:
+                return
+
+            self._stored = 0
+
+        for cache in self.caches.itervalues():
+            cache.evict()
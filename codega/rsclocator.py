@@ -8,8 +8,10 @@ A locators purposes are the following:
 '''
 import os.path
 import sys
+import imp
 
 from decorators import abstract
+from dependencies import record_file
 
 
 class ResourceError(Exception):
@@ -38,6 +40,10 @@ class ResourceLocatorBase(object):
     def import_module(self, module):
         '''Abstract method for locating a module'''
 
+    @abstract
+    def find_module(self, module):
+        '''Abstract method for finding the file of a module without importing it'''
+
 
 class FileResourceLocator(ResourceLocatorBase):
     '''Class that helps locating files from the given path.
@@ -72,6 +78,41 @@ class FileResourceLocator(ResourceLocatorBase):
         finally:
             sys.path = oldpath
 
+    def find_module(self, modname):
+        '''Find the file of a module (the directory for packages) without
+        importing it. The same paths are searched as with import_module.
+
+        Arguments:
+        modname -- Module name, Python style
+        '''
+
+        if modname in sys.modules and getattr(sys.modules[modname], '__file__', None):
+            filename = sys.modules[modname].__file__
+            if os.path.splitext(os.path.basename(filename))[0] == '__init__':
+                return os.path.dirname(filename)
+
+            return filename
+
+        parts = modname.split('.')
+        path = [self._path] + sys.path
+        for index, part in enumerate(parts):
+            # Continue from packages that are already imported
+            package = sys.modules.get('.'.join(parts[:index + 1]))
+            if index + 1 < len(parts) and hasattr(package, '__path__'):
+                path = list(package.__path__)
+                continue
+
+            fileobj, filename, (_, _, kind) = imp.find_module(part, path)
+            if fileobj is not None:
+                fileobj.close()
+
+            if kind not in (imp.PY_SOURCE, imp.PY_COMPILED, imp.C_EXTENSION, imp.PKG_DIRECTORY):
+                raise ImportError("No module named %s" % modname)
+
+            path = [filename]
+
+        return filename
+
     def find(self, resource, check_exists=True):
         '''Find a resource in the given path.
 
@@ -81,9 +122,13 @@ class FileResourceLocator(ResourceLocatorBase):
 
         dest = os.path.join(self._path, resource)
 
-        if check_exists and not os.path.exists(dest):
-            raise ResourceError("Resource could not be located", \
-                                resource=resource)
+        if check_exists:
+            if not os.path.exists(dest):
+                raise ResourceError("Resource could not be located", \
+                                    resource=resource)
+
+            # Resources found while generating a target are its dependencies
+            record_file(dest)
 
         return dest
 
@@ -156,6 +201,54 @@ class FallbackLocator(ResourceLocatorBase):
 
         raise ImportError("No module named %s" % module)
 
+    def find_module(self, module):
+        for locator in self._locators:
+            try:
+                return locator.find_module(module)
+
+            except ImportError:
+                pass
+
+        raise ImportError("No module named %s" % module)
+
+
+class RecordingLocator(ResourceLocatorBase):
+    '''Locator recording the resources found through another locator.
+
+    Members:
+    _locator -- The wrapped locator
+    _found -- Paths of the found resources in the order they were found
+    '''
+
+    _locator = None
+    _found = None
+
+    def __init__(self, locator):
+        super(RecordingLocator, self).__init__()
+
+        self._locator = locator
+        self._found = []
+
+    @property
+    def found(self):
+        return list(self._found)
+
+    def find(self, resource, check_exists=True):
+        res = self._locator.find(resource, check_exists=check_exists)
+        if res not in self._found:
+            self._found.append(res)
+
+        return res
+
+    def list_resources(self):
+        return self._locator.list_resources()
+
+    def import_module(self, module):
+        return self._locator.import_module(module)
+
+    def find_module(self, module):
+        return self._locator.find_module(module)
+
 
 class ModuleLocator(FileResourceLocator):
     '''Locate files relative to module path'''
@@ -0,0 +1,100 @@
+'''Cache of build runners
+
+Long running processes (like the build server) keep the runners of the
+configs they built, so the next build of a config does not parse the config
+and the sources again. A runner is identified by the absolute path and the
+content of its config file and the environment variables substituted in it.
+The runners keep their sources after the builds; they are released (least
+recently used first) when their estimated size exceeds the memory budget.
+'''
+
+import os
+import re
+
+from codega.ordereddict import OrderedDict
+from codega.manifest import hash_data
+from codega import logger
+
+
+# Default memory budget of the kept sources and number of kept runners
+DEFAULT_MEMORY_BUDGET = 512 << 20
+DEFAULT_MAX_RUNNERS = 256
+
+ENVIRONMENT_REFERENCE = re.compile(r'\@([a-zA-Z_][a-zA-Z0-9_]*)\@')
+
+
+def get_config_key(config_path):
+    '''Get the cache key of a config file'''
+
+    with open(config_path, 'rb') as f:
+        content = f.read()
+
+    names = sorted(set(ENVIRONMENT_REFERENCE.findall(content)))
+    environment = ['%s=%s' % (name, os.getenv(name)) for name in names]
+    return hash_data('\n'.join([os.path.abspath(config_path), hash_data(content)] + environment))
+
+
+class RunnerCache(object):
+    '''Build runners by config file
+
+    Members:
+    _runners -- Runners by config key, least recently used first
+    _memory_budget -- Maximal estimated memory use of the kept sources
+    _max_runners -- Maximal number of kept runners
+    '''
+
+    _runners = None
+    _memory_budget = None
+    _max_runners = None
+
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, max_runners=DEFAULT_MAX_RUNNERS):
+        self._runners = OrderedDict()
+        self._memory_budget = memory_budget
+        self._max_runners = max_runners
+
+    def __len__(self):
+        return len(self._runners)
+
+    def __iter__(self):
+        return iter(self._runners.values())
+
+    def get_runner(self, runner_class, config_path):
+        '''Get the runner of a config file, the config is loaded if it is
+        not in the cache (or it changed)'''
+
+        key = get_config_key(config_path)
+        runner = self._runners.pop(key, None)
+        if runner is None:
+            config = runner_class.load_config(config_path)
+            runner = runner_class(config, base_path=os.path.dirname(os.path.abspath(config_path)))
+            runner.keep_sources = True
+
+        else:
+            logger.debug('Using the loaded config %r', config_path)
+
+        self._runners[key] = runner
+        while len(self._runners) > self._max_runners:
+            self._runners.pop(self._runners.keys()[0])
+
+        return runner
+
+    def trim(self):
+        '''Release the sources of the least recently used runners while the
+        sources use more memory than the budget'''
+
+        sizes = [(runner, runner.estimate_source_memory()) for runner in self._runners.values()]
+        total = sum(size for _, size in sizes)
+
+        for runner, size in sizes:
+            if total <= self._memory_budget:
+                break
+
+            if size:
+                logger.debug('Releasing the sources of %r', runner.base_path)
+                runner.release_sources()
+                total -= size
+
+        return total
+
+    def clear(self):
+        self._runners = OrderedDict()
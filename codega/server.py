@@ -0,0 +1,301 @@
+'''Build server
+
+The build server is a long running process accepting cgx commands over a
+Unix socket. It imports the heavy modules (lxml, mako, ply) once and keeps
+the loaded configs and sources in a RunnerCache, so a build sent to the
+server does not pay for starting Python and loading everything again.
+
+The protocol is line based, every message is a JSON object. The client sends
+one request:
+
+  {"argv": [...], "cwd": "...", "env": {...}}
+
+The server sends back the log records ({"log": "..."}), the standard output
+of the command ({"output": "..."}) and finally the result ({"result": true}).
+
+Requests are served one after the other: each request runs in the working
+directory and environment of its client. Every request gets its own
+generation Contexts, only the configs, the sources and the imported modules
+are shared.
+'''
+
+import os
+import sys
+import errno
+import signal
+import socket
+import logging
+
+from codega import logger
+from codega.client import Connection, get_socket_path
+from codega.builder import BuildRunner
+from codega.runnercache import RunnerCache, DEFAULT_MEMORY_BUDGET
+from codega.watch import reload_modules
+from codega.dependencies import get_source_file, is_codega_module
+
+
+# Commands that cannot be sent to the server
+LOCAL_COMMANDS = ('serve', 'watch', 'cache-server')
+
+
+def make_module_paths_absolute():
+    '''The requests change the working directory, so the relative module
+    search paths and the relative file names of the imported modules are
+    made absolute'''
+
+    cwd = os.getcwd()
+    sys.path[:] = [os.path.join(cwd, path) for path in sys.path]
+    for module in sys.modules.values():
+        if getattr(module, '__file__', None):
+            module.__file__ = os.path.join(cwd, module.__file__)
+
+        if isinstance(getattr(module, '__path__', None), list):
+            module.__path__[:] = [os.path.join(cwd, path) for path in module.__path__]
+
+
+class ClientLogHandler(logging.Handler):
+    '''Send the log records to the client'''
+
+    def __init__(self, connection):
+        logging.Handler.__init__(self)
+
+        self.__connection = connection
+        self.setFormatter(logging.Formatter(logger.LOG_FORMAT))
+
+    def emit(self, record):
+        try:
+            self.__connection.send(log=self.format(record))
+
+        except socket.error:
+            pass
+
+
+class ClientOutput(object):
+    '''File-like object sending the standard output to the client'''
+
+    def __init__(self, connection):
+        self.__connection = connection
+
+    def write(self, data):
+        self.__connection.send(output=data)
+
+    def flush(self):
+        pass
+
+
+class ModuleTracker(object):
+    '''Notice the imported modules whose file changed
+
+    Members:
+    _mtimes -- Modification times of the module files by module name
+    '''
+
+    _mtimes = None
+
+    def __init__(self):
+        self._mtimes = {}
+
+    def get_changed(self):
+        '''Names of the modules changed since the last call'''
+
+        res = []
+        for name, module in sys.modules.items():
+            filename = get_source_file(module) if module is not None else None
+            if filename is None or is_codega_module(name):
+                continue
+
+            try:
+                mtime = os.stat(filename).st_mtime
+
+            except OSError:
+                continue
+
+            if name in self._mtimes and self._mtimes[name] != mtime:
+                res.append(name)
+
+            self._mtimes[name] = mtime
+
+        return sorted(res)
+
+
+class BuildServer(object):
+    '''Serve cgx commands over a Unix socket
+
+    Members:
+    _path -- Socket path
+    _cache -- The RunnerCache of the loaded configs
+    _modules -- ModuleTracker of the imported modules
+    _socket -- Listening socket
+    '''
+
+    _path = None
+    _cache = None
+    _modules = None
+    _socket = None
+
+    def __init__(self, path=None, memory_budget=DEFAULT_MEMORY_BUDGET):
+        self._path = get_socket_path(path)
+        self._cache = RunnerCache(memory_budget=memory_budget)
+        self._modules = ModuleTracker()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def preload(self):
+        '''Import the modules used by most builds'''
+
+        for name in ('codega.makowrapper', 'codega.alp.script', 'codega.generator.template'):
+            try:
+                __import__(name)
+
+            except ImportError, e:
+                logger.debug('Module %s not preloaded: %s', name, e)
+
+        make_module_paths_absolute()
+        self._modules.get_changed()
+
+    def bind(self):
+        '''Create the listening socket. A socket file left by a server that
+        is not running any more is removed.'''
+
+        dirname = os.path.dirname(self._path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        if os.path.exists(self._path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self._path)
+                probe.close()
+                raise RuntimeError('A server is already listening on %r' % self._path)
+
+            except socket.error:
+                os.unlink(self._path)
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self._path)
+        self._socket.listen(16)
+
+    def serve(self):
+        '''Serve requests until interrupted'''
+
+        def stop(signum, frame):
+            raise KeyboardInterrupt()
+
+        self.preload()
+        self.bind()
+        signal.signal(signal.SIGTERM, stop)
+        logger.info('Build server listening on %r', self._path)
+
+        old_runner_cache = BuildRunner.runner_cache
+        BuildRunner.runner_cache = self._cache
+        try:
+            while True:
+                try:
+                    client, _ = self._socket.accept()
+
+                except socket.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+
+                    raise
+
+                connection = Connection(client)
+                try:
+                    self.handle(connection)
+
+                except Exception, e:
+                    logger.error('Could not serve request: %s', e)
+                    logger.exception()
+
+                finally:
+                    connection.close()
+
+        except KeyboardInterrupt:
+            logger.info('Build server stopped')
+            return True
+
+        finally:
+            BuildRunner.runner_cache = old_runner_cache
+            self._socket.close()
+            if os.path.exists(self._path):
+                os.unlink(self._path)
+
+    def handle(self, connection):
+        '''Serve a request'''
+
+        request = connection.receive()
+        if request is None:
+            return
+
+        argv = [arg.encode('utf-8') for arg in request['argv']]
+        env = dict((name.encode('utf-8'), value.encode('utf-8')) for name, value in request.get('env', {}).iteritems())
+        if argv and argv[0] in LOCAL_COMMANDS:
+            connection.send(log='Command %s cannot be run by the server' % argv[0])
+            connection.send(result=False)
+            return
+
+        changed = self._modules.get_changed()
+        if changed:
+            paths = set()
+            for runner in self._cache:
+                paths.update(os.path.join(runner.base_path, path) for path in runner.config.paths.paths)
+                paths.add(runner.base_path)
+
+            reload_modules(changed, sorted(paths))
+
+        levelname = logger.pop_level(argv)
+        if levelname is not None and levelname not in logger.LEVELS:
+            connection.send(log='Unknown log level %s' % levelname)
+            connection.send(result=False)
+            return
+
+        logger.info('Serving request %s', ' '.join(argv))
+        level = logger.LEVELS[levelname] if levelname is not None else logger.ERROR
+        result = self.run_command(connection, argv, request['cwd'].encode('utf-8'), env, level)
+        connection.send(result=bool(result))
+
+        self._cache.trim()
+
+    def run_command(self, connection, argv, cwd, env, level):
+        '''Run a command in the working directory and environment of the
+        client, with the log and the output sent to the client'''
+
+        from codega.commands import CommandMain
+
+        root = logging.getLogger()
+        old_handlers, old_level = list(root.handlers), root.level
+        old_cwd, old_env, old_stdout = os.getcwd(), dict(os.environ), sys.stdout
+
+        for handler in old_handlers:
+            root.removeHandler(handler)
+
+        root.addHandler(ClientLogHandler(connection))
+        root.setLevel(level)
+
+        try:
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(env)
+            sys.stdout = ClientOutput(connection)
+
+            return CommandMain('cgx', helpstring='codega run-time script').run(argv)
+
+        finally:
+            sys.stdout = old_stdout
+            os.environ.clear()
+            os.environ.update(old_env)
+            os.chdir(old_cwd)
+
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+
+            for handler in old_handlers:
+                root.addHandler(handler)
+
+            root.setLevel(old_level)
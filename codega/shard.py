@@ -0,0 +1,164 @@
+'''Sharded builds
+
+A build can be split into N shards built by independent processes or hosts
+(cgx make --shard I/N). The targets and the copies of the build (of the
+externals too) are identified by their output path relative to the config
+and partitioned separately: sorted by decreasing cost, then by name, each
+one is given to the shard with the lowest total cost. The cost of a target
+is its build time recorded in a weights file; targets without a recorded
+time cost the average, and every copy costs the same. The partition only
+depends on the config and the weights file, so every shard computes the
+same one.
+
+Each shard writes a report of the outputs it built. The reports are merged
+by cgx merge-shards, which checks that every output was produced by exactly
+one shard and saves the build times as the weights of the next build.
+'''
+
+import os
+import json
+
+from codega import logger
+
+
+REPORT_VERSION = 1
+
+
+def parse_shard(text):
+    '''Parse a shard specification (I/N, 1 <= I <= N). Returns (I, N),
+    raises ValueError if the specification is invalid.'''
+
+    index, sep, count = text.partition('/')
+    try:
+        index, count = int(index), int(count)
+
+    except ValueError:
+        raise ValueError('Invalid shard %r, expected I/N' % text)
+
+    if not sep or count < 1 or not 1 <= index <= count:
+        raise ValueError('Invalid shard %r, expected I/N with 1 <= I <= N' % text)
+
+    return index, count
+
+
+def partition(names, count, weights=None):
+    '''Partition names into count lists with similar total weights. Names
+    without a weight get the average weight. The partition only depends on
+    the names and the weights.'''
+
+    weights = weights or {}
+    known = [weights[name] for name in names if name in weights]
+    default = sum(known) / len(known) if known else 1.0
+
+    shards = [[] for _ in range(count)]
+    loads = [0.0] * count
+    for name in sorted(names, key=lambda name: (-weights.get(name, default), name)):
+        index = loads.index(min(loads))
+        shards[index].append(name)
+        loads[index] += weights.get(name, default)
+
+    return [sorted(shard) for shard in shards]
+
+
+def select_shard(targets, copies, index, count, weights=None):
+    '''Get the names of the targets and copies built by shard index of count'''
+
+    res = set(partition(targets, count, weights)[index - 1])
+    res.update(partition(copies, count)[index - 1])
+    return res
+
+
+def load_weights(filename):
+    '''Load the build times of a weights file ({} if it does not exist yet)'''
+
+    if not os.path.exists(filename):
+        logger.info('Weights file %r does not exist, every target costs the same', filename)
+        return {}
+
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_weights(filename, weights):
+    with open(filename, 'w') as out:
+        json.dump(weights, out, indent=2, sort_keys=True)
+
+
+def save_report(filename, index, count, items):
+    '''Save the report of a shard. items maps the names of the outputs to
+    {'digest': content hash or None if the output is missing, 'duration':
+    recorded build time or None}.'''
+
+    data = {
+        'version': REPORT_VERSION,
+        'shard': [index, count],
+        'items': items,
+    }
+
+    with open(filename, 'w') as out:
+        json.dump(data, out, indent=2, sort_keys=True)
+
+
+def load_report(filename):
+    with open(filename) as f:
+        data = json.load(f)
+
+    if data.get('version') != REPORT_VERSION:
+        raise ValueError('Shard report %r has an unknown version' % filename)
+
+    return data
+
+
+def check_reports(reports, expected):
+    '''Check that the reports cover every shard and every expected output
+    was produced exactly once. Returns the list of problems.'''
+
+    problems = []
+    counts = set(report['shard'][1] for report in reports)
+    if len(counts) > 1:
+        problems.append('The reports are from builds with different shard counts: %s' %
+                        ', '.join(map(str, sorted(counts))))
+
+    shards = {}
+    for report in reports:
+        shards.setdefault(report['shard'][0], []).append(report)
+
+    for count in counts:
+        for index in range(1, count + 1):
+            if index not in shards:
+                problems.append('Report of shard %d/%d is missing' % (index, count))
+
+    for index, items in sorted(shards.iteritems()):
+        if len(items) > 1:
+            problems.append('Shard %d has %d reports' % (index, len(items)))
+
+    producers = {}
+    for report in reports:
+        for name, item in report['items'].iteritems():
+            if item['digest'] is not None:
+                producers.setdefault(name, []).append(report['shard'][0])
+
+    for name in sorted(expected):
+        shards = producers.get(name, [])
+        if not shards:
+            problems.append('Output %r was not produced' % name)
+
+        elif len(shards) > 1:
+            problems.append('Output %r was produced by shards %s' % (name, ', '.join(map(str, sorted(shards)))))
+
+    for name in sorted(set(producers) - set(expected)):
+        problems.append('Output %r is not part of the build' % name)
+
+    return problems
+
+
+def get_weights(reports):
+    '''Collect the recorded build times of the reports'''
+
+    res = {}
+    for report in reports:
+        for name, item in report['items'].iteritems():
+            if item.get('duration') is not None:
+                res[name] = item['duration']
+
+    return res
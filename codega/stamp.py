@@ -0,0 +1,100 @@
+'''Build stamps
+
+After a complete, successful build, the stamp of the config lists every file
+and directory the staleness checks of the build depend on: the config files
+(of the externals too), the include paths, the source resources, the parser,
+transform and codega modules, the recorded dependencies and the outputs of
+the targets and the copied files. Each one is recorded with its modification
+time and size (the ones it had when its content was hashed, if it was), along
+with the environment variables substituted in the configs.
+
+If none of them changed, the next build has nothing to do, so it returns
+without loading the config, importing the generators or checking the
+targets one by one. Any change only means the build is run normally.
+'''
+
+import os
+import sys
+import json
+
+from codega.runnercache import ENVIRONMENT_REFERENCE
+from codega import logger
+
+
+STAMP_VERSION = 1
+
+
+def get_signature(path):
+    '''Get the (modification time, size) of a file or directory (None if
+    it does not exist)'''
+
+    try:
+        st = os.stat(path)
+
+    except OSError:
+        return None
+
+    return (st.st_mtime, st.st_size)
+
+
+def get_environment(config_paths):
+    '''Get the values of the environment variables referenced by config files'''
+
+    names = set()
+    for path in config_paths:
+        with open(path) as f:
+            names.update(ENVIRONMENT_REFERENCE.findall(f.read()))
+
+    return dict((name, os.getenv(name)) for name in sorted(names))
+
+
+def save_stamp(filename, config_paths, signatures):
+    '''Save the stamp of a build
+
+    Arguments:
+    filename -- The stamp file
+    config_paths -- Config files of the build (of the externals too)
+    signatures -- Maps the paths checked by the build to their signatures
+    '''
+
+    data = {
+        'version': STAMP_VERSION,
+        'python': sys.version,
+        'environment': get_environment(config_paths),
+        'paths': sorted([path] + (list(signature) if signature is not None else [None, None])
+                        for path, signature in signatures.iteritems()),
+    }
+
+    tmpname = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmpname, 'w') as out:
+        json.dump(data, out)
+
+    os.rename(tmpname, filename)
+
+
+def check_stamp(filename):
+    '''Check if nothing recorded in a stamp changed'''
+
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+
+    except (IOError, ValueError), e:
+        logger.debug('Could not load stamp %r: %s', filename, e)
+        return False
+
+    if data.get('version') != STAMP_VERSION or data.get('python') != sys.version:
+        return False
+
+    for name, value in data['environment'].iteritems():
+        if os.getenv(name) != value:
+            logger.debug('Environment variable %s changed since the last build', name)
+            return False
+
+    for path, mtime, size in data['paths']:
+        signature = get_signature(path)
+        if signature != ((mtime, size) if mtime is not None else None):
+            logger.debug('%r changed since the last build', path)
+            return False
+
+    return True
@@ -0,0 +1,74 @@
+'''Build summary
+
+Counters collected during a build run (e.g. the number of written files).
+Worker processes send the changes of their counters back to the main
+process, where they are merged. Counters may be increased by several threads
+(e.g. by batched copies).
+'''
+
+import threading
+
+from codega.ordereddict import OrderedDict
+from codega import logger
+
+
+class BuildSummary(object):
+    '''Named counters of a build run
+
+    Members:
+    _counters -- Counter values by name
+    _changes -- Counter changes since the last pop_changes call
+    _lock -- Lock protecting the counters
+    '''
+
+    _counters = None
+    _changes = None
+    _lock = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._counters = OrderedDict()
+        self._changes = OrderedDict()
+
+    def add(self, name, value=1):
+        '''Increase a counter'''
+
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+            self._changes[name] = self._changes.get(name, 0) + value
+
+    def __getitem__(self, name):
+        return self._counters.get(name, 0)
+
+    def __iter__(self):
+        return iter(self._counters.items())
+
+    def pop_changes(self):
+        '''Return the changes since the last call (used by worker processes)'''
+
+        res, self._changes = dict(self._changes), OrderedDict()
+        return res
+
+    def merge(self, changes):
+        '''Merge the changes returned by pop_changes of a different process'''
+
+        for name in sorted(changes):
+            self.add(name, changes[name])
+
+    def log(self, title='Build summary'):
+        '''Log the counters'''
+
+        if self._counters:
+            logger.info('%s: %s', title, ', '.join(format_counter(name, value) for name, value in self))
+
+
+def format_counter(name, value):
+    '''Format a counter, times are rounded to milliseconds'''
+
+    if isinstance(value, float):
+        return '%s: %.3f' % (name, value)
+
+    return '%s: %s' % (name, value)
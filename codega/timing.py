@@ -0,0 +1,249 @@
+'''Build profiling
+
+A BuildProfile records the wall and CPU time of the phases of a build: the
+parsing, transformation and loading of the sources, the generation and
+writing of each target and the copies. Externals record their phases in the
+same profile. The records of worker processes are sent back and merged like
+the other build state. The report lists the slowest items and the totals per
+source, generator module and builder type.
+'''
+
+import os
+import sys
+import time
+import json
+import resource
+
+from contextlib import contextmanager
+
+from codega.ordereddict import OrderedDict
+
+
+# Phases in report order
+PHASES = ('load', 'parse', 'transform', 'generate', 'write', 'restore', 'copy')
+
+
+def get_cpu_time():
+    '''CPU time (user and system) of the current process'''
+
+    times = os.times()
+    return times[0] + times[1]
+
+
+def get_peak_memory():
+    '''Peak resident memory of the current process and its finished
+    children (in bytes)'''
+
+    res = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    # Linux reports kilobytes, Mac OS X bytes
+    if sys.platform != 'darwin':
+        res *= 1024
+
+    return res
+
+
+def get_memory_usage():
+    '''Get the (current, peak) resident memory of the process in bytes
+    (None if it is not available, it is read from /proc)'''
+
+    values = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in ('VmRSS', 'VmHWM'):
+                    values[name] = int(value.split()[0]) * 1024
+
+    except (IOError, ValueError):
+        return None
+
+    if len(values) != 2:
+        return None
+
+    return values['VmRSS'], values['VmHWM']
+
+
+class PeakMemory(object):
+    '''Measure the peak resident memory a block needs (in bytes): the peak
+    of the process while the block runs minus the memory resident when it
+    started. The peak of the process is only known if the block raised it,
+    so blocks staying below an earlier peak are not measured (the value is
+    None). Without /proc only the growth of the peak is known.
+
+    Members:
+    value -- The memory measured (None if it is unknown)
+    _start -- The (current, peak) memory at the start of the block
+    '''
+
+    value = None
+    _start = None
+
+    def __enter__(self):
+        self._start = self.__get_usage()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _, peak = self.__get_usage()
+        if peak > self._start[1]:
+            self.value = peak - self._start[0]
+
+    def __get_usage(self):
+        usage = get_memory_usage()
+        if usage is not None:
+            return usage
+
+        peak = get_peak_memory()
+        return peak, peak
+
+
+@contextmanager
+def no_measure():
+    '''Used instead of BuildProfile.measure if the build is not profiled'''
+
+    yield
+
+
+class BuildProfile(object):
+    '''Timing records of a build
+
+    Each record is a dictionary with the phase, the wall and CPU time and the
+    labels of the measured item: the target (or None for source phases),
+    the source, the generator module and the builder type.
+
+    Members:
+    _records -- Timing records
+    '''
+
+    _records = None
+
+    def __init__(self):
+        self._records = []
+
+    def __len__(self):
+        return len(self._records)
+
+    @property
+    def records(self):
+        return list(self._records)
+
+    @contextmanager
+    def measure(self, phase, target=None, source=None, generator=None, builder=None):
+        '''Measure the wall and CPU time of the enclosed block'''
+
+        wall, cpu = time.time(), get_cpu_time()
+        try:
+            yield
+
+        finally:
+            self.add({
+                'phase': phase,
+                'target': target,
+                'source': source,
+                'generator': generator,
+                'builder': builder,
+                'wall': time.time() - wall,
+                'cpu': get_cpu_time() - cpu,
+            })
+
+    def add(self, record):
+        self._records.append(record)
+
+    def get_records(self, start=0):
+        '''Get the records added after the first start records (used by
+        worker processes to send back their records)'''
+
+        return self._records[start:]
+
+    def merge(self, records):
+        '''Merge the records of a different process'''
+
+        self._records.extend(records)
+
+    def get_items(self):
+        '''Sum the times of each target and source by phase. Returns a list
+        of (name, builder, {phase: (wall, cpu)}), the slowest first.'''
+
+        items = OrderedDict()
+        for record in self._records:
+            if record['target'] is not None:
+                key = (record['target'], record['builder'])
+
+            else:
+                key = ('source:%s' % record['source'], 'source')
+
+            phases = items.setdefault(key, {})
+            wall, cpu = phases.get(record['phase'], (0.0, 0.0))
+            phases[record['phase']] = (wall + record['wall'], cpu + record['cpu'])
+
+        res = [(name, builder, phases) for (name, builder), phases in items.iteritems()]
+        res.sort(key=lambda item: -sum(wall for wall, _ in item[2].itervalues()))
+        return res
+
+    def get_totals(self, label):
+        '''Sum the wall and CPU times by a label (source, generator or
+        builder). Returns {value: (wall, cpu)}.'''
+
+        res = {}
+        for record in self._records:
+            value = record[label]
+            if value is None:
+                continue
+
+            wall, cpu = res.get(value, (0.0, 0.0))
+            res[value] = (wall + record['wall'], cpu + record['cpu'])
+
+        return res
+
+    def format_report(self, top=20):
+        '''Format the slowest items and the totals as text tables'''
+
+        items = self.get_items()
+        phases = [phase for phase in PHASES if any(phase in item[2] for item in items)]
+
+        header = ['Item', 'Builder'] + phases + ['wall', 'cpu']
+        rows = []
+        for name, builder, times in items[:top]:
+            row = [name, builder]
+            row.extend('%.3f' % times[phase][0] if phase in times else '-' for phase in phases)
+            row.append('%.3f' % sum(wall for wall, _ in times.itervalues()))
+            row.append('%.3f' % sum(cpu for _, cpu in times.itervalues()))
+            rows.append(row)
+
+        lines = ['Slowest %d of %d items (seconds):' % (len(rows), len(items))]
+        lines.extend(format_table(header, rows))
+
+        for label in ('source', 'generator', 'builder'):
+            totals = sorted(self.get_totals(label).iteritems(), key=lambda item: -item[1][0])
+            lines.append('')
+            lines.append('Totals by %s (seconds):' % label)
+            lines.extend(format_table([label.capitalize(), 'wall', 'cpu'],
+                                      [[value, '%.3f' % wall, '%.3f' % cpu] for value, (wall, cpu) in totals]))
+
+        return '\n'.join(lines)
+
+    def save(self, filename):
+        '''Save the records and the totals as JSON'''
+
+        data = {
+            'records': self._records,
+            'totals': dict((label, self.get_totals(label)) for label in ('source', 'generator', 'builder')),
+        }
+
+        with open(filename, 'w') as out:
+            json.dump(data, out, indent=2)
+
+
+def format_table(header, rows):
+    '''Format a table with aligned columns, the first column is left aligned'''
+
+    widths = [max(len(str(row[index])) for row in [header] + rows) for index in range(len(header))]
+
+    res = []
+    for row in [header] + rows:
+        cells = [str(row[0]).ljust(widths[0])]
+        cells.extend(str(cell).rjust(width) for cell, width in zip(row[1:], widths[1:]))
+        res.append('  '.join(cells).rstrip())
+
+    return res
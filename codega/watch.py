@@ -0,0 +1,488 @@
+'''Watching the inputs of a build
+
+The watchers wait until some of the watched files change. On Linux the
+inotify interface of the kernel is used (through ctypes), elsewhere the files
+are polled. BuildWatch keeps a BuildRunner alive and rebuilds the config when
+its inputs change, so parsed sources, generator modules and templates stay in
+memory between the builds.
+'''
+
+import os
+import sys
+import time
+import errno
+import struct
+import select
+
+from codega import logger
+from codega.decorators import abstract
+from codega.fscache import is_ignored_file
+from codega.dependencies import get_source_file, is_codega_module
+from codega.builder import BuildRunner, get_module_path, get_config
+from codega.rsclocator import ResourceError
+
+
+# inotify event masks (see inotify(7))
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+
+IN_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+                IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# Changes closer to each other than this (in seconds) are reported together
+SETTLE_TIME = 0.1
+
+
+def load_libc():
+    '''Load the C library if it has the inotify functions, otherwise None'''
+
+    try:
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init
+        libc.inotify_add_watch
+        return libc
+
+    except (ImportError, OSError, AttributeError):
+        return None
+
+
+def list_files(path):
+    '''List a file or the files in a directory tree'''
+
+    if not os.path.isdir(path):
+        yield path
+        return
+
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = [name for name in dirnames if not is_ignored_file(name)]
+        for name in filenames:
+            if not is_ignored_file(name):
+                yield os.path.join(dirpath, name)
+
+
+class WatcherBase(object):
+    '''Base class of watchers
+
+    Members:
+    _paths -- Watched files and directory trees (absolute paths)
+    _ignore -- Files whose changes are not reported
+    '''
+
+    _paths = None
+    _ignore = None
+
+    def __init__(self):
+        self._paths = []
+        self._ignore = set()
+
+    @property
+    def paths(self):
+        return list(self._paths)
+
+    def set_paths(self, paths, ignore=()):
+        '''Set the watched files and directories'''
+
+        self._paths = sorted(set(os.path.abspath(path) for path in paths))
+        self._ignore = set(os.path.abspath(path) for path in ignore)
+
+    def is_watched(self, path):
+        if path in self._ignore or is_ignored_file(os.path.basename(path)):
+            return False
+
+        for watched in self._paths:
+            if path == watched or path.startswith(watched + os.sep):
+                return True
+
+        return False
+
+    @abstract
+    def wait(self):
+        '''Wait until some watched files change and return their names'''
+
+    def close(self):
+        pass
+
+
+class PollingWatcher(WatcherBase):
+    '''Detect changes by comparing the stat information of the files
+
+    Members:
+    _interval -- Time between two checks (seconds)
+    _snapshot -- Maps files to their (mtime, size)
+    '''
+
+    _interval = None
+    _snapshot = None
+
+    def __init__(self, interval=1.0):
+        super(PollingWatcher, self).__init__()
+
+        self._interval = interval
+        self._snapshot = {}
+
+    def set_paths(self, paths, ignore=()):
+        super(PollingWatcher, self).set_paths(paths, ignore)
+
+        self._snapshot = self.take_snapshot()
+
+    def take_snapshot(self):
+        res = {}
+        for path in self._paths:
+            for filename in list_files(path):
+                if not self.is_watched(filename):
+                    continue
+
+                try:
+                    st = os.stat(filename)
+
+                except OSError:
+                    continue
+
+                res[filename] = (st.st_mtime, st.st_size)
+
+        return res
+
+    def wait(self):
+        while True:
+            time.sleep(self._interval)
+
+            snapshot = self.take_snapshot()
+            changed = [filename for filename in set(snapshot) | set(self._snapshot)
+                       if snapshot.get(filename) != self._snapshot.get(filename)]
+
+            self._snapshot = snapshot
+            if changed:
+                return sorted(changed)
+
+
+class InotifyWatcher(WatcherBase):
+    '''Watch the files with the inotify interface of the Linux kernel.
+
+    Directories are watched instead of files, so files replaced by editors
+    (written to a temporary file and renamed) are also noticed.
+
+    Members:
+    _libc -- The C library
+    _fd -- inotify file descriptor
+    _watches -- Maps watch descriptors to directories
+    '''
+
+    _libc = None
+    _fd = None
+    _watches = None
+
+    def __init__(self, libc):
+        super(InotifyWatcher, self).__init__()
+
+        self._libc = libc
+        self._watches = {}
+
+    def set_paths(self, paths, ignore=()):
+        super(InotifyWatcher, self).set_paths(paths, ignore)
+
+        self.close()
+        self._fd = self._libc.inotify_init()
+        if self._fd < 0:
+            raise OSError(self.__get_errno(), 'inotify_init failed')
+
+        directories = set()
+        for path in self._paths:
+            if not os.path.isdir(path):
+                directories.add(os.path.dirname(path))
+                continue
+
+            for dirpath, dirnames, _ in os.walk(path):
+                dirnames[:] = [name for name in dirnames if not is_ignored_file(name)]
+                directories.add(dirpath)
+
+        for dirname in sorted(directories):
+            wd = self._libc.inotify_add_watch(self._fd, dirname, IN_WATCH_MASK)
+            if wd < 0:
+                logger.warning('Cannot watch directory %r: %s', dirname, os.strerror(self.__get_errno()))
+                continue
+
+            self._watches[wd] = dirname
+
+    def wait(self):
+        changed = set()
+        timeout = None
+        while True:
+            readable, _, _ = select.select([self._fd], [], [], timeout)
+            if not readable:
+                if changed:
+                    return sorted(changed)
+
+                timeout = None
+                continue
+
+            changed.update(self.__read_events())
+            if changed:
+                # Wait until the changes settle
+                timeout = SETTLE_TIME
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+        self._watches = {}
+
+    def __read_events(self):
+        try:
+            data = os.read(self._fd, 65536)
+
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                return []
+
+            raise
+
+        res = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip('\0')
+            offset += INOTIFY_EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, report every watched file
+                res.extend(filename for path in self._paths for filename in list_files(path))
+                continue
+
+            dirname = self._watches.get(wd)
+            if dirname is None:
+                continue
+
+            path = os.path.join(dirname, name) if name else dirname
+            if self.is_watched(path):
+                res.append(path)
+
+        return res
+
+    def __get_errno(self):
+        import ctypes
+
+        return ctypes.get_errno()
+
+
+def create_watcher(polling=False, interval=1.0):
+    '''Create an inotify watcher if possible, otherwise a polling one'''
+
+    if not polling:
+        libc = load_libc()
+        if libc is not None:
+            return InotifyWatcher(libc)
+
+        logger.info('inotify is not available, polling the files')
+
+    return PollingWatcher(interval)
+
+
+def reload_modules(names, path=()):
+    '''Reload the given imported modules. codega itself is never reloaded.
+
+    Arguments:
+    names -- Module names
+    path -- Extra module search paths (like the ones used by the locator)
+    '''
+
+    oldpath = list(sys.path)
+    try:
+        sys.path[:0] = list(path)
+        for name in names:
+            module = sys.modules.get(name)
+            if module is None or is_codega_module(name):
+                continue
+
+            logger.info('Reloading module %s', name)
+            try:
+                reload(module)
+
+            except Exception, e:
+                logger.error('Could not reload module %s: %s', name, e)
+
+    finally:
+        sys.path = oldpath
+
+
+class BuildWatch(object):
+    '''Rebuild a config whenever its inputs change
+
+    The runner is kept between the builds. The manifest decides which
+    targets have to be rebuilt, so only the targets whose inputs changed are
+    built again. Changed modules are reloaded, together with the modules of
+    the config (parsers, transforms and generators) containing them and the
+    generators of the targets that read a changed file (e.g. a template or
+    a helper module, as recorded in the manifest). Changes of unrelated
+    files rebuild nothing. If the config file changes, it is loaded again.
+
+    Members:
+    _config_file -- The config file given by the user
+    _config_path -- Absolute path of the loaded config file
+    _watcher -- The watcher used
+    _options -- Options of the build task
+    _runner -- The build runner
+    '''
+
+    _config_file = None
+    _config_path = None
+    _watcher = None
+    _options = None
+    _runner = None
+
+    def __init__(self, config_file, watcher, **options):
+        self._config_file = config_file
+        self._watcher = watcher
+        self._options = options
+
+    @property
+    def runner(self):
+        return self._runner
+
+    def load(self):
+        '''Load the config and create the runner'''
+
+        runner = BuildRunner.load_file(self._config_file)
+        if runner is None:
+            return False
+
+        # The sources are kept between the builds
+        runner.keep_sources = True
+        self._config_path = os.path.abspath(get_config(self._config_file))
+        self._runner = runner
+        return True
+
+    def build(self, force=False):
+        options = dict(self._options)
+        options['force'] = force or options.get('force', False)
+        return self._runner.run_task('build', **options)
+
+    def get_modules(self):
+        '''Map the modules used by the config to their files (the directory
+        for packages)'''
+
+        config = self._runner.config
+        references = []
+        for source in config.sources.values():
+            references.append(source.parser)
+            references.extend(source.transform)
+
+        for target in config.targets.values():
+            references.append(target.generator)
+
+        res = {}
+        for reference in references:
+            try:
+                res[reference.module] = os.path.abspath(get_module_path(self._runner.locator, reference.module))
+
+            except ImportError:
+                logger.warning('Module %s cannot be found, it is not watched', reference.module)
+
+        return res
+
+    def get_inputs(self):
+        '''List the source resources and copied files of the config'''
+
+        config = self._runner.config
+        resources = [source.resource for source in config.sources.values()]
+        resources.extend(copy.source for copy in config.copy.values())
+        resources.extend(config.external)
+
+        res = []
+        for resource in resources:
+            try:
+                res.append(os.path.abspath(self._runner.locator.find(resource)))
+
+            except ResourceError:
+                logger.debug('Resource %r is not a file, it is not watched', resource)
+
+        return res
+
+    def get_outputs(self):
+        '''List the generated files, they are not watched'''
+
+        config = self._runner.config
+        names = list(config.targets.keys()) + [copy.target for copy in config.copy.values()]
+        return [os.path.join(self._runner.base_path, config.paths.destination, name) for name in names]
+
+    def get_watched_paths(self):
+        paths = [self._config_path]
+        paths.extend(self.get_inputs())
+        paths.extend(self.get_modules().values())
+        paths.extend(os.path.join(self._runner.base_path, path) for path in self._runner.config.paths.paths)
+        return paths
+
+    def handle_changes(self, changed):
+        '''Reload what changed. Returns (reloaded config, forced rebuild).
+        Only a changed config forces a rebuild, the manifest finds the
+        targets affected by the other changes.'''
+
+        if self._config_path in changed:
+            logger.info('Config file changed, reloading it')
+            return self.load(), True
+
+        modules = self.get_modules()
+
+        # Imported modules defined in the changed files
+        changed_modules = [name for name, module in sorted(sys.modules.items())
+                           if module is not None and get_source_file(module) in changed]
+
+        # Modules of the config containing the changed files
+        affected = [name for name, path in sorted(modules.items())
+                    if any(filename == path or filename.startswith(path + os.sep) for filename in changed)]
+
+        # Generators of the targets that read the changed files
+        for name, target in sorted(self._runner.config.targets.items()):
+            record = self._runner.manifest.get_target(name)
+            if record is not None and any(path in changed for path, _ in record.get('depends', ())):
+                module = target.generator.module
+                if module in modules and module not in affected:
+                    affected.append(module)
+
+        for name in changed_modules:
+            if is_codega_module(name):
+                logger.warning('Module %s changed, restart the watch to use it', name)
+
+        path = [os.path.join(self._runner.base_path, path) for path in self._runner.config.paths.paths]
+        path.append(self._runner.base_path)
+        reload_modules(changed_modules + [name for name in affected if name not in changed_modules], path)
+        return True, False
+
+    def run(self):
+        '''Build, then rebuild after each change until interrupted'''
+
+        if not self.load():
+            return False
+
+        self.build()
+        try:
+            while True:
+                self._watcher.set_paths(self.get_watched_paths(), ignore=self.get_outputs())
+
+                logger.info('Watching %d paths for changes', len(self._watcher.paths))
+                changed = set(self._watcher.wait())
+                logger.info('Changed files: %s', ', '.join(sorted(changed)))
+
+                loaded, force = self.handle_changes(changed)
+                if loaded:
+                    self.build(force=force)
+
+        except KeyboardInterrupt:
+            logger.info('Watch interrupted')
+            return True
+
+        finally:
+            self._watcher.close()
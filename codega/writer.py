@@ -0,0 +1,272 @@
+'''Background output writer
+
+Writing the outputs of the targets can take a large part of a build (e.g.
+on network filesystems). The OutputWriter writes them on a few threads
+while the builder goes on with the next targets. The writes are queued in
+a bounded queue, so the outputs waiting to be written do not use unbounded
+memory; the builder waits when the queue is full.
+
+The threads compare the content of the existing file with the output
+(write-if-changed) and sync the written files according to the fsync
+policy. A file is replaced atomically: the output is written to a
+temporary file next to it, which is then renamed, so an interrupted build
+leaves no partially written output and files linked to the destination
+are not changed. The results are reported by callbacks run in the thread of the
+builder (see poll and join), so the manifest and the summary are only used
+by that thread. Errors are collected and reported when the writer is
+joined at the end of the build.
+
+A writer without threads writes the outputs when they are submitted. The
+writers of parallel builds have no threads, since the worker processes are
+forked.
+'''
+
+import os
+import sys
+import Queue
+import shutil
+import thread
+import threading
+
+from codega import logger
+
+
+DEFAULT_WRITE_THREADS = 2
+DEFAULT_QUEUE_SIZE = 32
+
+# Fsync policies: never sync, sync every file before it is reported as
+# written, or sync the written files when the writer is joined
+FSYNC_NONE = 'none'
+FSYNC_FILE = 'file'
+FSYNC_END = 'end'
+FSYNC_POLICIES = (FSYNC_NONE, FSYNC_FILE, FSYNC_END)
+
+
+def sync_file(filename):
+    '''Flush a file written earlier to the disk'''
+
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+
+    finally:
+        os.close(fd)
+
+
+class WriteJob(object):
+    '''An output to write
+
+    Members:
+    filename -- Destination file name
+    data -- Content of the output
+    compare -- Do not write the file if its content is the same
+    recorded -- (mtime, size, same) if the hash of the file was recorded,
+                same tells if it equals the hash of the output
+    callback -- Called with True if the file was written, False if it did
+                not change (in the thread of the builder)
+    '''
+
+    filename = None
+    data = None
+    compare = False
+    recorded = None
+    callback = None
+
+    def __init__(self, filename, data, compare=False, recorded=None, callback=None):
+        self.filename = filename
+        self.data = data
+        self.compare = compare
+        self.recorded = recorded
+        self.callback = callback
+
+
+class OutputWriter(object):
+    '''Write outputs on a pool of threads
+
+    Members:
+    _threads -- Number of writer threads (0 writes the outputs when they are submitted)
+    _fsync -- Fsync policy (see FSYNC_POLICIES)
+    _queue -- Jobs waiting to be written (bounded)
+    _done -- Completed jobs waiting for their callbacks
+    _workers -- The running threads
+    _pending -- Number of jobs submitted and not reported yet
+    _written -- Files to sync when the writer is joined (FSYNC_END)
+    _errors -- (filename, error) of the failed writes
+    _pid -- Process that created the writer
+    '''
+
+    _threads = 0
+    _fsync = FSYNC_NONE
+    _queue = None
+    _done = None
+    _workers = None
+    _pending = 0
+    _written = None
+    _errors = None
+    _pid = None
+
+    def __init__(self, threads=DEFAULT_WRITE_THREADS, queue_size=DEFAULT_QUEUE_SIZE, fsync=FSYNC_NONE):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Invalid fsync policy %r' % fsync)
+
+        self._threads = threads
+        self._fsync = fsync
+        self._queue = Queue.Queue(queue_size)
+        self._done = Queue.Queue()
+        self._workers = []
+        self._written = []
+        self._errors = []
+        self._pid = os.getpid()
+
+    @property
+    def threads(self):
+        return self._threads
+
+    @property
+    def fsync(self):
+        return self._fsync
+
+    @property
+    def errors(self):
+        return list(self._errors)
+
+    def submit(self, filename, data, compare=False, recorded=None, callback=None):
+        '''Write an output. Waits if the queue is full.'''
+
+        job = WriteJob(filename, data, compare=compare, recorded=recorded, callback=callback)
+
+        # The threads are not inherited by forked processes. Errors of the
+        # writes without threads are raised.
+        if self._threads <= 0 or self._pid != os.getpid():
+            result = self.__run(job)
+            if isinstance(result, tuple):
+                raise result[0], result[1], result[2]
+
+            self.__report(job, result)
+            return
+
+        self.poll()
+        if len(self._workers) < self._threads:
+            worker = threading.Thread(target=self.__work, name='codega-writer-%d' % len(self._workers))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+        self._pending += 1
+        self._queue.put(job)
+
+    def poll(self):
+        '''Run the callbacks of the completed writes'''
+
+        while True:
+            try:
+                job, result = self._done.get_nowait()
+
+            except Queue.Empty:
+                return
+
+            self._pending -= 1
+            self.__report(job, result)
+
+    def flush(self):
+        '''Wait until every submitted output is written'''
+
+        while self._pending > 0:
+            job, result = self._done.get()
+            self._pending -= 1
+            self.__report(job, result)
+
+    def join(self):
+        '''Complete the writes and stop the threads. Returns False if a
+        write failed (the errors are logged).'''
+
+        self.flush()
+        for _ in self._workers:
+            self._queue.put(None)
+
+        for worker in self._workers:
+            worker.join()
+
+        self._workers = []
+
+        for filename in self._written:
+            try:
+                sync_file(filename)
+
+            except (IOError, OSError), error:
+                self._errors.append((filename, error))
+
+        self._written = []
+
+        for filename, error in self._errors:
+            logger.critical('Could not write %r: %s', filename, error)
+
+        res = not self._errors
+        self._errors = []
+        return res
+
+    def __work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+
+            self._done.put((job, self.__run(job)))
+
+    def __run(self, job):
+        '''Write a job, returns True if the file was written, False if it
+        did not change, or the exception info of a failure'''
+
+        try:
+            if job.compare and self.__is_unchanged(job):
+                return False
+
+            tmpname = '%s.%d-%d.tmp' % (job.filename, os.getpid(), thread.get_ident())
+            try:
+                with open(tmpname, 'w') as out:
+                    out.write(job.data)
+                    if self._fsync == FSYNC_FILE or (self._fsync == FSYNC_END and self._pid != os.getpid()):
+                        out.flush()
+                        os.fsync(out.fileno())
+
+                if os.path.isfile(job.filename):
+                    shutil.copymode(job.filename, tmpname)
+
+                os.rename(tmpname, job.filename)
+
+            finally:
+                if os.path.lexists(tmpname):
+                    os.unlink(tmpname)
+
+            return True
+
+        except (IOError, OSError):
+            return sys.exc_info()
+
+    def __is_unchanged(self, job):
+        try:
+            st = os.stat(job.filename)
+
+        except OSError:
+            return False
+
+        if st.st_size != len(job.data):
+            return False
+
+        # The recorded hash is valid if the file was not changed since
+        if job.recorded is not None and job.recorded[:2] == (st.st_mtime, st.st_size):
+            return job.recorded[2]
+
+        with open(job.filename) as f:
+            return f.read() == job.data
+
+    def __report(self, job, result):
+        if isinstance(result, tuple):
+            self._errors.append((job.filename, result[1]))
+            return
+
+        if result and self._fsync == FSYNC_END and self._pid == os.getpid():
+            self._written.append(job.filename)
+
+        if job.callback is not None:
+            job.callback(result)
@@ -1,9 +1,24 @@
+from builder import *
+from buildgraph import *
+from cache import *
 from config import *
 from decorators import *
+from discovery import *
 from examples import *
+from filecopy import *
 from generator import *
+from history import *
+from manifest import *
 from ordereddict import *
+from postprocess import *
+from remotecache import *
 from rsclocator import *
+from server import *
+from shard import *
 from source import *
+from stamp import *
+from timing import *
 from version import *
 from visitor import *
+from watch import *
+from writer import *
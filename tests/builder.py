@@ -0,0 +1,785 @@
+from unittest import TestCase
+import os.path
+import json
+import shutil
+import tempfile
+import threading
+from StringIO import StringIO
+
+from codega.config.structures import StructureBuilder
+from codega.builder import BuildRunner
+from codega.cache import ContentCache
+from codega.remotecache import CacheServer
+from codega.history import TARGET, SOURCE
+from codega.timing import BuildProfile
+
+exampledir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples')
+
+xml_content = """<?xml version="1.0" ?>\n<root><entry name="a">Hello</entry><entry name="b" /></root>\n"""
+
+depgen_files = {
+    'depgen_module.py': """import os
+from codega.generator.base import GeneratorBase
+from codega.makowrapper import MakoTemplateset
+import depgen_helper
+
+class DependencyGenerator(GeneratorBase):
+    def generate(self, source, context):
+        templates = MakoTemplateset(directories=[os.path.dirname(os.path.abspath(__file__))])
+        with open(context.locator.find('extra.txt')) as f:
+            extra = f.read().strip()
+
+        return templates.render('main.mako:main', {'prefix': depgen_helper.PREFIX, 'extra': extra})
+""",
+    'depgen_helper.py': "PREFIX = 'prefix'\n",
+    'main.mako': '<%def name="main()">${prefix}: ${extra}\n</%def>',
+    'extra.txt': 'extra',
+    'unrelated.txt': '',
+}
+
+multigen_module = """from codega.generator.base import GeneratorBase
+
+class MultiGenerator(GeneratorBase):
+    def generate(self, source, context):
+        for entry in source:
+            context.output.write('entries/%s.txt' % entry.attrib['name'], (entry.text or '') + '\\n')
+
+        context.output.write('index.txt', ' '.join(entry.attrib['name'] for entry in source))
+"""
+
+allocgen_module = """from codega.generator.base import GeneratorBase
+
+class AllocatingGenerator(GeneratorBase):
+    def generate(self, source, context):
+        return str(len('x' * (64 << 20)))
+"""
+
+fusegen_module = """from codega.generator.traversal import TraversalGenerator, enter, leave
+
+class NameGenerator(TraversalGenerator):
+    @enter('entry')
+    def entry(self, node, context, out):
+        out.write(node.attrib['name'] + '\\n')
+
+class TextGenerator(TraversalGenerator):
+    @enter('root')
+    def root(self, node, context, out):
+        out.write('[')
+
+    @enter('entry')
+    def entry(self, node, context, out):
+        out.write(node.text or '-')
+
+    @leave('root')
+    def leave_root(self, node, context, out):
+        out.write(']')
+"""
+
+external_config = """<?xml version="1.0" ?>
+<config version="1.0">
+    <paths>
+        <target>./</target>
+        <path>%(include)s</path>
+    </paths>
+    <source>
+        <name>source</name>
+        <filename>%(resource)s</filename>
+    </source>
+    <target>
+        <source>source</source>
+        <generator>dumper:DumpGenerator</generator>
+        <target>out.txt</target>
+    </target>
+</config>
+"""
+
+
+class TestBuildRunner(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+        self.resource = os.path.join(self.path, 'source.xml')
+        with open(self.resource, 'w') as out:
+            out.write(xml_content)
+
+        os.mkdir(os.path.join(self.path, 'out'))
+
+        self.cache_dir = os.getenv('CODEGA_CACHE_DIR')
+        os.environ['CODEGA_CACHE_DIR'] = os.path.join(self.path, 'cache')
+
+    def tearDown(self):
+        if self.cache_dir is None:
+            del os.environ['CODEGA_CACHE_DIR']
+
+        else:
+            os.environ['CODEGA_CACHE_DIR'] = self.cache_dir
+
+        shutil.rmtree(self.path)
+
+    def make_config(self, targets):
+        builder = StructureBuilder()
+        builder.set_destination('out')
+        builder.add_include(os.path.join(exampledir, 'basic'))
+        builder.add_source('source', self.resource)
+        for name in targets:
+            builder.add_target('source', name, 'dumper.DumpGenerator')
+
+        return builder.config
+
+    def read(self, name):
+        with open(os.path.join(self.path, 'out', name)) as f:
+            return f.read()
+
+    def test_build(self):
+        runner = BuildRunner(self.make_config(['a.txt']), base_path=self.path)
+
+        self.assertTrue(runner.run_task('build'))
+        self.assertTrue('entry: name = ' in self.read('a.txt'))
+
+    def test_parallel_build(self):
+        names = ['%d.txt' % i for i in range(8)]
+
+        runner = BuildRunner(self.make_config(names), base_path=self.path)
+        self.assertTrue(runner.run_task('build', jobs=4))
+
+        expected = self.read(names[0])
+        for name in names:
+            self.assertEqual(self.read(name), expected)
+
+    def test_parallel_failure(self):
+        config = self.make_config(['a.txt'])
+        config.targets['a.txt'].generator.reference = 'NoSuchGenerator'
+
+        runner = BuildRunner(config, base_path=self.path)
+        self.assertFalse(runner.run_task('build', jobs=2))
+
+    def test_up_to_date(self):
+        runner = BuildRunner(self.make_config(['a.txt']), base_path=self.path)
+        self.assertTrue(runner.run_task('build'))
+        self.assertTrue(os.path.isfile(os.path.join(self.path, '.codega', 'manifest')))
+
+        # Changing only the modification times does not trigger a rebuild
+        destination = os.path.join(self.path, 'out', 'a.txt')
+        os.utime(destination, (1000, 1000))
+        os.utime(self.resource, None)
+
+        runner = BuildRunner(self.make_config(['a.txt']), base_path=self.path)
+        self.assertTrue(runner.run_task('build'))
+        self.assertEqual(os.stat(destination).st_mtime, 1000)
+
+        # Changing the output does
+        with open(destination, 'w') as out:
+            out.write('garbage')
+
+        runner = BuildRunner(self.make_config(['a.txt']), base_path=self.path)
+        self.assertTrue(runner.run_task('build'))
+        self.assertTrue('entry: name = ' in self.read('a.txt'))
+
+    def test_write_if_changed(self):
+        destination = os.path.join(self.path, 'out', 'a.txt')
+
+        runner = BuildRunner(self.make_config(['a.txt']), base_path=self.path)
+        self.assertTrue(runner.run_task('build'))
+        self.assertEqual(runner.summary['written outputs'], 1)
+        os.utime(destination, (1000, 1000))
+
+        # A forced rebuild generates the same output, the file is not touched
+        self.assertTrue(runner.run_task('build', force=True))
+        self.assertEqual(runner.summary['unchanged outputs'], 1)
+        self.assertEqual(os.stat(destination).st_mtime, 1000)
+
+        self.assertTrue(runner.run_task('build', force=True, write_if_changed=False))
+        self.assertEqual(runner.summary['written outputs'], 1)
+        self.assertNotEqual(os.stat(destination).st_mtime, 1000)
+
+    def test_source_cache(self):
+        runner = BuildRunner(self.make_config(['a.txt']), base_path=self.path)
+        self.assertTrue(runner.run_task('build', source_cache=True))
+        self.assertEqual(runner.summary['source cache stores'], 1)
+        expected = self.read('a.txt')
+
+        runner = BuildRunner(self.make_config(['a.txt']), base_path=self.path)
+        self.assertTrue(runner.run_task('build', force=True, source_cache=True))
+        self.assertEqual(runner.summary['source cache hits'], 1)
+        self.assertEqual(self.read('a.txt'), expected)
+
+        # A changed resource is parsed again
+        with open(self.resource, 'w') as out:
+            out.write('<root><entry name="c" /></root>')
+
+        runner = BuildRunner(self.make_config(['a.txt']), base_path=self.path)
+        self.assertTrue(runner.run_task('build', source_cache=True))
+        self.assertEqual(runner.summary['source cache hits'], 0)
+        self.assertTrue('c' in self.read('a.txt'))
+
+        self.assertTrue(runner.run_task('build', force=True, source_cache=False))
+        self.assertEqual(runner.summary['source cache hits'], 0)
+
+    def test_reuse_runner(self):
+        runner = BuildRunner(self.make_config(['a.txt']), base_path=self.path)
+        runner.keep_sources = True
+        self.assertTrue(runner.run_task('build', source_cache=False))
+
+        # The parsed source is kept in memory while the resource is unchanged
+        self.assertTrue(runner.run_task('build', force=True, source_cache=False))
+        self.assertEqual(runner.summary['source cache misses'], 0)
+        self.assertTrue(runner.run_task('build', force=True, source_cache=True))
+        self.assertEqual(runner.summary['source cache misses'], 0)
+
+        with open(self.resource, 'w') as out:
+            out.write('<root><entry name="c" /></root>')
+
+        self.assertTrue(runner.run_task('build', source_cache=True))
+        self.assertEqual(runner.summary['source cache misses'], 1)
+        self.assertTrue('c' in self.read('a.txt'))
+
+    def test_release_sources(self):
+        other = os.path.join(self.path, 'other.xml')
+        with open(other, 'w') as out:
+            out.write(xml_content)
+
+        builder = StructureBuilder()
+        builder.set_destination('out')
+        builder.add_include(os.path.join(exampledir, 'basic'))
+        builder.add_source('source', self.resource)
+        builder.add_source('other', other)
+        for name, source in [('a.txt', 'source'), ('b.txt', 'other'), ('c.txt', 'source'), ('d.txt', 'other')]:
+            builder.add_target(source, name, 'dumper.DumpGenerator')
+
+        # The consumers of a source are built before the next source is
+        # parsed, so only one source is in memory at a time
+        runner = BuildRunner(builder.config, base_path=self.path)
+        self.assertTrue(runner.run_task('build', source_cache=False))
+        self.assertEqual(runner.session.peak_source_memory, runner.get_source_size(builder.config.sources['source']))
+        self.assertEqual(runner.session.source_memory, {})
+        self.assertEqual(runner.estimate_source_memory(), 0)
+        self.assertTrue(runner.summary['peak memory (MB)'] > 0)
+
+        # Runners reused by several builds keep their sources
+        runner.keep_sources = True
+        self.assertTrue(runner.run_task('build', force=True, source_cache=False))
+        self.assertEqual(runner.estimate_source_memory(), 2 * runner.get_source_size(builder.config.sources['source']))
+
+    def test_write_errors(self):
+        # The output is written in the background, the build fails at the end
+        os.makedirs(os.path.join(self.path, 'out', 'a.txt'))
+        runner = BuildRunner(self.make_config(['a.txt']), base_path=self.path)
+        self.assertFalse(runner.run_task('build'))
+        self.assertFalse(runner.run_task('build', write_threads=0))
+
+    def test_postprocess(self):
+        builder = StructureBuilder()
+        builder.set_destination('out')
+        builder.add_include(os.path.join(exampledir, 'basic'))
+        builder.add_source('source', self.resource)
+        builder.add_target('source', 'a.txt', 'dumper.DumpGenerator')
+        builder.add_postprocess('a.txt', 'sh upper.sh')
+        builder.add_postprocess('a.txt', 'grep -q NAME', check=True)
+        with open(os.path.join(self.path, 'upper.sh'), 'w') as out:
+            out.write('tr a-z A-Z\n')
+
+        runner = BuildRunner(builder.config, base_path=self.path)
+        self.assertTrue(runner.run_task('build', output_cache=True))
+        self.assertTrue('ENTRY: NAME = ' in self.read('a.txt'))
+        self.assertEqual(runner.summary['post-processed outputs'], 1)
+
+        # The processed output is cached
+        self.assertTrue(runner.run_task('build', force=True, output_cache=True))
+        self.assertEqual(runner.summary['post-process cache hits'], 1)
+        self.assertEqual(runner.summary['post-processed outputs'], 0)
+
+        # The target is rebuilt when the script changes
+        with open(os.path.join(self.path, 'upper.sh'), 'w') as out:
+            out.write('tr a-z A-Z | sed s/ENTRY/ITEM/\n')
+
+        self.assertTrue(runner.run_task('build', output_cache=True))
+        self.assertEqual(runner.summary['post-processed outputs'], 1)
+        self.assertTrue('ITEM: NAME = ' in self.read('a.txt'))
+
+        # Nothing is written if a step fails
+        os.remove(os.path.join(self.path, 'out', 'a.txt'))
+        builder.add_postprocess('a.txt', 'false', check=True)
+        self.assertFalse(runner.run_task('build', output_cache=True))
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'out', 'a.txt')))
+
+    def test_prefetch(self):
+        builder = StructureBuilder()
+        builder.set_destination('out')
+        builder.add_include(os.path.join(exampledir, 'basic'))
+        for index in range(4):
+            resource = os.path.join(self.path, 'source%d.xml' % index)
+            with open(resource, 'w') as out:
+                out.write(xml_content.replace('Hello', 'Hello %d' % index))
+
+            builder.add_source('source%d' % index, resource)
+            builder.add_target('source%d' % index, '%d.txt' % index, 'dumper.DumpGenerator')
+
+        # The sources parsed in the background give the same outputs
+        runner = BuildRunner(builder.config, base_path=self.path)
+        self.assertTrue(runner.run_task('build', source_cache=False, output_cache=False, prefetch=4))
+        self.assertEqual(runner.session.source_memory, {})
+        expected = [self.read('%d.txt' % index) for index in range(4)]
+        self.assertTrue('Hello 3' in expected[3])
+
+        self.assertTrue(runner.run_task('build', force=True, source_cache=False, output_cache=False))
+        self.assertEqual([self.read('%d.txt' % index) for index in range(4)], expected)
+
+    def test_profile(self):
+        profile = BuildProfile()
+        runner = BuildRunner(self.make_config(['a.txt', 'b.txt']), base_path=self.path)
+        self.assertTrue(runner.run_task('build', jobs=2, source_cache=False, output_cache=False, profile=profile))
+
+        phases = set((record['phase'], record['target']) for record in profile.records)
+        self.assertTrue(('parse', None) in phases)
+        self.assertTrue(('generate', os.path.relpath(os.path.join(self.path, 'out', 'a.txt'))) in phases)
+        self.assertTrue(('write', os.path.relpath(os.path.join(self.path, 'out', 'b.txt'))) in phases)
+        self.assertEqual(profile.get_totals('generator').keys(), ['dumper'])
+
+    def test_dependencies(self):
+        gendir = os.path.join(self.path, 'gen')
+        os.mkdir(gendir)
+        for name, content in depgen_files.iteritems():
+            with open(os.path.join(gendir, name), 'w') as out:
+                out.write(content)
+
+        builder = StructureBuilder()
+        builder.set_destination('out')
+        builder.add_include(gendir)
+        builder.add_source('source', self.resource)
+        builder.add_target('source', 'a.txt', 'depgen_module.DependencyGenerator')
+
+        runner = BuildRunner(builder.config, base_path=self.path)
+        self.assertTrue(runner.run_task('build'))
+        self.assertEqual(self.read('a.txt'), 'prefix: extra\n')
+
+        depends = [path for path, _ in runner.manifest.get_target('a.txt')['depends']]
+        self.assertEqual(sorted(os.path.basename(path) for path in depends),
+                         ['depgen_helper.py', 'depgen_module.py', 'extra.txt', 'main.mako'])
+
+        # Files the generator does not read do not cause a rebuild
+        with open(os.path.join(gendir, 'unrelated.txt'), 'w') as out:
+            out.write('changed')
+
+        self.assertTrue(runner.run_task('build'))
+        self.assertEqual(runner.summary['written outputs'], 0)
+
+        for name in ('main.mako', 'extra.txt', 'depgen_helper.py'):
+            with open(os.path.join(gendir, name), 'a') as out:
+                out.write('\n')
+
+            self.assertTrue(runner.run_task('build'))
+            self.assertEqual(runner.summary['written outputs'] + runner.summary['unchanged outputs'], 1)
+
+    def test_fuse(self):
+        gendir = os.path.join(self.path, 'gen')
+        os.mkdir(gendir)
+        with open(os.path.join(gendir, 'fusegen_module.py'), 'w') as out:
+            out.write(fusegen_module)
+
+        builder = StructureBuilder()
+        builder.set_destination('out')
+        builder.add_include(gendir)
+        builder.add_include(os.path.join(exampledir, 'basic'))
+        builder.add_source('source', self.resource)
+        builder.add_target('source', 'names.txt', 'fusegen_module.NameGenerator')
+        builder.add_target('source', 'text.txt', 'fusegen_module.TextGenerator')
+        builder.add_target('source', 'dump.txt', 'dumper.DumpGenerator')
+
+        runner = BuildRunner(builder.config, base_path=self.path)
+        self.assertTrue(runner.run_task('build', fuse=True))
+        self.assertEqual(runner.summary['fused targets'], 2)
+        self.assertEqual(runner.summary['written outputs'], 3)
+        self.assertEqual(self.read('names.txt'), 'a\nb\n')
+        self.assertEqual(self.read('text.txt'), '[Hello-]')
+        self.assertTrue('entry: name = ' in self.read('dump.txt'))
+        depends = [os.path.basename(path) for path, _ in runner.manifest.get_target('text.txt')['depends']]
+        self.assertEqual(depends, ['fusegen_module.py'])
+
+        # Only the targets that are not up to date are fused
+        self.assertTrue(runner.run_task('build', fuse=True))
+        self.assertEqual(runner.summary['written outputs'], 0)
+        os.unlink(os.path.join(self.path, 'out', 'text.txt'))
+        self.assertTrue(runner.run_task('build', fuse=True, output_cache=False))
+        self.assertEqual(runner.summary['fused targets'], 0)
+        self.assertEqual(runner.summary['written outputs'], 1)
+        self.assertEqual(self.read('text.txt'), '[Hello-]')
+
+        os.unlink(os.path.join(self.path, 'out', 'text.txt'))
+        os.unlink(os.path.join(self.path, 'out', 'dump.txt'))
+        self.assertTrue(runner.run_task('build', fuse=True, output_cache=False))
+        self.assertEqual(runner.summary['fused targets'], 1)
+        self.assertEqual(runner.summary['written outputs'], 2)
+
+        # The same outputs are generated without fusing
+        self.assertTrue(runner.run_task('build', force=True, output_cache=False))
+        self.assertEqual(runner.summary['fused targets'], 0)
+        self.assertEqual(runner.summary['unchanged outputs'], 3)
+
+    def test_multiple_outputs(self):
+        gendir = os.path.join(self.path, 'gen')
+        os.mkdir(gendir)
+        with open(os.path.join(gendir, 'multigen_module.py'), 'w') as out:
+            out.write(multigen_module)
+
+        builder = StructureBuilder()
+        builder.set_destination('out')
+        builder.add_include(gendir)
+        builder.add_source('source', self.resource)
+        builder.add_target('source', 'multi', 'multigen_module.MultiGenerator', kind='multiple')
+
+        runner = BuildRunner(builder.config, base_path=self.path)
+        self.assertTrue(runner.run_task('build', copy_threads=2, output_cache=True))
+        self.assertEqual(runner.summary['written outputs'], 3)
+        self.assertEqual(self.read('multi/index.txt'), 'a b')
+        self.assertEqual(self.read('multi/entries/a.txt'), 'Hello\n')
+        self.assertEqual(self.read('multi/entries/b.txt'), '\n')
+        self.assertEqual([name for name, _ in runner.manifest.get_target('multi')['outputs']],
+                         ['entries/a.txt', 'entries/b.txt', 'index.txt'])
+
+        # Every file is checked when the target is up to date
+        self.assertTrue(runner.run_task('build', output_cache=True))
+        self.assertEqual(runner.summary['written outputs'], 0)
+        os.unlink(os.path.join(self.path, 'out', 'multi', 'entries', 'b.txt'))
+        self.assertTrue(runner.run_task('build', output_cache=True))
+        self.assertEqual(runner.summary['written outputs'], 1)
+        self.assertEqual(runner.summary['unchanged outputs'], 2)
+
+        # The files are written by the writer, the ones written before an
+        # error are recorded
+        os.unlink(os.path.join(self.path, 'out', 'multi', 'entries', 'b.txt'))
+        os.mkdir(os.path.join(self.path, 'out', 'multi', 'entries', 'b.txt'))
+        self.assertFalse(runner.run_task('build', force=True, write_if_changed=False, write_threads=2))
+        self.assertEqual(runner.summary['written outputs'], 2)
+        os.rmdir(os.path.join(self.path, 'out', 'multi', 'entries', 'b.txt'))
+
+        # Files that are not generated any more are removed
+        with open(self.resource, 'w') as out:
+            out.write('<root><entry name="c">World</entry></root>')
+
+        self.assertTrue(runner.run_task('build', output_cache=True))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.path, 'out', 'multi', 'entries'))), ['c.txt'])
+        self.assertEqual(self.read('multi/index.txt'), 'c')
+
+        # Restored from the output cache
+        shutil.rmtree(os.path.join(self.path, 'out', 'multi'))
+        runner = BuildRunner(builder.config, base_path=self.path)
+        self.assertTrue(runner.run_task('build', output_cache=True))
+        self.assertEqual(runner.summary['output cache hits'], 1)
+        self.assertEqual(self.read('multi/entries/c.txt'), 'World\n')
+
+        # Cached names outside the target directory are not restored
+        record = runner.manifest.get_target('multi')
+        path = ContentCache(os.path.join(self.path, 'cache', 'outputs')).get_entry_path(record['output'])
+        with open(path, 'w') as out:
+            json.dump([['../escaped.txt', digest] for _, digest in record['outputs']], out)
+
+        shutil.rmtree(os.path.join(self.path, 'out', 'multi'))
+        self.assertTrue(runner.run_task('build', output_cache=True))
+        self.assertEqual(runner.summary['output cache hits'], 0)
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'out', 'escaped.txt')))
+        self.assertEqual(self.read('multi/entries/c.txt'), 'World\n')
+
+        self.assertTrue(runner.run_task('cleanup'))
+        self.assertEqual(os.listdir(os.path.join(self.path, 'out')), [])
+        self.assertEqual(runner.manifest.get_target('multi'), None)
+
+    def make_external(self, name, resource):
+        os.mkdir(os.path.join(self.path, name))
+        with open(os.path.join(self.path, name, 'codega.xml'), 'w') as out:
+            out.write(external_config % {'include': os.path.join(exampledir, 'basic'), 'resource': resource})
+
+    def test_externals(self):
+        self.make_external('sub1', '../source.xml')
+        self.make_external('sub2', '../source.xml')
+
+        builder = StructureBuilder()
+        builder.set_destination('out')
+        for name in ['sub1/codega.xml', 'sub2/codega.xml', 'sub1/codega.xml']:
+            builder.add_external(name)
+
+        # The externals share the parsed source, each one is built once
+        profile = BuildProfile()
+        runner = BuildRunner(builder.config, base_path=self.path)
+        self.assertTrue(runner.run_task('build', jobs=2, source_cache=False, output_cache=False, profile=profile))
+        self.assertEqual(len([record for record in profile.records if record['phase'] == 'parse']), 1)
+        self.assertEqual(len([record for record in profile.records if record['phase'] == 'generate']), 2)
+
+        with open(os.path.join(self.path, 'sub1', 'out.txt')) as f:
+            expected = f.read()
+
+        with open(os.path.join(self.path, 'sub2', 'out.txt')) as f:
+            self.assertEqual(f.read(), expected)
+
+    def test_dependent_external(self):
+        # The external reads a file copied by the config, so it is built
+        # after the copy
+        self.make_external('sub', '../out/copy.xml')
+
+        builder = StructureBuilder()
+        builder.set_destination('out')
+        builder.add_include(self.path)
+        builder.add_copy('source.xml', 'copy.xml')
+        builder.add_external('sub/codega.xml')
+
+        runner = BuildRunner(builder.config, base_path=self.path)
+        self.assertTrue(runner.run_task('build', jobs=2, source_cache=False))
+        self.assertTrue(os.path.isfile(os.path.join(self.path, 'sub', 'out.txt')))
+
+    def test_copy(self):
+        builder = StructureBuilder()
+        builder.set_destination('out')
+        builder.add_include(self.path)
+        builder.add_copy('source.xml', 'copy.xml')
+
+        runner = BuildRunner(builder.config, base_path=self.path)
+        self.assertTrue(runner.run_task('build', jobs=2))
+        self.assertEqual(self.read('copy.xml'), xml_content)
+        self.assertEqual(runner.summary['copied files'], 1)
+
+        self.assertTrue(runner.run_task('build'))
+        self.assertEqual(runner.summary['unchanged copies'], 1)
+
+    def test_copy_batch(self):
+        builder = StructureBuilder()
+        builder.set_destination('out')
+        builder.add_include(self.path)
+        for index in range(10):
+            builder.add_copy('source.xml', 'copy%d.xml' % index)
+
+        runner = BuildRunner(builder.config, base_path=self.path)
+        self.assertTrue(runner.run_task('build', copy_mode='hardlink', copy_threads=4))
+        self.assertEqual(runner.summary['copied files'], 10)
+        self.assertEqual(runner.summary['copied bytes'], 10 * len(xml_content))
+        self.assertTrue(os.path.samefile(self.resource, os.path.join(self.path, 'out', 'copy9.xml')))
+
+        self.assertTrue(runner.run_task('build', copy_threads=4))
+        self.assertEqual(runner.summary['unchanged copies'], 10)
+
+    def test_shards(self):
+        self.make_external('sub', '../source.xml')
+
+        builder = StructureBuilder()
+        builder.set_destination('out')
+        builder.add_include(os.path.join(exampledir, 'basic'))
+        builder.add_include(self.path)
+        builder.add_source('source', self.resource)
+        for name in ['a.txt', 'b.txt', 'c.txt']:
+            builder.add_target('source', name, 'dumper.DumpGenerator')
+
+        builder.add_copy('source.xml', 'copy.xml')
+        builder.add_external('sub/codega.xml')
+
+        # Every output is built by exactly one shard
+        built = []
+        for index in (1, 2):
+            runner = BuildRunner(builder.config, base_path=self.path)
+            self.assertTrue(runner.run_task('build', shard=(index, 2)))
+            report = runner.get_shard_report()
+            self.assertTrue(all(item['digest'] is not None for item in report.values()))
+            built.append(set(report))
+
+        self.assertEqual(built[0] & built[1], set())
+        self.assertEqual(built[0] | built[1], set(['out/a.txt', 'out/b.txt', 'out/c.txt', 'out/copy.xml', 'sub/out.txt']))
+        for name in built[0] | built[1]:
+            self.assertTrue(os.path.isfile(os.path.join(self.path, name)))
+
+    def test_history(self):
+        self.make_external('sub', '../source.xml')
+        config_file = os.path.join(self.path, 'sub', 'codega.xml')
+
+        # The costs of the worker processes are recorded too
+        runner = BuildRunner.load_file(config_file)
+        self.assertEqual(runner.history.get(TARGET, 'out.txt'), None)
+        self.assertTrue(runner.run_task('build', jobs=2, source_cache=False, output_cache=False))
+        self.assertTrue(runner.history.get_duration(TARGET, 'out.txt') > 0)
+        self.assertTrue(runner.history.get_duration(SOURCE, 'parse(source)') > 0)
+
+        # The history is persistent, the schedule is explained without building
+        runner = BuildRunner.load_file(config_file)
+        duration = runner.history.get_duration(TARGET, 'out.txt')
+        self.assertTrue(duration > 0)
+
+        out = StringIO()
+        self.assertTrue(runner.run_task('build', force=True, jobs=2, source_cache=False, output_cache=False,
+                                        explain_schedule=out))
+        self.assertTrue('target(out.txt)' in out.getvalue())
+        self.assertEqual(runner.history.get_duration(TARGET, 'out.txt'), duration)
+
+    def test_history_memory(self):
+        os.mkdir(os.path.join(self.path, 'gen'))
+        with open(os.path.join(self.path, 'gen', 'allocgen_module.py'), 'w') as out:
+            out.write(allocgen_module)
+
+        builder = StructureBuilder()
+        builder.set_destination('out')
+        builder.add_include('gen')
+        builder.add_source('source', self.resource)
+        builder.add_target('source', 'a.txt', 'allocgen_module.AllocatingGenerator')
+
+        # Repeating an allocation does not raise the peak memory of the
+        # process again, it is not recorded as free
+        runner = BuildRunner(builder.config, base_path=self.path)
+        for _ in range(2):
+            self.assertTrue(runner.run_task('build', force=True, source_cache=False, output_cache=False))
+            memory = runner.history.get_memory(TARGET, 'a.txt')
+            self.assertTrue(memory is None or memory >= 32 << 20)
+
+    def test_stamp(self):
+        self.make_external('sub', '../source.xml')
+        config_file = os.path.join(self.path, 'sub', 'codega.xml')
+        output = os.path.join(self.path, 'sub', 'out.txt')
+
+        self.assertFalse(BuildRunner.is_stamp_valid(config_file))
+        self.assertTrue(BuildRunner.run_task_file(config_file, 'build', source_cache=False))
+        self.assertTrue(BuildRunner.is_stamp_valid(config_file))
+
+        # Nothing is built while the stamp is valid
+        os.unlink(output)
+        self.assertFalse(BuildRunner.is_stamp_valid(config_file))
+        self.assertTrue(BuildRunner.run_task_file(config_file, 'build', source_cache=False))
+        self.assertTrue(os.path.isfile(output))
+        self.assertTrue(BuildRunner.is_stamp_valid(config_file))
+
+        with open(self.resource, 'a') as out:
+            out.write('\n')
+
+        self.assertFalse(BuildRunner.is_stamp_valid(config_file))
+        self.assertTrue(BuildRunner.run_task_file(config_file, 'build', source_cache=False))
+        self.assertTrue(BuildRunner.is_stamp_valid(config_file))
+
+        # A partial build does not save the stamp
+        os.unlink(output)
+        self.assertTrue(BuildRunner.run_task_file(config_file, 'build', filter=lambda name: False))
+        self.assertFalse(BuildRunner.is_stamp_valid(config_file))
+
+    def test_run_task_files(self):
+        self.make_external('sub1', '../source.xml')
+        self.make_external('sub2', '../source.xml')
+        config_files = [os.path.join(self.path, name, 'codega.xml') for name in ('sub1', 'sub2')]
+
+        # The configs share the parsed source and are built in one graph
+        profile = BuildProfile()
+        self.assertTrue(BuildRunner.run_task_files(config_files, 'build', base_path=self.path, jobs=2,
+                                                   source_cache=False, output_cache=False, profile=profile))
+        self.assertEqual(len([record for record in profile.records if record['phase'] == 'parse']), 1)
+        self.assertTrue(all(BuildRunner.is_stamp_valid(config_file) for config_file in config_files))
+
+        # Only the configs with an invalid stamp are built
+        os.unlink(os.path.join(self.path, 'sub2', 'out.txt'))
+        profile = BuildProfile()
+        self.assertTrue(BuildRunner.run_task_files(config_files, 'build', base_path=self.path, profile=profile, output_cache=True))
+        self.assertEqual([record['target'] for record in profile.records if record['phase'] == 'restore'],
+                         [os.path.relpath(os.path.join(self.path, 'sub2', 'out.txt'))])
+        self.assertTrue(os.path.isfile(os.path.join(self.path, 'sub2', 'out.txt')))
+
+    def test_output_cache(self):
+        # A second checkout of the same config restores the outputs from
+        # the output cache without parsing the source
+        profiles = []
+        for name in ('first', 'second'):
+            os.mkdir(os.path.join(self.path, name))
+            shutil.copy(self.resource, os.path.join(self.path, name, 'source.xml'))
+            self.make_external(os.path.join(name, 'sub'), '../source.xml')
+
+            profile = BuildProfile()
+            runner = BuildRunner.load_file(os.path.join(self.path, name, 'sub', 'codega.xml'))
+            self.assertTrue(runner.run_task('build', source_cache=False, profile=profile, output_cache=True,
+                                            copy_mode='hardlink'))
+            profiles.append(profile)
+
+        self.assertEqual(runner.summary['output cache hits'], 1)
+        self.assertEqual(runner.summary['written outputs'], 1)
+        self.assertFalse(any(record['phase'] == 'parse' for record in profiles[1].records))
+        self.assertTrue(any(record['phase'] == 'restore' for record in profiles[1].records))
+
+        with open(os.path.join(self.path, 'first', 'sub', 'out.txt')) as f:
+            expected = f.read()
+
+        with open(os.path.join(self.path, 'second', 'sub', 'out.txt')) as f:
+            self.assertEqual(f.read(), expected)
+
+        # The restored output is not linked to the cache
+        self.assertEqual(os.stat(os.path.join(self.path, 'second', 'sub', 'out.txt')).st_nlink, 1)
+
+        # The target is up to date after it was restored
+        self.assertTrue(runner.run_task('build', force=False, output_cache=True))
+        self.assertEqual(runner.summary['written outputs'] + runner.summary['unchanged outputs'], 0)
+
+        # The output cache can be turned off
+        self.assertTrue(runner.run_task('build', force=True, source_cache=False, output_cache=False))
+        self.assertEqual(runner.summary['output cache hits'], 0)
+
+        cache = ContentCache(os.path.join(self.path, 'cache', 'outputs'))
+        self.assertEqual(cache.get_counters(), {'hits': 1, 'misses': 1, 'stores': 1})
+
+    def test_output_cache_checkouts(self):
+        # Checkouts in different directories share the output cache, the
+        # files read by the generator are checked in the checkout using it
+        for name, extra in (('first', 'extra'), ('second', 'extra'), ('third', 'other')):
+            gendir = os.path.join(self.path, name, 'gen')
+            os.makedirs(gendir)
+            os.mkdir(os.path.join(self.path, name, 'out'))
+            for filename, content in depgen_files.iteritems():
+                with open(os.path.join(gendir, filename.replace('depgen_', 'cachegen_')), 'w') as out:
+                    out.write(content.replace('depgen_', 'cachegen_'))
+
+            with open(os.path.join(gendir, 'extra.txt'), 'w') as out:
+                out.write(extra)
+
+            builder = StructureBuilder()
+            builder.set_destination('out')
+            builder.add_include('gen')
+            builder.add_source('source', self.resource)
+            builder.add_target('source', 'a.txt', 'cachegen_module.DependencyGenerator')
+
+            runner = BuildRunner(builder.config, base_path=os.path.join(self.path, name))
+            self.assertTrue(runner.run_task('build', output_cache=True))
+            with open(os.path.join(self.path, name, 'out', 'a.txt')) as f:
+                self.assertEqual(f.read(), 'prefix: %s\n' % extra)
+
+            self.assertEqual(runner.summary['output cache hits'], 1 if name == 'second' else 0)
+            if name == 'second':
+                # The restored target depends on the files of its own checkout
+                depends = [path for path, _ in runner.manifest.get_target('a.txt')['depends']]
+                self.assertTrue(os.path.join(self.path, name, 'gen', 'extra.txt') in depends)
+                self.assertFalse([path for path in depends if path.startswith(os.path.join(self.path, 'first', ''))])
+
+    def test_remote_cache(self):
+        # Two checkouts with separate local caches share the outputs and
+        # the sources through a cache server
+        server = CacheServer(('127.0.0.1', 0), os.path.join(self.path, 'server'))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        url = 'http://127.0.0.1:%d' % server.server_address[1]
+        try:
+            profiles = []
+            for name in ('first', 'second'):
+                os.mkdir(os.path.join(self.path, name))
+                shutil.copy(self.resource, os.path.join(self.path, name, 'source.xml'))
+                self.make_external(os.path.join(name, 'sub'), '../source.xml')
+
+                profile = BuildProfile()
+                runner = BuildRunner.load_file(os.path.join(self.path, name, 'sub', 'codega.xml'))
+                self.assertTrue(runner.run_task('build', profile=profile, source_cache=True, output_cache=True,
+                                                remote_cache=url, cache_dir=os.path.join(self.path, name, 'cache')))
+                profiles.append(profile)
+
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        self.assertEqual(runner.summary['output cache hits'], 1)
+        self.assertFalse(any(record['phase'] == 'parse' for record in profiles[1].records))
+        self.assertTrue(server.caches['outputs'].get_stats()[0] > 0)
+
+        with open(os.path.join(self.path, 'first', 'sub', 'out.txt')) as f:
+            expected = f.read()
+
+        with open(os.path.join(self.path, 'second', 'sub', 'out.txt')) as f:
+            self.assertEqual(f.read(), expected)
+
+        # Without the server the local cache of the second checkout is used
+        self.assertTrue(runner.run_task('build', force=False, output_cache=True, remote_cache=url, remote_timeout=0.5,
+                                        cache_dir=os.path.join(self.path, 'second', 'cache')))
@@ -0,0 +1,237 @@
+from unittest import TestCase
+import os
+import time
+import shutil
+import tempfile
+import threading
+
+from codega.buildgraph import BuildNode, BuildGraph, Scheduler, GraphError, PrefetchResult, format_schedule
+
+
+class ValueNode(BuildNode):
+    def __init__(self, key, requires=(), order=(), parallel=False, fail=False, cost=0.0, runs=None):
+        super(ValueNode, self).__init__(key, requires=requires, order=order)
+
+        self.cost = cost
+        self.runs = runs
+        self.parallel = parallel
+        self.ordered = parallel
+        self.fail = fail
+        self.graph = None
+        self.reports = None
+
+    def run(self):
+        if self.fail:
+            raise RuntimeError('node %r failed' % (self.key,))
+
+        if self.runs is not None:
+            self.runs.append(self.key)
+
+        return sum(self.graph[key].value for key in self.requires) + 1
+
+    def report(self, success, error):
+        if self.ordered:
+            self.reports.append((self.key, success))
+
+
+def make_graph(nodes):
+    graph = BuildGraph()
+    reports = []
+    for node in nodes:
+        node.graph = graph
+        node.reports = reports
+        graph.add(node)
+
+    return graph, reports
+
+
+class TimedNode(ValueNode):
+    '''Parallel node logging when it ran'''
+
+    def __init__(self, key, memory, log):
+        super(TimedNode, self).__init__(key, parallel=True)
+
+        self.memory = memory
+        self.log = log
+
+    def run(self):
+        start = time.time()
+        time.sleep(0.1)
+        with open(self.log, 'a') as out:
+            out.write('%s %f %f\n' % (self.key, start, time.time()))
+
+        return 1
+
+
+class PrefetchNode(ValueNode):
+    '''Prefetchable node recording the thread computing its value'''
+
+    prefetchable = True
+
+    def __init__(self, key, requires=(), order=(), memory=0):
+        super(PrefetchNode, self).__init__(key, requires=requires, order=order)
+
+        self.memory = memory
+        self.thread = None
+
+    def prefetch(self, pool):
+        self.prefetched = PrefetchResult(pool, self.compute)
+
+    def run(self):
+        if self.prefetched is not None:
+            res, self.prefetched = self.prefetched.get(), None
+            return res
+
+        return self.compute()
+
+    def compute(self):
+        self.thread = threading.current_thread().name
+        for key in self.requires:
+            pending = self.graph[key].prefetched
+            if pending is not None:
+                pending.get()
+
+        return 1
+
+
+class TestBuildGraph(TestCase):
+    def test_topological_order(self):
+        graph, _ = make_graph([
+            ValueNode('c', requires=['b'], order=(0,)),
+            ValueNode('b', requires=['a'], order=(1,)),
+            ValueNode('a', order=(2,)),
+            ValueNode('d', order=(3,)),
+        ])
+
+        self.assertEqual([node.key for node in graph.topological_order()], ['a', 'b', 'c', 'd'])
+
+    def test_cycle(self):
+        graph, _ = make_graph([ValueNode('a', requires=['b']), ValueNode('b', requires=['a'])])
+        self.assertRaises(GraphError, graph.topological_order)
+
+    def test_critical_path(self):
+        graph, _ = make_graph([
+            ValueNode('a', cost=1.0),
+            ValueNode('b', cost=1.0),
+            ValueNode('c', requires=['a'], cost=2.0),
+            ValueNode('d', requires=['b'], cost=None),
+            ValueNode('e', requires=['b'], cost=5.0),
+        ])
+
+        # Unknown costs are the average of the known ones
+        self.assertEqual(graph.get_costs()['d'], 2.25)
+        self.assertEqual(graph.get_priorities(), {'a': 3.0, 'b': 6.0, 'c': 2.0, 'd': 2.25, 'e': 5.0})
+        self.assertEqual([node.key for node in graph.get_critical_path()], ['b', 'e'])
+
+        text = format_schedule(graph, jobs=2)
+        self.assertTrue('critical path: 6.000 s' in text)
+
+
+class TestScheduler(TestCase):
+    def make_nodes(self, fail=False):
+        nodes = [ValueNode('source', order=(0,))]
+        for index in range(6):
+            nodes.append(ValueNode(('target', index), requires=['source'], order=(index + 1,), parallel=True,
+                                   fail=fail and index == 3))
+
+        return nodes
+
+    def test_serial(self):
+        graph, reports = make_graph(self.make_nodes())
+
+        self.assertTrue(Scheduler(graph).run())
+        self.assertEqual(reports, [(('target', index), True) for index in range(6)])
+
+    def test_parallel(self):
+        graph, reports = make_graph(self.make_nodes())
+
+        self.assertTrue(Scheduler(graph, jobs=3).run())
+        self.assertEqual(reports, [(('target', index), True) for index in range(6)])
+        for index in range(6):
+            self.assertEqual(graph[('target', index)].value, 2)
+
+    def test_longest_first(self):
+        runs = []
+        nodes = [ValueNode(index, order=(index,), cost=cost, runs=runs) for index, cost in enumerate([1.0, 3.0, 2.0])]
+
+        # With one job the nodes are run in order, otherwise the longest first
+        graph, _ = make_graph(nodes)
+        self.assertTrue(Scheduler(graph).run())
+        self.assertEqual(runs, [0, 1, 2])
+
+        del runs[:]
+        self.assertTrue(Scheduler(graph, jobs=2).run())
+        self.assertEqual(runs, [1, 2, 0])
+
+    def test_memory_budget(self):
+        path = tempfile.mkdtemp()
+        try:
+            log = os.path.join(path, 'log')
+            memory = {'a': 60, 'b': 50, 'c': 40, 'd': 150, 'e': 10}
+            graph, _ = make_graph([TimedNode(key, size, log) for key, size in sorted(memory.items())])
+            self.assertTrue(Scheduler(graph, jobs=4, memory_budget=100).run())
+
+            with open(log) as f:
+                runs = [(line.split()[0], float(line.split()[1]), float(line.split()[2])) for line in f]
+
+        finally:
+            shutil.rmtree(path)
+
+        # The nodes running at the same time fit in the budget, larger
+        # nodes run alone
+        self.assertEqual(len(runs), 5)
+        for key, start, end in runs:
+            running = [other for other, other_start, other_end in runs if other_start < end and start < other_end]
+            if memory[key] > 100:
+                self.assertEqual(running, [key])
+
+            else:
+                self.assertTrue(sum(memory[other] for other in running) <= 100)
+
+    def test_prefetch(self):
+        main = threading.current_thread().name
+        nodes = [PrefetchNode(('source', index), order=(index,), memory=10) for index in range(6)]
+        nodes.append(PrefetchNode('stage', requires=[('source', 1)], order=(1,)))
+
+        # Without prefetching everything runs in the main thread
+        graph, _ = make_graph(nodes)
+        self.assertTrue(Scheduler(graph).run())
+        self.assertEqual(set(node.thread for node in nodes), set([main]))
+
+        # The next nodes are prefetched, including nodes requiring prefetched
+        # nodes, while they fit in the prefetch memory
+        graph, _ = make_graph(nodes)
+        self.assertTrue(Scheduler(graph, prefetch=3, prefetch_memory=20).run())
+        self.assertEqual(graph[('source', 0)].thread, main)
+        self.assertNotEqual(graph[('source', 1)].thread, main)
+        self.assertNotEqual(graph['stage'].thread, main)
+        self.assertTrue(all(node.prefetched is None for node in nodes))
+
+        # Parallel builds do not prefetch
+        graph, _ = make_graph(nodes)
+        self.assertTrue(Scheduler(graph, jobs=2, prefetch=3).run())
+        self.assertEqual(graph[('source', 5)].value, 1)
+
+    def test_prefetch_memory(self):
+        nodes = [PrefetchNode(index, order=(index,), memory=100) for index in range(4)]
+
+        # Nodes larger than the prefetch memory run in their turn
+        graph, _ = make_graph(nodes)
+        self.assertTrue(Scheduler(graph, prefetch=3, prefetch_memory=50).run())
+        self.assertEqual(set(node.thread for node in nodes), set([threading.current_thread().name]))
+
+    def test_failure(self):
+        graph, reports = make_graph(self.make_nodes(fail=True))
+        self.assertFalse(Scheduler(graph).run())
+        self.assertEqual(reports[-1], (('target', 3), False))
+
+        graph, reports = make_graph(self.make_nodes(fail=True))
+        self.assertFalse(Scheduler(graph, jobs=3).run())
+        self.assertTrue((('target', 3), False) in reports)
+
+    def test_unguarded_failure(self):
+        graph, _ = make_graph(self.make_nodes(fail=True))
+        self.assertRaises(RuntimeError, Scheduler(graph, guarded=False).run)
+
+        graph, _ = make_graph(self.make_nodes(fail=True))
+        self.assertRaises(GraphError, Scheduler(graph, jobs=2, guarded=False).run)
@@ -0,0 +1,105 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+from lxml import etree
+
+from codega.cache import ContentCache, SourceCache, OutputCache, dump_source, load_source
+from codega.manifest import hash_data
+
+
+class TestContentCache(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = ContentCache(os.path.join(self.path, 'cache'), max_size=1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_put_get(self):
+        self.assertEqual(self.cache.get('abcdef'), None)
+        self.cache.put('abcdef', 'data')
+        self.assertTrue(self.cache.contains('abcdef'))
+        self.assertEqual(self.cache.get('abcdef'), 'data')
+        self.assertEqual(self.cache.get_stats(), (1, 4))
+
+        self.cache.clear()
+        self.assertFalse(self.cache.contains('abcdef'))
+        self.assertEqual(self.cache.get_stats(), (0, 0))
+
+    def test_evict(self):
+        for index in range(4):
+            key = 'key%d' % index
+            self.cache.put(key, 'x' * 400)
+            os.utime(self.cache.get_entry_path(key), (index, index))
+
+        # Using an entry makes it the most recent one
+        self.cache.get('key0')
+
+        self.assertEqual(self.cache.evict(), 2)
+        self.assertEqual([self.cache.contains('key%d' % index) for index in range(4)], [True, False, False, True])
+
+    def test_counters(self):
+        self.assertEqual(self.cache.get_counters(), {})
+
+        self.cache.add_counters({'hits': 2})
+        self.cache.add_counters({'hits': 1, 'misses': 1})
+        self.assertEqual(self.cache.get_counters(), {'hits': 3, 'misses': 1})
+        self.assertEqual(self.cache.get_stats(), (0, 0))
+
+
+class TestSourceCache(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = SourceCache(ContentCache(self.path))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_serialize(self):
+        root = etree.fromstring('<root><a x="1">text</a></root>')
+        self.assertEqual(etree.tostring(load_source(dump_source(root))), etree.tostring(root))
+        self.assertEqual(load_source(dump_source({'a': [1, 2]})), {'a': [1, 2]})
+
+        # The location of the nodes is kept
+        root = etree.fromstring('<?xml version="1.0"?>\n<!-- comment -->\n<root>\n  <a />\n</root>',
+                                base_url='/path/source.xml')
+        loaded = load_source(dump_source(root))
+        self.assertEqual(loaded[0].sourceline, 4)
+        self.assertEqual(loaded[0].base, '/path/source.xml')
+
+    def test_dependencies(self):
+        self.cache.store('key', {'a': 1}, [('included.txt', 'digest')])
+
+        data, dependencies = self.cache.load('key', lambda filename, digest: True)
+        self.assertEqual(data, {'a': 1})
+        self.assertEqual(dependencies, [['included.txt', 'digest']])
+
+        self.assertEqual(self.cache.load('key', lambda filename, digest: False), None)
+        self.assertEqual(self.cache.load('missing', lambda filename, digest: True), None)
+
+
+class TestOutputCache(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = OutputCache(ContentCache(self.path))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_store_load(self):
+        digest = hash_data('output')
+        self.assertTrue(self.cache.store('key', 'output', digest, [('template.mako', 'digest')]))
+
+        self.assertEqual(self.cache.load('key', lambda filename, digest: True), (digest, [['template.mako', 'digest']]))
+        self.assertEqual(self.cache.load('key', lambda filename, digest: False), None)
+        self.assertEqual(self.cache.load('missing', lambda filename, digest: True), None)
+
+        with open(self.cache.get_output_path(digest)) as f:
+            self.assertEqual(f.read(), 'output')
+
+        # Entries of evicted outputs are invalid
+        self.cache.cache.remove(digest)
+        self.assertEqual(self.cache.get_output_path(digest), None)
+        self.assertEqual(self.cache.load('key', lambda filename, digest: True), None)
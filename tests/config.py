@@ -110,6 +110,18 @@ class TestVisitors(TestCase):
         self.assertEqual(target.settings.setting.other, 'some other thing')
         self.assertEqual(target.settings.other, 'foo')
 
+    def check_parse03(self, cfg):
+        self.assertEqual(cfg.targets['config.txt'].kind, TARGET_SINGLE)
+        self.assertFalse(cfg.targets['config.txt'].multiple)
+        self.assertEqual(cfg.targets['pages'].kind, TARGET_MULTIPLE)
+        self.assertTrue(cfg.targets['pages'].multiple)
+
+        self.assertRaises(ValueError, setattr, cfg.targets['pages'], 'kind', 'other')
+
+    def check_parse04(self, cfg):
+        steps = cfg.targets['config.txt'].postprocess
+        self.assertEqual([(step.command, step.check) for step in steps], [('tr a-z A-Z', False), ('grep -q CONFIG', True)])
+
 class TestFunctions(TestCase):
     def test_validators(self):
         # Module validator
@@ -0,0 +1,51 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+from codega.discovery import ConfigDiscovery, find_configs
+
+
+class TestConfigDiscovery(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = os.path.join(self.path, '.codega', 'discovery.json')
+        for name in ('a', 'b/c', '.hidden', 'd'):
+            os.makedirs(os.path.join(self.path, name))
+
+        for name in ('a', 'b/c', '.hidden'):
+            self.touch(os.path.join(name, 'codega.xml'))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def touch(self, name):
+        with open(os.path.join(self.path, name), 'w'):
+            pass
+
+    def test_find_configs(self):
+        configs, dirs = find_configs(self.path)
+        self.assertEqual(configs, ['a/codega.xml', 'b/c/codega.xml'])
+        self.assertEqual(sorted(dirs), ['.', 'a', 'b', 'b/c', 'd'])
+
+    def test_cache(self):
+        discovery = ConfigDiscovery(self.path, self.cache)
+        expected = [os.path.join(self.path, 'a', 'codega.xml'), os.path.join(self.path, 'b', 'c', 'codega.xml')]
+        self.assertEqual(discovery.find(), expected)
+        self.assertEqual(discovery.load(), ['a/codega.xml', 'b/c/codega.xml'])
+
+        # Changing a file does not change the directories
+        self.touch('a/codega.xml')
+        self.assertEqual(ConfigDiscovery(self.path, self.cache).load(), ['a/codega.xml', 'b/c/codega.xml'])
+
+        # A new config changes its directory
+        self.touch('d/codega.xml')
+        os.utime(os.path.join(self.path, 'd'), (1000, 1000))
+        self.assertEqual(discovery.load(), None)
+        self.assertEqual(len(discovery.find()), 3)
+
+        # The cached list is not used when rescanning
+        os.unlink(os.path.join(self.path, 'd', 'codega.xml'))
+        os.utime(os.path.join(self.path, 'd'), (1000, 1000))
+        self.assertEqual(len(discovery.find()), 3)
+        self.assertEqual(len(discovery.find(rescan=True)), 2)
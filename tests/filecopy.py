@@ -0,0 +1,51 @@
+from unittest import TestCase
+import os
+import stat
+import shutil
+import tempfile
+
+from codega.filecopy import copy_file, is_same_file, COPY_MODES
+
+
+class TestCopyFile(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.source = os.path.join(self.path, 'source')
+        self.destination = os.path.join(self.path, 'destination')
+
+        with open(self.source, 'w') as out:
+            out.write('content')
+
+        os.chmod(self.source, 0750)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def read(self, name):
+        with open(name) as f:
+            return f.read()
+
+    def test_modes(self):
+        for mode in COPY_MODES:
+            with open(self.destination, 'w') as out:
+                out.write('old content')
+
+            copy_file(self.source, self.destination, mode)
+            self.assertEqual(self.read(self.destination), 'content')
+            self.assertEqual(stat.S_IMODE(os.stat(self.destination).st_mode), 0750)
+            self.assertEqual(is_same_file(self.source, self.destination), mode == 'hardlink')
+            self.assertEqual(sorted(os.listdir(self.path)), ['destination', 'source'])
+
+    def test_replace_link(self):
+        # A destination linked to the source is replaced, not written through
+        copy_file(self.source, self.destination, 'hardlink')
+        copy_file(self.source, self.destination, 'copy')
+        self.assertFalse(is_same_file(self.source, self.destination))
+
+        with open(self.destination, 'w') as out:
+            out.write('changed')
+
+        self.assertEqual(self.read(self.source), 'content')
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, copy_file, self.source, self.destination, 'move')
@@ -5,6 +5,9 @@ from codega.generator.function import FunctionGenerator
 from codega.generator.template import TemplateGenerator
 from codega.generator.priority import PriorityGenerator, PRI_LOW
 from codega.generator.object import ObjectGenerator, generator, match
+from codega.generator.traversal import TraversalGenerator, enter, leave, traverse
+
+from lxml import etree
 
 class SimpleGenerator(GeneratorBase):
     def generate(self, source, context):
@@ -54,6 +57,26 @@ class MyObjectGenerator(ObjectGenerator):
         # Template explicitly specified
         return dict(name='testrunner!', source=source, context=context)
 
+class OutlineGenerator(TraversalGenerator):
+    @enter('section')
+    def enter_section(self, node, context, out):
+        out.write('%s(' % node.attrib['name'])
+
+    @leave('section')
+    def leave_section(self, node, context, out):
+        out.write(')')
+
+class CountingGenerator(OutlineGenerator):
+    def begin(self, source, context, out):
+        self.count = 0
+
+    @enter('item')
+    def enter_item(self, node, context, out):
+        self.count += 1
+
+    def end(self, source, context, out):
+        return '%s %d' % (context, self.count)
+
 class TestGenerators(TestCase):
     matcher = lambda self, src, context: src == 0
 
@@ -103,3 +126,17 @@ class TestGenerators(TestCase):
         self.check(p, 1, 1, "template #1 (context = 1, source = 1, name = 'testrunner!'")
         self.check(p, 2, 1, "template #2 (context = 1, source = 2, name = 'testrunner!'")
         self.assertRaises(ValueError, p, 4, None)
+
+    def test_traversal_generator(self):
+        source = etree.fromstring('<root><section name="a"><item /><section name="b"><item /></section></section>'
+                                  '<section name="c" /></root>')
+
+        self.assertEqual(OutlineGenerator().generate(source, None), 'a(b())c()')
+        self.assertEqual(CountingGenerator().generate(source, 'counted'), 'counted 2')
+
+        # Several generators are driven by one walk
+        self.assertEqual(traverse(source, [(OutlineGenerator(), None), (CountingGenerator(), 'x')]),
+                         ['a(b())c()', 'x 2'])
+
+        # Handlers are inherited
+        self.assertEqual(sorted(CountingGenerator.__enter_handlers__), ['item', 'section'])
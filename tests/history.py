@@ -0,0 +1,43 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+from codega.history import BuildHistory, TARGET, SOURCE
+
+
+class TestBuildHistory(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'state', 'history')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_record(self):
+        history = BuildHistory(self.filename).load()
+        self.assertEqual(history.get_duration(TARGET, 'a.txt'), None)
+
+        # Durations are averaged, the memory is the last one
+        history.record(TARGET, 'a.txt', 4.0, 100)
+        history.record(TARGET, 'a.txt', 2.0, 50)
+        history.record(SOURCE, 'parse(a)', 1.0)
+        self.assertEqual(history.get(TARGET, 'a.txt'), {'duration': 3.0, 'memory': 50})
+        self.assertEqual(history.get_memory(SOURCE, 'parse(a)'), None)
+
+        history.save()
+        history = BuildHistory(self.filename).load()
+        self.assertEqual(history.get_duration(TARGET, 'a.txt'), 3.0)
+        self.assertEqual(history.get_duration(SOURCE, 'parse(a)'), 1.0)
+
+    def test_merge(self):
+        history = BuildHistory(self.filename)
+        worker = BuildHistory(self.filename)
+        worker.record(TARGET, 'a.txt', 1.0, 10)
+
+        history.merge(worker.pop_changes())
+        self.assertEqual(history.get(TARGET, 'a.txt'), {'duration': 1.0, 'memory': 10})
+        self.assertEqual(worker.pop_changes(), {})
+
+        history.save()
+        self.assertTrue(os.path.isfile(self.filename))
@@ -0,0 +1,46 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+from codega.manifest import BuildManifest, hash_data
+
+
+class TestManifest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'file')
+        with open(self.filename, 'w') as out:
+            out.write('content')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_file_digest(self):
+        manifest = BuildManifest()
+        self.assertEqual(manifest.file_digest(self.filename), hash_data('content'))
+        self.assertEqual(manifest.file_digest(os.path.join(self.path, 'missing')), None)
+
+    def test_save_load(self):
+        path = os.path.join(self.path, 'state', 'manifest')
+        manifest = BuildManifest(path)
+        manifest.file_digest(self.filename)
+        manifest.set_target('target', {'inputs': 'a', 'output': 'b'})
+        manifest.save()
+
+        loaded = BuildManifest(path).load()
+        self.assertEqual(loaded.get_target('target'), {'inputs': 'a', 'output': 'b'})
+        self.assertEqual(loaded.file_digest(self.filename), hash_data('content'))
+
+    def test_merge(self):
+        worker = BuildManifest()
+        worker.set_target('target', {'inputs': 'a', 'output': 'b'})
+        worker.file_digest(self.filename)
+
+        manifest = BuildManifest()
+        manifest.merge(worker.pop_changes())
+        self.assertEqual(manifest.get_target('target'), {'inputs': 'a', 'output': 'b'})
+
+        worker.remove_target('target')
+        manifest.merge(worker.pop_changes())
+        self.assertEqual(manifest.get_target('target'), None)
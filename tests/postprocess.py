@@ -0,0 +1,68 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+from codega.cache import ContentCache, PostProcessCache
+from codega.postprocess import PostProcessor, PostProcessError, get_command_files
+
+
+class TestPostProcessor(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_process_files(self):
+        files = [('%d.txt' % index, 'output %d\n' % index) for index in range(8)]
+        steps = [('tr a-z A-Z', False), ('grep -q OUTPUT', True), ('echo "$CODEGA_OUTPUT"', False)]
+
+        processor = PostProcessor(jobs=4, cwd=self.path)
+        processed, hits = processor.process_files(files, steps)
+        self.assertEqual(processed, [(name, name + '\n') for name, _ in files])
+        self.assertEqual(hits, 0)
+
+    def test_cache(self):
+        cache = PostProcessCache(ContentCache(self.path))
+        processor = PostProcessor(cache, cwd=self.path)
+        steps = [('tr a-z A-Z', False)]
+
+        self.assertEqual(processor.process('a.txt', 'abc', steps), ('ABC', False))
+        self.assertEqual(processor.process('a.txt', 'abc', steps), ('ABC', True))
+
+        # The key depends on the output and on the commands
+        self.assertEqual(processor.process('a.txt', 'abd', steps), ('ABD', False))
+        self.assertEqual(processor.process('a.txt', 'abc', steps + [('rev', False)]), ('CBA', False))
+
+        # The key depends on the directory of the commands and the files they reference
+        other = PostProcessor(cache, cwd=os.path.join(self.path, 'other'))
+        os.mkdir(os.path.join(self.path, 'other'))
+        self.assertEqual(other.process('a.txt', 'abc', steps), ('ABC', False))
+
+        with open(os.path.join(self.path, 'lower.sh'), 'w') as out:
+            out.write('tr A-Z a-z\n')
+
+        steps = [('sh lower.sh', False)]
+        self.assertEqual(processor.process('a.txt', 'ABC', steps), ('abc', False))
+        self.assertEqual(processor.process('a.txt', 'ABC', steps), ('abc', True))
+        with open(os.path.join(self.path, 'lower.sh'), 'w') as out:
+            out.write('tr A-Z a-z | rev\n')
+
+        self.assertEqual(processor.process('a.txt', 'ABC', steps), ('cba', False))
+
+    def test_command_files(self):
+        for name in ('fmt.sh', 'fmt.cfg'):
+            with open(os.path.join(self.path, name), 'w') as out:
+                out.write('\n')
+
+        self.assertEqual(get_command_files('sh ./fmt.sh --config=fmt.cfg /bin/sh missing.sh', self.path),
+                         [os.path.join(self.path, 'fmt.sh'), os.path.join(self.path, 'fmt.cfg')])
+        self.assertEqual(get_command_files('sh "unterminated', self.path), [])
+
+    def test_errors(self):
+        files = [('a.txt', 'a'), ('b.txt', 'b')]
+        processor = PostProcessor(jobs=2, cwd=self.path)
+
+        self.assertRaises(PostProcessError, processor.process_files, files, [('test "$CODEGA_OUTPUT" = a.txt', True)])
+        self.assertRaises(PostProcessError, processor.process_files, files, [('exit 3', False)])
@@ -0,0 +1,113 @@
+from unittest import TestCase
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+from lxml import etree
+
+from codega.cache import ContentCache, SourceCache, SOURCE_CACHE, OUTPUT_CACHE
+from codega.manifest import hash_data
+from codega.remotecache import RemoteCache, RemoteStore, CacheServer
+
+
+class TestRemoteCache(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.server = CacheServer(('127.0.0.1', 0), os.path.join(self.path, 'server'))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        self.client = RemoteCache(self.url, timeout=5.0)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.path)
+
+    def test_protocol(self):
+        self.assertEqual(self.client.get(SOURCE_CACHE, 'abcdef'), None)
+        self.assertFalse(self.client.contains(SOURCE_CACHE, 'abcdef'))
+
+        self.assertTrue(self.client.put(SOURCE_CACHE, 'abcdef', 'data'))
+        self.assertEqual(self.client.get(SOURCE_CACHE, 'abcdef'), 'data')
+        self.assertTrue(self.client.contains(SOURCE_CACHE, 'abcdef'))
+        self.assertTrue(self.server.caches[SOURCE_CACHE].contains('abcdef'))
+
+        # The caches are separate
+        self.assertEqual(self.client.get(OUTPUT_CACHE, 'abcdef'), None)
+        self.assertEqual(self.client.exists(SOURCE_CACHE, ['abcdef', '012345']), set(['abcdef']))
+
+        # Invalid keys and caches are not found
+        self.assertEqual(self.client.request('GET', '/%s/../x' % SOURCE_CACHE)[0], 404)
+        self.assertEqual(self.client.request('PUT', '/unknown/abcdef', 'data')[0], 404)
+
+        # Every request used the same connection
+        self.assertEqual(len(self.client._pool), 1)
+        self.assertTrue(self.client.available)
+
+    def test_content_cache(self):
+        # Entries missing locally are downloaded and stored locally
+        first = ContentCache(os.path.join(self.path, 'first'), remote=RemoteStore(self.client, OUTPUT_CACHE))
+        second = ContentCache(os.path.join(self.path, 'second'), remote=RemoteStore(self.client, OUTPUT_CACHE))
+
+        first.put('abcdef', 'data')
+        second.prefetch(['abcdef', '012345'])
+        self.assertTrue(second.contains('abcdef'))
+        self.assertFalse(second.contains('012345'))
+        self.assertEqual(second.get('abcdef'), 'data')
+        self.assertTrue(os.path.isfile(second.get_entry_path('abcdef')))
+
+        # Entries stored locally before are uploaded by add
+        second.put('012345', 'other')
+        local = ContentCache(os.path.join(self.path, 'first'))
+        local.put('fedcba', 'local')
+        first.add('fedcba', 'local')
+        self.assertEqual(self.client.get(OUTPUT_CACHE, 'fedcba'), 'local')
+
+        # Entries addressed by their content must match it
+        second.put(hash_data('other'), 'other')
+        path = first.get_path(hash_data('other'))
+        with open(path) as f:
+            self.assertEqual(f.read(), 'other')
+
+        self.assertEqual(first.get_path('012345'), None)
+        self.assertFalse(os.path.isfile(first.get_entry_path('012345')))
+
+        # Pickled sources are not shared
+        sources = SourceCache(ContentCache(os.path.join(self.path, 'sources'),
+                                           remote=RemoteStore(self.client, SOURCE_CACHE)))
+        sources.store('abcdef', {'a': 1})
+        sources.store('fedcba', etree.fromstring('<root />'))
+        self.assertEqual(self.client.get(SOURCE_CACHE, 'abcdef'), None)
+
+        self.client.put(SOURCE_CACHE, '012345', self.client.get(SOURCE_CACHE, 'fedcba').replace('\nx', '\np', 1))
+        other = SourceCache(ContentCache(os.path.join(self.path, 'other'), remote=RemoteStore(self.client, SOURCE_CACHE)))
+        self.assertEqual(other.load('012345', lambda filename, digest: True), None)
+        self.assertEqual(other.load('fedcba', lambda filename, digest: True)[0].tag, 'root')
+
+    def test_timeout(self):
+        # A server accepting connections but never answering
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        try:
+            client = RemoteCache('http://127.0.0.1:%d' % listener.getsockname()[1], timeout=0.2)
+            cache = ContentCache(os.path.join(self.path, 'local'), remote=RemoteStore(client, SOURCE_CACHE))
+
+            self.assertEqual(cache.get('abcdef'), None)
+            self.assertFalse(client.available)
+
+            # The local cache still works
+            cache.put('abcdef', 'data')
+            self.assertEqual(cache.get('abcdef'), 'data')
+
+        finally:
+            listener.close()
+
+    def test_invalid_url(self):
+        self.assertRaises(ValueError, RemoteCache, 'ftp://localhost/')
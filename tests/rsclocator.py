@@ -45,3 +45,18 @@ class FallbackLocatorTest(TestCase):
         self.assertEqual(self.locator.find('run_tests.py'), os.path.join(path1, 'run_tests.py'))
 
     test_list = test_list_base
+
+class FindModuleTest(TestCase):
+    def setUp(self):
+        self.locator = FallbackLocator([ FileResourceLocator(path0), FileResourceLocator(path1) ])
+
+    def test_find_module(self):
+        self.assertEqual(self.locator.find_module('common'), os.path.join(path0, 'common.py'))
+        self.assertEqual(self.locator.find_module('codega.alp'), os.path.join(path1, 'codega', 'alp'))
+        self.assertRaises(ImportError, self.locator.find_module, 'no_such_module')
+
+    def test_no_import(self):
+        import sys
+
+        self.locator.find_module('codega.alp.tools')
+        self.assertFalse('codega.alp.tools' in sys.modules)
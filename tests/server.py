@@ -0,0 +1,105 @@
+from unittest import TestCase
+import os
+import socket
+import shutil
+import tempfile
+import threading
+
+from codega.builder import BuildRunner
+from codega.client import Connection
+from codega.runnercache import RunnerCache
+from codega.server import BuildServer
+
+exampledir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples')
+
+config_content = """<?xml version="1.0" ?>
+<config version="1.5">
+    <paths>
+        <target>out</target>
+        <path>%s</path>
+    </paths>
+    <source>
+        <name>source</name>
+        <resource>source.xml</resource>
+    </source>
+    <target>
+        <source>source</source>
+        <generator>dumper.DumpGenerator</generator>
+        <target>a.txt</target>
+    </target>
+</config>
+""" % os.path.join(exampledir, 'basic')
+
+
+class ServerTestBase(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.path, 'out'))
+
+        self.config = self.write('codega.xml', config_content)
+        self.write('source.xml', '<root><entry name="a" /></root>')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, data):
+        filename = os.path.join(self.path, name)
+        with open(filename, 'w') as out:
+            out.write(data)
+
+        return filename
+
+
+class TestRunnerCache(ServerTestBase):
+    def test_get_runner(self):
+        cache = RunnerCache()
+
+        runner = cache.get_runner(BuildRunner, self.config)
+        self.assertTrue(cache.get_runner(BuildRunner, self.config) is runner)
+        self.assertEqual(len(cache), 1)
+
+        self.write('codega.xml', config_content.replace('a.txt', 'b.txt'))
+        self.assertFalse(cache.get_runner(BuildRunner, self.config) is runner)
+
+    def test_trim(self):
+        cache = RunnerCache(memory_budget=0)
+
+        runner = cache.get_runner(BuildRunner, self.config)
+        self.assertTrue(runner.run_task('build', source_cache=False, output_cache=False))
+        self.assertTrue(runner.estimate_source_memory() > 0)
+
+        cache.trim()
+        self.assertEqual(runner.estimate_source_memory(), 0)
+
+
+class TestBuildServer(ServerTestBase):
+    def test_request(self):
+        server = BuildServer(os.path.join(self.path, 'server.sock'))
+        server_socket, client_socket = socket.socketpair()
+
+        server.preload()
+        BuildRunner.runner_cache = server.cache
+        thread = threading.Thread(target=server.handle, args=(Connection(server_socket),))
+        thread.start()
+        try:
+            client = Connection(client_socket)
+            client.send(argv=['make', '-v', 'info'], cwd=self.path, env=dict(os.environ))
+
+            logs = []
+            while True:
+                message = client.receive()
+                if 'result' in message:
+                    break
+
+                logs.append(message['log'])
+
+        finally:
+            thread.join()
+            BuildRunner.runner_cache = None
+            server_socket.close()
+            client_socket.close()
+
+        self.assertTrue(message["result"], logs)
+        self.assertTrue(any('Completed task build' in line for line in logs))
+        self.assertTrue(os.path.isfile(os.path.join(self.path, 'out', 'a.txt')))
+        self.assertEqual(len(server.cache), 1)
@@ -0,0 +1,60 @@
+from unittest import TestCase
+
+from codega.shard import parse_shard, partition, select_shard, check_reports, get_weights
+
+
+class TestShard(TestCase):
+    def make_report(self, index, count, names, duration=None):
+        items = dict((name, {'digest': 'x', 'duration': duration}) for name in names)
+        return {'version': 1, 'shard': [index, count], 'items': items}
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard('1/1'), (1, 1))
+        self.assertEqual(parse_shard('3/4'), (3, 4))
+
+        for text in ('', '1', '0/2', '3/2', 'a/b', '1/0'):
+            self.assertRaises(ValueError, parse_shard, text)
+
+    def test_partition(self):
+        names = ['t%d' % index for index in range(10)]
+        shards = partition(names, 3)
+
+        self.assertEqual(sorted(sum(shards, [])), sorted(names))
+        self.assertEqual(sorted(len(shard) for shard in shards), [3, 3, 4])
+
+        # The partition does not depend on the order of the names
+        self.assertEqual(partition(list(reversed(names)), 3), shards)
+
+    def test_partition_weights(self):
+        weights = {'slow': 10.0, 'a': 1.0, 'b': 1.0, 'c': 1.0}
+        shards = partition(['a', 'b', 'c', 'slow'], 2, weights)
+        self.assertEqual(shards, [['slow'], ['a', 'b', 'c']])
+
+        # Names without a weight cost the average
+        shards = partition(['a', 'b', 'slow', 'new'], 2, weights)
+        self.assertTrue(['slow'] in shards)
+
+    def test_select_shard(self):
+        targets = ['t%d' % index for index in range(5)]
+        copies = ['c%d' % index for index in range(4)]
+
+        selected = [select_shard(targets, copies, index, 2) for index in (1, 2)]
+        self.assertEqual(selected[0] & selected[1], set())
+        self.assertEqual(selected[0] | selected[1], set(targets + copies))
+        self.assertEqual(len(selected[0] & set(copies)), 2)
+
+    def test_check_reports(self):
+        reports = [self.make_report(1, 2, ['a', 'b'], 0.5), self.make_report(2, 2, ['c'])]
+        self.assertEqual(check_reports(reports, ['a', 'b', 'c']), [])
+        self.assertEqual(get_weights(reports), {'a': 0.5, 'b': 0.5})
+
+        problems = check_reports(reports, ['a', 'b', 'c', 'd'])
+        self.assertEqual(problems, ["Output 'd' was not produced"])
+
+        reports.append(self.make_report(2, 2, ['a']))
+        problems = check_reports(reports, ['a', 'b', 'c'])
+        self.assertTrue('Shard 2 has 2 reports' in problems)
+        self.assertTrue("Output 'a' was produced by shards 1, 2" in problems)
+
+        problems = check_reports(reports[:1], ['a', 'b'])
+        self.assertEqual(problems, ['Report of shard 2/2 is missing'])
@@ -0,0 +1,60 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+from codega.stamp import get_signature, save_stamp, check_stamp
+
+
+class TestStamp(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.config = os.path.join(self.path, 'codega.xml')
+        self.input = os.path.join(self.path, 'input.txt')
+        self.stamp = os.path.join(self.path, 'stamp')
+        self.variable = os.getenv('CODEGA_STAMP_TEST')
+
+        with open(self.config, 'w') as out:
+            out.write('<config><paths><target>@CODEGA_STAMP_TEST@</target></paths></config>')
+
+        with open(self.input, 'w') as out:
+            out.write('input')
+
+    def tearDown(self):
+        if self.variable is None:
+            os.environ.pop('CODEGA_STAMP_TEST', None)
+
+        else:
+            os.environ['CODEGA_STAMP_TEST'] = self.variable
+
+        shutil.rmtree(self.path)
+
+    def save(self):
+        paths = [self.config, self.input, os.path.join(self.path, 'missing.txt')]
+        save_stamp(self.stamp, [self.config], dict((path, get_signature(path)) for path in paths))
+
+    def test_check(self):
+        self.assertFalse(check_stamp(self.stamp))
+
+        self.save()
+        self.assertTrue(check_stamp(self.stamp))
+
+        with open(self.input, 'a') as out:
+            out.write('changed')
+
+        self.assertFalse(check_stamp(self.stamp))
+
+    def test_missing_file(self):
+        self.save()
+        with open(os.path.join(self.path, 'missing.txt'), 'w') as out:
+            out.write('')
+
+        self.assertFalse(check_stamp(self.stamp))
+
+    def test_environment(self):
+        os.environ['CODEGA_STAMP_TEST'] = 'out'
+        self.save()
+        self.assertTrue(check_stamp(self.stamp))
+
+        os.environ['CODEGA_STAMP_TEST'] = 'other'
+        self.assertFalse(check_stamp(self.stamp))
@@ -0,0 +1,75 @@
+from unittest import TestCase
+import os
+import json
+import shutil
+import tempfile
+
+from codega.timing import BuildProfile, format_table
+
+
+class TestBuildProfile(TestCase):
+    def make_record(self, phase, wall, target=None, source='src', generator=None, builder='target'):
+        return {'phase': phase, 'target': target, 'source': source, 'generator': generator,
+                'builder': builder, 'wall': wall, 'cpu': wall / 2}
+
+    def test_measure(self):
+        profile = BuildProfile()
+        with profile.measure('generate', target='a.txt', source='src', generator='gen', builder='target'):
+            pass
+
+        self.assertEqual(len(profile), 1)
+        record = profile.records[0]
+        self.assertEqual(record['phase'], 'generate')
+        self.assertEqual(record['target'], 'a.txt')
+        self.assertTrue(record['wall'] >= 0)
+
+    def test_merge(self):
+        profile = BuildProfile()
+        profile.add(self.make_record('parse', 1.0, builder='source'))
+        mark = len(profile)
+
+        other = BuildProfile()
+        other.add(self.make_record('generate', 2.0, target='a.txt'))
+        profile.merge(other.get_records())
+
+        self.assertEqual(len(profile), 2)
+        self.assertEqual(profile.get_records(mark), other.records)
+
+    def test_totals(self):
+        profile = BuildProfile()
+        profile.add(self.make_record('parse', 1.0, builder='source'))
+        profile.add(self.make_record('generate', 2.0, target='a.txt', generator='gen'))
+        profile.add(self.make_record('write', 0.5, target='a.txt', generator='gen'))
+        profile.add(self.make_record('generate', 4.0, target='b.txt', generator='gen'))
+
+        self.assertEqual(profile.get_totals('source'), {'src': (7.5, 3.75)})
+        self.assertEqual(profile.get_totals('generator'), {'gen': (6.5, 3.25)})
+
+        items = profile.get_items()
+        self.assertEqual([item[0] for item in items], ['b.txt', 'a.txt', 'source:src'])
+        self.assertEqual(items[1][2], {'generate': (2.0, 1.0), 'write': (0.5, 0.25)})
+
+        report = profile.format_report(top=1)
+        self.assertTrue(report.startswith('Slowest 1 of 3 items'))
+        self.assertTrue('b.txt' in report)
+        self.assertFalse('a.txt' in report)
+
+    def test_save(self):
+        path = tempfile.mkdtemp()
+        try:
+            profile = BuildProfile()
+            profile.add(self.make_record('generate', 2.0, target='a.txt', generator='gen'))
+            profile.save(os.path.join(path, 'profile.json'))
+
+            with open(os.path.join(path, 'profile.json')) as f:
+                data = json.load(f)
+
+            self.assertEqual(len(data['records']), 1)
+            self.assertEqual(data['totals']['generator'], {'gen': [2.0, 1.0]})
+
+        finally:
+            shutil.rmtree(path)
+
+    def test_format_table(self):
+        self.assertEqual(format_table(['a', 'b'], [['long', '1'], ['x', '100']]),
+                         ['a       b', 'long    1', 'x     100'])
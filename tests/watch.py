@@ -0,0 +1,161 @@
+from unittest import TestCase
+import os
+import sys
+import shutil
+import tempfile
+import threading
+
+from codega.watch import PollingWatcher, InotifyWatcher, BuildWatch, load_libc
+
+
+watch_config = """<?xml version="1.0" ?>
+<config version="1.5">
+    <paths>
+        <target>out</target>
+        <path>gen</path>
+    </paths>
+    <source>
+        <name>source</name>
+        <resource>source.xml</resource>
+    </source>
+    <target>
+        <source>source</source>
+        <generator>watchgen_module.PrefixGenerator</generator>
+        <target>a.txt</target>
+    </target>
+    <target>
+        <source>source</source>
+        <generator>watchgen_other.CountGenerator</generator>
+        <target>b.txt</target>
+    </target>
+</config>
+"""
+
+watch_files = {
+    'source.xml': '<root><entry /></root>',
+    'gen/watchgen_module.py': """from codega.generator.base import GeneratorBase
+import watchgen_helper
+
+class PrefixGenerator(GeneratorBase):
+    def generate(self, source, context):
+        return '%s: %d\\n' % (watchgen_helper.PREFIX, len(source))
+""",
+    'gen/watchgen_helper.py': "PREFIX = 'prefix'\n",
+    'gen/watchgen_other.py': """from codega.generator.base import GeneratorBase
+
+class CountGenerator(GeneratorBase):
+    def generate(self, source, context):
+        return '%d\\n' % len(source)
+""",
+}
+
+
+class WatcherTestMixin(object):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.tree = os.path.join(self.path, 'tree')
+        os.mkdir(self.tree)
+
+        self.single = self.write('single.txt', 'a')
+        self.other = self.write('other.txt', 'a')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, data):
+        filename = os.path.join(self.path, name)
+        with open(filename, 'w') as out:
+            out.write(data)
+
+        return filename
+
+    def check_changes(self, watcher, change, expected):
+        watcher.set_paths([self.single, self.tree])
+
+        timer = threading.Timer(0.05, change)
+        timer.start()
+        try:
+            self.assertEqual(watcher.wait(), expected)
+
+        finally:
+            timer.join()
+            watcher.close()
+
+    def test_file(self):
+        self.check_changes(self.create_watcher(), lambda: self.write('single.txt', 'changed'), [self.single])
+
+    def test_tree(self):
+        def change():
+            self.write('other.txt', 'not watched')
+            self.write('tree/new.txt', 'new')
+
+        self.check_changes(self.create_watcher(), change, [os.path.join(self.tree, 'new.txt')])
+
+
+class TestPollingWatcher(WatcherTestMixin, TestCase):
+    def create_watcher(self):
+        return PollingWatcher(interval=0.1)
+
+
+if load_libc() is not None:
+    class TestInotifyWatcher(WatcherTestMixin, TestCase):
+        def create_watcher(self):
+            return InotifyWatcher(load_libc())
+
+
+class TestBuildWatch(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for name in ('gen', 'out'):
+            os.mkdir(os.path.join(self.path, name))
+
+        self.write('codega.xml', watch_config)
+        for name, content in watch_files.iteritems():
+            self.write(name, content)
+
+        self.watch = BuildWatch(os.path.join(self.path, 'codega.xml'), None)
+        self.assertTrue(self.watch.load())
+        self.assertTrue(self.watch.build())
+
+    def tearDown(self):
+        for name in ('watchgen_module', 'watchgen_helper', 'watchgen_other'):
+            sys.modules.pop(name, None)
+
+        shutil.rmtree(self.path)
+
+    def write(self, name, data):
+        filename = os.path.join(self.path, name)
+        with open(filename, 'w') as out:
+            out.write(data)
+
+        # Modules written in the same second must not be loaded from the
+        # byte code of the previous content
+        mtime = os.stat(filename).st_mtime + 10
+        os.utime(filename, (mtime, mtime))
+        return filename
+
+    def read(self, name):
+        with open(os.path.join(self.path, 'out', name)) as f:
+            return f.read()
+
+    def rebuild(self, changed):
+        self.assertEqual(self.watch.handle_changes(set(changed)), (True, False))
+        self.assertTrue(self.watch.build())
+        summary = self.watch.runner.summary
+        return summary['written outputs'] + summary['unchanged outputs']
+
+    def test_input_change(self):
+        changed = self.write('source.xml', '<root><entry /><entry /></root>')
+        self.assertEqual(self.rebuild([changed]), 2)
+        self.assertEqual(self.read('a.txt'), 'prefix: 2\n')
+        self.assertEqual(self.read('b.txt'), '2\n')
+
+    def test_module_change(self):
+        # Only the target importing the module is rebuilt
+        changed = self.write('gen/watchgen_helper.py', "PREFIX = 'changed'\n")
+        self.assertEqual(self.rebuild([changed]), 1)
+        self.assertEqual(self.read('a.txt'), 'changed: 1\n')
+
+    def test_unrelated_change(self):
+        changed = self.write('gen/README', 'unrelated')
+        self.assertEqual(self.rebuild([changed]), 0)
@@ -0,0 +1,100 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+from codega.writer import OutputWriter, FSYNC_FILE, FSYNC_END
+
+
+class TestOutputWriter(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.results = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def filename(self, name):
+        return os.path.join(self.path, name)
+
+    def read(self, name):
+        with open(self.filename(name)) as f:
+            return f.read()
+
+    def callback(self, name):
+        def report(written):
+            self.results[name] = written
+
+        return report
+
+    def test_write(self):
+        writer = OutputWriter(threads=2, queue_size=2)
+        for index in range(10):
+            name = 'out%d.txt' % index
+            writer.submit(self.filename(name), 'data %d' % index, callback=self.callback(name))
+
+        self.assertTrue(writer.join())
+        self.assertEqual(len(self.results), 10)
+        self.assertTrue(all(self.results.values()))
+        self.assertEqual(self.read('out3.txt'), 'data 3')
+
+    def test_compare(self):
+        with open(self.filename('a.txt'), 'w') as out:
+            out.write('same')
+
+        os.utime(self.filename('a.txt'), (1000, 1000))
+
+        writer = OutputWriter(threads=1)
+        writer.submit(self.filename('a.txt'), 'same', compare=True, callback=self.callback('a'))
+        writer.submit(self.filename('b.txt'), 'new', compare=True, callback=self.callback('b'))
+        writer.flush()
+        self.assertEqual(self.results, {'a': False, 'b': True})
+        self.assertEqual(os.stat(self.filename('a.txt')).st_mtime, 1000)
+
+        # A recorded hash of the unchanged file is trusted
+        writer.submit(self.filename('a.txt'), 'diff', compare=True, recorded=(1000, 4, True),
+                      callback=self.callback('a'))
+        self.assertTrue(writer.join())
+        self.assertEqual(self.results['a'], False)
+        self.assertEqual(self.read('a.txt'), 'same')
+
+    def test_replace(self):
+        # The destination is replaced, a file linked to it is not changed
+        with open(self.filename('a.txt'), 'w') as out:
+            out.write('old')
+
+        os.chmod(self.filename('a.txt'), 0600)
+        os.link(self.filename('a.txt'), self.filename('link.txt'))
+
+        writer = OutputWriter(threads=0)
+        writer.submit(self.filename('a.txt'), 'new')
+        self.assertEqual(self.read('a.txt'), 'new')
+        self.assertEqual(self.read('link.txt'), 'old')
+        self.assertEqual(os.stat(self.filename('a.txt')).st_mode & 0777, 0600)
+        self.assertEqual(sorted(os.listdir(self.path)), ['a.txt', 'link.txt'])
+
+    def test_errors(self):
+        writer = OutputWriter(threads=2)
+        writer.submit(self.filename('missing/a.txt'), 'data', callback=self.callback('a'))
+        writer.submit(self.filename('b.txt'), 'data', callback=self.callback('b'))
+        self.assertFalse(writer.join())
+        self.assertEqual(self.results, {'b': True})
+
+        # The errors are reported once
+        self.assertTrue(writer.join())
+
+    def test_inline(self):
+        writer = OutputWriter(threads=0)
+        writer.submit(self.filename('a.txt'), 'data', callback=self.callback('a'))
+        self.assertEqual(self.results, {'a': True})
+        self.assertRaises(IOError, writer.submit, self.filename('missing/a.txt'), 'data')
+        self.assertTrue(writer.join())
+
+    def test_fsync(self):
+        for fsync in (FSYNC_FILE, FSYNC_END):
+            writer = OutputWriter(threads=1, fsync=fsync)
+            writer.submit(self.filename('a.txt'), fsync)
+            self.assertTrue(writer.join())
+            self.assertEqual(self.read('a.txt'), fsync)
+
+        self.assertRaises(ValueError, OutputWriter, fsync='always')